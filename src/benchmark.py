@@ -0,0 +1,175 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import kstruct_io
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_FORMAT = 'kstruct-bench'
+RESULTS_VERSION = 1
+
+
+def run_stage(name, command, log_path):
+    # One stage in its own process: wall time from the parent, peak RSS from
+    # the child's rusage (the largest of the stage and its worker processes).
+    with open(log_path, 'w') as log:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, cwd=SCRIPT_DIR)
+        _, status, usage = os.wait4(process.pid, 0)
+        wall = time.perf_counter() - start
+    # Reaped here for its rusage; tell Popen so it does not wait again.
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return {
+        'stage': name,
+        'exit_code': process.returncode,
+        'wall_seconds': wall,
+        'user_seconds': usage.ru_utime,
+        'system_seconds': usage.ru_stime,
+        'peak_rss_mb': usage.ru_maxrss / 1024.0,
+        'command': command,
+        'log': log_path,
+    }
+
+
+def planted_precision(graph_path, ground_truth_path):
+    # Fraction of the k strongest edges that join fields of the same planted
+    # cluster, with k the number of such field pairs.
+    with open(ground_truth_path, 'r') as f:
+        clusters = json.load(f)['clusters']
+    cluster_of = {field: c['id'] for c in clusters for field in c['members']}
+    k = sum(len(c['members']) * (len(c['members']) - 1) // 2 for c in clusters)
+    graph = kstruct_io.read_sparse_adjacency(graph_path)
+    rows, cols, weights = graph.edges()
+    if not k or not len(weights):
+        return None
+    top = np.argsort(-weights, kind='stable')[:k]
+    labels = graph.labels
+    same = [cluster_of.get(labels[a], -1) == cluster_of.get(labels[b], -2) for a, b in zip(rows[top], cols[top])]
+    return float(np.mean(same))
+
+
+def script(name):
+    return [sys.executable, os.path.join(SCRIPT_DIR, name)]
+
+
+def scale_stages(events, work_dir, args):
+    # (name, command, output checked for planted clusters) in run order; every
+    # stage reads what the ones before it wrote.
+    base = os.path.join(work_dir, f"e{events}")
+    suffix = kstruct_io.COLUMNAR_SUFFIX if args.columnar else '.csv'
+    trace, pahole, truth = f"{base}.log", f"{base}.pahole", f"{base}.truth.json"
+    table = f"{base}.access{suffix}"
+    window_graph, stack_graph = f"{base}.window{suffix}", f"{base}.stack{suffix}"
+    insights = f"{base}.insights.json"
+    sparse = ['--sparse'] if args.sparse else []
+    return [
+        ('generate', script('gen-trace.py') + [trace, pahole, '--ground_truth', truth, '--events', str(events),
+                                               '--fields', str(args.fields), '--clusters', str(args.clusters),
+                                               '--cpus', str(args.cpus), '--seed', str(args.seed)], None),
+        ('struct-parser', script('struct-parser.py') + [trace, pahole, table, '--exclude_cross_cpu',
+                                                        '--n_jobs', str(args.n_jobs), '--no_pahole_cache'], None),
+        ('proximity-window', script('proximity-graph.py') + ['--method', 'window', '--window_size', str(args.window_size),
+                                                             '--n_jobs', str(args.n_jobs), '--input_file', table,
+                                                             '--output_file', window_graph] + sparse, window_graph),
+        ('proximity-stack', script('proximity-graph.py') + ['--method', 'stack', '--stack_distance_threshold',
+                                                            str(args.stack_distance_threshold), '--n_jobs',
+                                                            str(args.n_jobs), '--input_file', table,
+                                                            '--output_file', stack_graph] + sparse, stack_graph),
+        ('hierarchical-clustering', script('hierarchical-clustering.py') + [window_graph, '-o', f"{base}.insights.out",
+                                                                            '--json_out', insights], None),
+        ('gen-heatmap', script('gen-heatmap.py') + [window_graph, f"{base}.heatmap.html", '--order', insights,
+                                                    '--static_out', f"{base}.heatmap.png"], None),
+    ]
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=SCRIPT_DIR, capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'host': platform.node(),
+        'git_commit': commit,
+    }
+
+
+def compare(results, baseline_path):
+    with open(baseline_path, 'r') as f:
+        baseline = {(r['events'], r['stage']): r for r in json.load(f)['results'] if r['exit_code'] == 0}
+    print(f"\nAgainst {baseline_path} (wall time ratio, < 1 is faster):")
+    for entry in results:
+        old = baseline.get((entry['events'], entry['stage']))
+        if old and entry['exit_code'] == 0:
+            print(f"  {entry['stage']:<24} {entry['events']:>10} events: {entry['wall_seconds'] / old['wall_seconds']:.2f}x, "
+                  f"peak RSS {entry['peak_rss_mb']:.0f} MB (was {old['peak_rss_mb']:.0f} MB)")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run the pipeline on synthetic traces of several sizes and record time and memory per stage."
+    )
+    parser.add_argument("--scales", type=int, nargs="+", default=[10000, 100000, 1000000],
+                        help="Trace sizes in accesses.")
+    parser.add_argument("--work_dir", type=str, default="bench", help="Directory for the traces, outputs and stage logs.")
+    parser.add_argument("--results", type=str, default="bench_results.json", help="JSON results file to write.")
+    parser.add_argument("--baseline", type=str, default=None,
+                        help="Results file of an earlier run to compare against.")
+    parser.add_argument("--n_jobs", type=int, default=4, help="--n_jobs for the parser and proximity stages.")
+    parser.add_argument("--fields", type=int, default=64, help="Struct members in the synthetic trace.")
+    parser.add_argument("--clusters", type=int, default=8, help="Planted clusters in the synthetic trace.")
+    parser.add_argument("--cpus", type=int, default=8, help="CPUs in the synthetic trace.")
+    parser.add_argument("--seed", type=int, default=0, help="Generator seed.")
+    parser.add_argument("--window_size", type=float, default=3e-6, help="Window size for the window stage.")
+    parser.add_argument("--stack_distance_threshold", type=int, default=10, help="Threshold for the stack stage.")
+    parser.add_argument("--sparse", action="store_true", help="Run the proximity stages with --sparse.")
+    parser.add_argument("--columnar", action="store_true", help="Use .kcol stores between stages instead of CSV.")
+
+    args = parser.parse_args()
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    work_dir = os.path.abspath(args.work_dir)
+    report = {
+        'format': RESULTS_FORMAT,
+        'version': RESULTS_VERSION,
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'environment': environment(),
+        'settings': vars(args),
+        'results': [],
+    }
+    for events in args.scales:
+        for name, command, graph in scale_stages(events, work_dir, args):
+            entry = run_stage(name, command, os.path.join(work_dir, f"e{events}.{name}.log"))
+            entry['events'] = events
+            entry['events_per_second'] = events / entry['wall_seconds'] if entry['wall_seconds'] else None
+            if graph and entry['exit_code'] == 0:
+                entry['planted_precision'] = planted_precision(graph, os.path.join(work_dir, f"e{events}.truth.json"))
+            report['results'].append(entry)
+            with open(args.results, 'w') as f:
+                json.dump(report, f, indent=2)
+
+            status = 'ok' if entry['exit_code'] == 0 else f"FAILED ({entry['exit_code']}, see {entry['log']})"
+            precision = f", planted precision {entry['planted_precision']:.2f}" if entry.get('planted_precision') is not None else ''
+            print(f"{name:<24} {events:>10} events: {entry['wall_seconds']:8.2f} s, "
+                  f"{entry['events_per_second']:12.0f} events/s, peak RSS {entry['peak_rss_mb']:8.1f} MB{precision} {status}")
+            if entry['exit_code'] != 0:
+                break
+
+    print(f"Results written to {args.results}")
+    if args.baseline:
+        compare(report['results'], args.baseline)
+
+
+if __name__ == "__main__":
+    main()
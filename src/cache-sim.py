@@ -0,0 +1,319 @@
+import argparse
+import json
+import os
+from collections import OrderedDict
+from typing import Any, Dict, List
+
+import numpy as np
+import pandas as pd
+
+import kstruct_io
+from pahole import split_access_path
+
+ACCESS_COLUMNS = ['Timestamp', 'CPU_ID', 'Field', 'Function', 'Access_Type', 'Offset', 'Size (Bytes)']
+
+
+def instance_column(columns: List[str]) -> str:
+    # The struct's [idx]; tables written before the Instance column only have
+    # it as Runqueue_CPU.
+    return 'Instance' if 'Instance' in columns else 'Runqueue_CPU'
+
+
+def load_accesses(filename: str) -> Dict[str, np.ndarray]:
+    columns = kstruct_io.table_columns(filename)
+    has_struct = 'Struct' in columns
+    instance = instance_column(columns)
+    data = kstruct_io.read_columns(filename, ACCESS_COLUMNS + [instance] + (['Struct'] if has_struct else []), dtype={
+        'Timestamp': np.float64, 'CPU_ID': np.int64, instance: np.int64,
+        'Field': 'category', 'Function': 'category', 'Access_Type': 'category', 'Struct': 'category',
+    })
+    # Replay in time order; accesses with equal timestamps keep their log order.
+    order = np.argsort(np.asarray(data['Timestamp']), kind='stable')
+    fields = pd.Series(data['Field']).astype(str).to_numpy()[order]
+    instances = np.asarray(data[instance])[order]
+    if has_struct:
+        structs = pd.Series(data['Struct']).astype(str).to_numpy()[order]
+        struct_codes, struct_names = pd.factorize(structs)
+        # Instances of different structs live apart; fields are "struct->field"
+        # once the trace holds more than one struct.
+        instances = struct_codes * (int(instances.max(initial=0)) + 1) + instances
+        if len(struct_names) > 1:
+            fields = structs.astype(object) + '->' + fields.astype(object)
+    fields, field_names = pd.factorize(fields)
+    functions, function_names = pd.factorize(pd.Series(data['Function']).astype(str).to_numpy()[order])
+    return {
+        'cpu': np.asarray(data['CPU_ID'])[order],
+        'instance': instances,
+        'field': fields,
+        'field_names': list(field_names),
+        'function': functions,
+        'function_names': list(function_names),
+        'write': (pd.Series(data['Access_Type']).astype(str).to_numpy() == 'modify')[order],
+        'offset': pd.to_numeric(pd.Series(np.asarray(data['Offset'])), errors='coerce').to_numpy()[order],
+        'size': pd.to_numeric(pd.Series(np.asarray(data['Size (Bytes)'])), errors='coerce').to_numpy()[order],
+    }
+
+
+def original_layout(events: Dict[str, Any]) -> Dict[str, Any]:
+    # Offsets and sizes attached by struct-parser.py, first value seen per field.
+    n_fields = len(events['field_names'])
+    offsets = np.full(n_fields, np.nan)
+    sizes = np.full(n_fields, np.nan)
+    first = np.unique(events['field'], return_index=True)[1]
+    offsets[events['field'][first]] = events['offset'][first]
+    sizes[events['field'][first]] = events['size'][first]
+    known = ~np.isnan(offsets) & ~np.isnan(sizes)
+    return {
+        'name': 'original',
+        'offsets': np.where(known, offsets, -1).astype(np.int64),
+        'sizes': np.where(known, sizes, 0).astype(np.int64),
+    }
+
+
+def json_layout(path: str, field_names: List[str], original: Dict[str, Any]) -> Dict[str, Any]:
+    # Members of the laid-out struct move with their top-level member; fields
+    # of other structs keep their original offsets.
+    with open(path, 'r') as f:
+        layout = json.load(f)
+    placed = {field['name']: field for field in layout['fields']}
+    offsets = original['offsets'].copy()
+    sizes = original['sizes'].copy()
+    for i, name in enumerate(field_names):
+        struct_name, member_path = split_access_path(name)
+        member = placed.get(member_path.split('.')[0])
+        if member is None or struct_name not in (None, layout['struct']):
+            continue
+        if member_path == member['name']:
+            offsets[i], sizes[i] = member['offset'], member['size']
+        elif offsets[i] >= 0:
+            offsets[i] += member['offset'] - member['original_offset']
+    return {'name': os.path.basename(path), 'offsets': offsets, 'sizes': sizes}
+
+
+def expand_to_lines(events: Dict[str, Any], layout: Dict[str, Any], line_size: int, access_bytes: int):
+    # One row per (access, cache line) it touches, in replay order.
+    offsets = layout['offsets'][events['field']]
+    sizes = layout['sizes'][events['field']]
+    if access_bytes:
+        sizes = np.minimum(sizes, access_bytes)
+    mapped = np.flatnonzero(offsets >= 0)
+    stride = -(-int((layout['offsets'] + layout['sizes']).max(initial=1)) // line_size)
+    first = offsets[mapped] // line_size
+    span = (offsets[mapped] + np.maximum(sizes[mapped], 1) - 1) // line_size - first + 1
+    access = np.repeat(mapped, span)
+    starts = np.cumsum(span) - span
+    within = np.arange(len(access)) - np.repeat(starts, span)
+    # Each struct instance (rq[cpu], task_struct[idx], ...) gets its own block of lines.
+    lines = events['instance'][access] * stride + np.repeat(first, span) + within
+    return access, lines, len(events['field']) - len(mapped)
+
+
+def operation_ids(events: Dict[str, Any]) -> np.ndarray:
+    # An operation is a run of consecutive accesses by one CPU from the same function.
+    order = np.lexsort((np.arange(len(events['cpu'])), events['cpu']))
+    cpu, function = events['cpu'][order], events['function'][order]
+    starts = np.ones(len(order), dtype=bool)
+    starts[1:] = (cpu[1:] != cpu[:-1]) | (function[1:] != function[:-1])
+    ops = np.empty(len(order), dtype=np.int64)
+    ops[order] = np.cumsum(starts) - 1
+    return ops
+
+
+def lines_per_operation(ops: np.ndarray, access: np.ndarray, lines: np.ndarray, n_ops: int) -> np.ndarray:
+    # Distinct (operation, line) pairs, packed into one int64 key per pair.
+    n_lines = int(lines.max()) + 1
+    keys = np.sort(ops[access] * n_lines + lines)
+    keys = keys[np.concatenate(([True], keys[1:] != keys[:-1]))]
+    return np.bincount(keys // n_lines, minlength=n_ops)
+
+
+def collapse_repeats(cpus: np.ndarray, lines: np.ndarray, writes: np.ndarray) -> np.ndarray:
+    # Indices of the line accesses the state machine has to see. In a run of
+    # consecutive accesses by one CPU to one line, all but the first hit the
+    # most recently used line with no other CPU in between, so only the first
+    # and the last write of the run (it leaves the dirty field) change state.
+    if not len(lines):
+        return np.zeros(0, dtype=np.int64)
+    starts = np.ones(len(lines), dtype=bool)
+    starts[1:] = (cpus[1:] != cpus[:-1]) | (lines[1:] != lines[:-1])
+    run = np.cumsum(starts) - 1
+    written = np.flatnonzero(writes)
+    last_write = written[np.append(run[written][1:] != run[written][:-1], True)] if len(written) else written
+    starts[last_write] = True
+    return np.flatnonzero(starts)
+
+
+def simulate_caches(cpus: np.ndarray, lines: np.ndarray, writes: np.ndarray, fields: np.ndarray,
+                    n_sets: int, ways: int, n_fields: int, collapse: bool = True) -> Dict[str, Any]:
+    # Per-CPU set-associative LRU caches kept coherent by invalidation: a write
+    # removes every other copy of the line, and touching a line another CPU
+    # modified moves it over (a cross-CPU transfer, charged to the written field).
+    # Line mapping, set indices and repeat hits are settled with NumPy; only
+    # the LRU and coherence state machine runs per access.
+    if collapse:
+        keep = collapse_repeats(cpus, lines, writes)
+        cpus, lines, writes, fields = cpus[keep], lines[keep], writes[keep], fields[keep]
+    slots = cpus.astype(np.int64) * n_sets + lines % n_sets
+    caches: Dict[int, OrderedDict] = {}
+    holders: Dict[int, set] = {}
+    owner: Dict[int, int] = {}
+    dirty_field: Dict[int, int] = {}
+    misses = [0] * n_fields
+    transfers = [0] * n_fields
+    invalidations = 0
+
+    for cpu, line, write, field, slot in zip(cpus.tolist(), lines.tolist(), writes.tolist(), fields.tolist(),
+                                             slots.tolist()):
+        cache = caches.get(slot)
+        if cache is None:
+            cache = caches[slot] = OrderedDict()
+        if line in cache:
+            cache.move_to_end(line)
+        else:
+            misses[field] += 1
+            cache[line] = None
+            if len(cache) > ways:
+                victim, _ = cache.popitem(last=False)
+                holders[victim].discard(cpu)
+                if owner.get(victim) == cpu:
+                    del owner[victim]
+            holders.setdefault(line, set()).add(cpu)
+
+        modified_by = owner.get(line)
+        if modified_by is not None and modified_by != cpu:
+            transfers[dirty_field[line]] += 1
+            if not write:
+                del owner[line]
+        if write:
+            sharers = holders[line]
+            if len(sharers) > 1:
+                set_index = line % n_sets
+                for other in sharers:
+                    if other != cpu:
+                        del caches[other * n_sets + set_index][line]
+                invalidations += len(sharers) - 1
+                holders[line] = {cpu}
+            owner[line] = cpu
+            dirty_field[line] = field
+
+    return {'misses': np.array(misses, dtype=np.int64), 'transfers': np.array(transfers, dtype=np.int64),
+            'invalidations': invalidations}
+
+
+def replay(events: Dict[str, Any], layout: Dict[str, Any], ops: np.ndarray, line_size: int, access_bytes: int,
+           n_sets: int, ways: int, top_n: int) -> Dict[str, Any]:
+    access, lines, unmapped = expand_to_lines(events, layout, line_size, access_bytes)
+    n_ops = int(ops.max()) + 1 if len(ops) else 0
+    per_op = lines_per_operation(ops, access, lines, n_ops) if len(access) else np.zeros(n_ops, dtype=np.int64)
+    n_fields = len(events['field_names'])
+    sim = simulate_caches(events['cpu'][access], lines, events['write'][access], events['field'][access],
+                          n_sets, ways, n_fields)
+
+    op_function = np.zeros(n_ops, dtype=np.int64)
+    op_function[ops] = events['function']
+    op_count = np.bincount(op_function, minlength=len(events['function_names']))
+    op_lines = np.bincount(op_function, weights=per_op, minlength=len(events['function_names']))
+    busiest = np.argsort(-op_count, kind='stable')[:top_n]
+    field_rank = np.argsort(-sim['transfers'], kind='stable')[:top_n]
+
+    n_line_accesses = len(access)
+    misses = int(sim['misses'].sum())
+    return {
+        'layout': layout['name'],
+        'events': int(len(events['field'])),
+        'unmapped_events': int(unmapped),
+        'line_accesses': int(n_line_accesses),
+        'distinct_lines': int(np.count_nonzero(np.bincount(lines))) if len(lines) else 0,
+        'operations': int(n_ops),
+        'lines_per_operation': {
+            'mean': float(per_op.mean()) if n_ops else 0.0,
+            'p95': float(np.percentile(per_op, 95)) if n_ops else 0.0,
+            'max': int(per_op.max()) if n_ops else 0,
+        },
+        'misses': misses,
+        'miss_rate': misses / n_line_accesses if n_line_accesses else 0.0,
+        'cross_cpu_transfers': int(sim['transfers'].sum()),
+        'invalidations': int(sim['invalidations']),
+        'per_function': [
+            {'function': events['function_names'][i], 'operations': int(op_count[i]),
+             'mean_lines': float(op_lines[i] / op_count[i])}
+            for i in busiest if op_count[i]
+        ],
+        'transfers_by_field': [
+            {'field': events['field_names'][i], 'transfers': int(sim['transfers'][i])}
+            for i in field_rank if sim['transfers'][i]
+        ],
+    }
+
+
+def write_text_report(results: List[Dict[str, Any]], config: Dict[str, int], output_file: str) -> None:
+    with open(output_file, 'w') as f:
+        f.write(f"Cache: {config['cache_size']} bytes, {config['associativity']}-way, "
+                f"{config['cache_line_size']}-byte lines, {config['sets']} sets per CPU, "
+                f"{config['access_bytes'] or 'whole-field'} bytes per access\n\n")
+        f.write("Layout Summary\n")
+        f.write(f"{'layout':<30} {'lines/op':>9} {'p95':>6} {'misses':>10} {'miss rate':>10} "
+                f"{'transfers':>10} {'invalidations':>14}\n")
+        for r in results:
+            f.write(f"{r['layout']:<30} {r['lines_per_operation']['mean']:9.3f} {r['lines_per_operation']['p95']:6.1f} "
+                    f"{r['misses']:10d} {r['miss_rate']:10.4f} {r['cross_cpu_transfers']:10d} {r['invalidations']:14d}\n")
+        for r in results:
+            f.write(f"\n[{r['layout']}]\n")
+            f.write(f"events: {r['events']} (unmapped: {r['unmapped_events']}), line accesses: {r['line_accesses']}, "
+                    f"distinct lines: {r['distinct_lines']}, operations: {r['operations']}\n")
+            f.write("Lines per operation by function\n")
+            for entry in r['per_function']:
+                f.write(f"{entry['function']}: {entry['mean_lines']:.3f} ({entry['operations']} ops)\n")
+            if r['transfers_by_field']:
+                f.write("Cross-CPU transfers by modified field\n")
+                for entry in r['transfers_by_field']:
+                    f.write(f"{entry['field']}: {entry['transfers']}\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay a parsed access log through per-CPU LRU caches to score struct layouts."
+    )
+    parser.add_argument("access_file", help="Parsed access log from struct-parser.py (CSV or .kcol).")
+    parser.add_argument("--layout", action="append", default=[],
+                        help="Layout JSON from layout-optimizer.py --json_out; may be given more than once. "
+                             "The original pahole layout from the access log is always replayed.")
+    parser.add_argument("--output_file", "-o", default="cache_sim.out", help="Path to write the text report.")
+    parser.add_argument("--json_out", type=str, default=None, help="Optional path to also write the report as JSON.")
+    parser.add_argument("--cache_line_size", type=int, default=64, help="Cache line size in bytes.")
+    parser.add_argument("--cache_size", type=int, default=32768, help="Per-CPU cache size in bytes.")
+    parser.add_argument("--associativity", type=int, default=8, help="Ways per cache set.")
+    parser.add_argument("--access_bytes", type=int, default=8,
+                        help="Bytes touched by one access from the start of its field, so an access to a large "
+                             "member such as cfs counts one line rather than all of them; 0 touches the whole field.")
+    parser.add_argument("--top_n", type=int, default=10,
+                        help="Number of functions and transferred fields to report per layout.")
+
+    args = parser.parse_args()
+
+    n_sets = args.cache_size // (args.cache_line_size * args.associativity)
+    if n_sets < 1:
+        raise SystemExit("Error: --cache_size must hold at least one set of --associativity lines.")
+    config = {'cache_size': args.cache_size, 'associativity': args.associativity,
+              'cache_line_size': args.cache_line_size, 'sets': n_sets, 'access_bytes': args.access_bytes}
+
+    events = load_accesses(args.access_file)
+    ops = operation_ids(events)
+    original = original_layout(events)
+    layouts = [original] + [json_layout(path, events['field_names'], original) for path in args.layout]
+    results = [replay(events, layout, ops, args.cache_line_size, args.access_bytes, n_sets, args.associativity,
+                      args.top_n)
+               for layout in layouts]
+
+    write_text_report(results, config, args.output_file)
+    if args.json_out:
+        with open(args.json_out, 'w') as jf:
+            json.dump({'config': config, 'layouts': results}, jf, indent=2)
+
+    print(f"Cache simulation report written to {args.output_file}")
+    if args.json_out:
+        print(f"JSON report written to {args.json_out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+import argparse
+import json
+import sys
+from collections import defaultdict
+from typing import Any, Dict, Iterator, List
+
+import numpy as np
+import pandas as pd
+
+import kstruct_io
+
+ACCESS_COLUMNS = ['CPU_ID', 'Timestamp', 'Field', 'Access_Type', 'Offset']
+
+
+def iter_access_chunks(filename: str, chunk_size: int) -> Iterator[pd.DataFrame]:
+    # Cross-CPU accesses are kept: they are the signal here. The struct's
+    # [idx] comes as Instance, also from tables that only have Runqueue_CPU.
+    available = kstruct_io.table_columns(filename)
+    instance = 'Instance' if 'Instance' in available else 'Runqueue_CPU'
+    columns = ACCESS_COLUMNS + [instance] + (['Struct'] if 'Struct' in available else [])
+    if kstruct_io.is_columnar(filename):
+        arrays = kstruct_io.read_columnar_columns(filename, columns)
+        n_rows = len(arrays['Timestamp'])
+        for start in range(0, n_rows, chunk_size):
+            chunk = pd.DataFrame({name: values[start:start + chunk_size] for name, values in arrays.items()})
+            yield chunk.rename(columns={instance: 'Instance'})
+        return
+    for chunk in pd.read_csv(filename, usecols=columns, chunksize=chunk_size):
+        yield chunk.rename(columns={instance: 'Instance'})
+
+
+class LineContention:
+    # Recent accesses per cache line, keyed by (cpu, field) and pruned to the
+    # window, so each event is checked against the handful of CPUs that touched
+    # its line recently rather than against every other event. Events must be
+    # observed in time order: observe_chunk sorts each chunk together with the
+    # events of the previous one that are still within a window of its newest
+    # event. An event older than one already observed is late; it is skipped
+    # and counted in late_events.
+    def __init__(self, window_size: float):
+        self.window_size = window_size
+        self.recent: Dict[Any, Dict[Any, List[float]]] = {}
+        self.false_sharing = defaultdict(int)
+        self.true_sharing = defaultdict(int)
+        self.pair_counts = defaultdict(int)
+        self.field_true_sharing = defaultdict(int)
+        self.line_fields = defaultdict(set)
+        self.line_cpus = defaultdict(set)
+        self.line_instances = defaultdict(set)
+        self.events = 0
+        self.late_events = 0
+        self.observed_until = float('-inf')
+        self.pending: List[np.ndarray] = []
+
+    def observe(self, timestamp: float, cpu: int, instance: int, line: Any, field: str, write: bool) -> None:
+        # line is (struct, cache line within the struct).
+        self.events += 1
+        key = (instance, line)
+        state = self.recent.get(key)
+        if state is None:
+            state = self.recent[key] = {}
+        horizon = timestamp - self.window_size
+        stale = []
+        for (other_cpu, other_field), (last_access, last_modify) in state.items():
+            if max(last_access, last_modify) < horizon:
+                stale.append((other_cpu, other_field))
+                continue
+            if other_cpu == cpu:
+                continue
+            # A modify contends with any recent access from another CPU; an
+            # access contends only with another CPU's recent modify.
+            if not (write or last_modify >= horizon):
+                continue
+            if other_field == field:
+                self.true_sharing[line] += 1
+                self.field_true_sharing[field] += 1
+            else:
+                self.false_sharing[line] += 1
+                self.pair_counts[(min(field, other_field), max(field, other_field))] += 1
+            self.line_cpus[line].update((cpu, other_cpu))
+            self.line_instances[line].add(instance)
+        for entry in stale:
+            del state[entry]
+
+        times = state.get((cpu, field))
+        if times is None:
+            times = state[(cpu, field)] = [float('-inf'), float('-inf')]
+        times[1 if write else 0] = timestamp
+        self.line_fields[line].add(field)
+
+    def observe_chunk(self, chunk: pd.DataFrame, line_size: int) -> int:
+        offsets = pd.to_numeric(chunk['Offset'], errors='coerce').to_numpy()
+        known = ~np.isnan(offsets)
+        structs = chunk['Struct'].astype(str).to_numpy()[known] if 'Struct' in chunk else np.full(known.sum(), '')
+        columns = [chunk['Timestamp'].to_numpy(dtype=np.float64)[known],
+                   chunk['CPU_ID'].to_numpy(dtype=np.int64)[known],
+                   chunk['Instance'].to_numpy(dtype=np.int64)[known],
+                   structs.astype(object), (offsets[known] // line_size).astype(np.int64),
+                   chunk['Field'].astype(str).to_numpy().astype(object)[known],
+                   (chunk['Access_Type'].astype(str).to_numpy() == 'modify')[known]]
+        if self.pending:
+            columns = [np.concatenate([held, new]) for held, new in zip(self.pending, columns)]
+        # perf merges per-CPU buffers, so timestamps can go backwards: events
+        # are held back until a window past them has been seen.
+        order = np.argsort(columns[0], kind='stable')
+        columns = [column[order] for column in columns]
+        ready = int(np.searchsorted(columns[0], columns[0][-1] - self.window_size, side='left')) if len(order) else 0
+        self.observe_sorted([column[:ready] for column in columns])
+        self.pending = [column[ready:] for column in columns]
+        return int(len(offsets) - known.sum())
+
+    def finish(self) -> None:
+        if self.pending:
+            self.observe_sorted(self.pending)
+            self.pending = []
+
+    def observe_sorted(self, columns: List[np.ndarray]) -> None:
+        timestamps, cpus, instances, structs, lines, fields, writes = columns
+        if len(timestamps):
+            late = timestamps < self.observed_until
+            if late.any():
+                if not self.late_events:
+                    print(f"Warning: {int(late.sum())} events are older than events already observed "
+                          f"(up to {self.observed_until}); they are skipped (see late_events in the report).",
+                          file=sys.stderr)
+                self.late_events += int(late.sum())
+                timestamps, cpus, instances, structs, lines, fields, writes = (
+                    column[~late] for column in columns)
+        for timestamp, cpu, instance, line, field, write in zip(
+                timestamps.tolist(), cpus.tolist(), instances.tolist(), zip(structs.tolist(), lines.tolist()),
+                fields.tolist(), writes.tolist()):
+            self.observe(timestamp, cpu, instance, line, field, write)
+        if len(timestamps):
+            self.observed_until = max(self.observed_until, float(timestamps[-1]))
+
+    def report(self, line_size: int, top_n: int) -> Dict[str, Any]:
+        lines = sorted(set(self.false_sharing) | set(self.true_sharing),
+                       key=lambda line: (-self.false_sharing[line], -self.true_sharing[line], line))
+        pairs = sorted(self.pair_counts.items(), key=lambda item: (-item[1], item[0]))[:top_n]
+        fields = sorted(self.field_true_sharing.items(), key=lambda item: (-item[1], item[0]))[:top_n]
+        return {
+            'lines': [
+                {'struct': line[0], 'cacheline': int(line[1]), 'offset': int(line[1] * line_size),
+                 'false_sharing': self.false_sharing[line], 'true_sharing': self.true_sharing[line],
+                 'cpus': len(self.line_cpus[line]), 'instances': len(self.line_instances[line]),
+                 'fields': sorted(self.line_fields[line])}
+                for line in lines
+            ],
+            'late_events': self.late_events,
+            'field_pairs': [{'a': a, 'b': b, 'count': count} for (a, b), count in pairs],
+            'true_sharing_fields': [{'field': field, 'count': count} for field, count in fields],
+        }
+
+
+def write_text_report(report: Dict[str, Any], output_file: str) -> None:
+    with open(output_file, 'w') as f:
+        f.write(f"Events: {report['events']} (without pahole offset: {report['unmapped_events']}), "
+                f"window: {report['window_size']}, cache line: {report['cache_line_size']} bytes\n")
+        if report['late_events']:
+            f.write(f"Late events skipped (older than events already observed): {report['late_events']}\n")
+        f.write("\n")
+        f.write("Contended Cache Lines (false sharing, true sharing, CPUs, struct instances)\n")
+        for entry in report['lines']:
+            struct = f"{entry['struct']} " if entry['struct'] else ''
+            f.write(f"{struct}cacheline {entry['cacheline']} (offset {entry['offset']}): {entry['false_sharing']}, "
+                    f"{entry['true_sharing']}, {entry['cpus']}, {entry['instances']}  "
+                    f"[{', '.join(entry['fields'])}]\n")
+        f.write("\nFalse Sharing Field Pairs (modify vs. other-CPU access of a different field on the same line)\n")
+        for entry in report['field_pairs']:
+            f.write(f"{entry['a']} <-> {entry['b']}: {entry['count']}\n")
+        f.write("\nTrue Sharing Fields (same field modified and accessed from different CPUs)\n")
+        for entry in report['true_sharing_fields']:
+            f.write(f"{entry['field']}: {entry['count']}\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Find cache lines that different CPUs modify and access within a time window."
+    )
+    parser.add_argument("input_file", help="Parsed access log without --exclude_cross_cpu (CSV or .kcol), in log order.")
+    parser.add_argument("--output_file", "-o", default="false_sharing.out", help="Path to write the text report.")
+    parser.add_argument("--json_out", type=str, default=None, help="Optional path to also write the report as JSON.")
+    parser.add_argument("--window_size", type=float, default=3e-6,
+                        help="Accesses from different CPUs closer than this (in timestamp units) contend.")
+    parser.add_argument("--cache_line_size", type=int, default=64, help="Cache line size in bytes.")
+    parser.add_argument("--chunk_size", type=int, default=100000, help="Rows read from the input at a time.")
+    parser.add_argument("--top_n", type=int, default=30, help="Number of field pairs and fields to report.")
+
+    args = parser.parse_args()
+
+    contention = LineContention(args.window_size)
+    unmapped = 0
+    for chunk in iter_access_chunks(args.input_file, args.chunk_size):
+        unmapped += contention.observe_chunk(chunk, args.cache_line_size)
+    contention.finish()
+
+    report = {
+        'events': contention.events + unmapped,
+        'unmapped_events': unmapped,
+        'window_size': args.window_size,
+        'cache_line_size': args.cache_line_size,
+    }
+    report.update(contention.report(args.cache_line_size, args.top_n))
+
+    write_text_report(report, args.output_file)
+    if args.json_out:
+        with open(args.json_out, 'w') as jf:
+            json.dump(report, jf, indent=2)
+
+    print(f"False sharing report written to {args.output_file}")
+    if args.json_out:
+        print(f"JSON report written to {args.json_out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,86 +1,159 @@
+import argparse
+import base64
+import json
+import struct
+import zlib
+from typing import Dict, List, Optional, Tuple
+from xml.sax.saxutils import escape
+
+import numpy as np
 import pandas as pd
 import plotly.express as px
-import argparse
 
-def main():
-    parser = argparse.ArgumentParser(description="Generate a heatmap based on percentages relative to the highest value.")
-    parser.add_argument("input_file", help="Path to the input CSV file containing the adjacency matrix.")
-    parser.add_argument("output_file", help="Path to save the output HTML file.")
-    args = parser.parse_args()
+import kstruct_io
+import kstruct_metrics
 
-    csv_file = args.input_file
-    output_file = args.output_file
+TITLE = "Heatmap Based on Percentage Relative to Max Value ({view})"
 
-    try:
-        df = pd.read_csv(csv_file, index_col=0)
-    except FileNotFoundError:
-        print(f"Error: The file '{csv_file}' was not found.")
-        return 1
+COLOR_SCALE = [
+    (0.00, "#e5e5e5"),  # 0–1%: Very light gray
+    (0.01, "#d9e2dc"),  # 2–3%: Light muted green
+    (0.03, "#c2d8cf"),  # 4–5%: Soft teal
+    (0.05, "#a8cbc0"),  # 6–7%: Muted aqua
+    (0.07, "#85b8af"),  # 8–9%: Soft green
+    (0.09, "#6ba99f"),  # 10–11%: Matte green
+    (0.11, "#4a8b80"),  # 12–13%: Muted teal
+    (0.13, "#34695f"),  # 14–15%: Dark muted green
+    (0.15, "#2e5551"),  # 16–17%: Dark matte forest green
+    (0.17, "#243d3f"),  # 18–19%: Very dark green
+    (0.19, "#345b8a"),  # 20–21%: Soft blue-gray
+    (0.21, "#3e6799"),  # 22–23%: Muted navy blue
+    (0.23, "#4873a8"),  # 24–25%: Deep blue
+    (0.25, "#507bb7"),  # 26–27%: Rich blue
+    (0.27, "#5983c6"),  # 28–29%: Medium blue
+    (0.29, "#6179d5"),  # 30–31%: Muted royal blue
+    (0.31, "#6a8ee4"),  # 32–33%: Bright navy
+    (0.33, "#728df3"),  # 34–35%: Soft indigo
+    (0.35, "#7b7dfa"),  # 36–37%: Light indigo
+    (0.37, "#8375ff"),  # 38–39%: Muted violet
+    (0.39, "#8b6aff"),  # 40–41%: Rich violet
+    (0.41, "#9460ff"),  # 42–43%: Deep violet
+    (0.43, "#9b55ff"),  # 44–45%: Soft purple
+    (0.45, "#a44aff"),  # 46–47%: Rich purple
+    (0.47, "#ac3fff"),  # 48–49%: Matte purple
+    (0.49, "#b534ff"),  # 50–51%: Bold purple
+    (0.51, "#c229f8"),  # 52–53%: Deep pink-purple
+    (0.53, "#d71fe3"),  # 54–55%: Vibrant pink
+    (0.55, "#e015c9"),  # 56–57%: Muted magenta
+    (0.57, "#e60bb0"),  # 58–59%: Deep magenta
+    (0.59, "#ec0098"),  # 60–61%: Bright magenta
+    (0.61, "#f00081"),  # 62–63%: Matte fuchsia
+    (0.63, "#f40069"),  # 64–65%: Deep muted red
+    (0.65, "#f80052"),  # 66–67%: Rich red
+    (0.67, "#fc003b"),  # 68–69%: Vibrant red
+    (0.69, "#ff0024"),  # 70–71%: Bold red
+    (0.71, "#ff140d"),  # 72–73%: Bright crimson
+    (0.73, "#ff2900"),  # 74–75%: Deep crimson
+    (0.75, "#ff3f00"),  # 76–77%: Rich orange-red
+    (0.77, "#ff5500"),  # 78–79%: Deep orange
+    (0.79, "#ff6b00"),  # 80–81%: Vibrant orange
+    (0.81, "#ff8100"),  # 82–83%: Bright orange
+    (0.83, "#ff9700"),  # 84–85%: Soft orange
+    (0.85, "#ffad00"),  # 86–87%: Muted amber
+    (0.87, "#ffc300"),  # 88–89%: Rich gold
+    (0.89, "#ffdb00"),  # 90–91%: Vibrant yellow
+    (0.91, "#ffe000"),  # 92–93%: Bright yellow
+    (0.93, "#ffe600"),  # 94–95%: Soft yellow
+    (0.95, "#ffec00"),  # 96–97%: Pale yellow
+    (0.97, "#fff200"),  # 98–99%: Very light yellow
+    (1.00, "#fff700"),  # 100%: Brightest yellow
+]
 
-    max_value = df.max().max()
-    df_percentage = (df / max_value) * 100
-
-    color_scale = [
-        (0.00, "#e5e5e5"),  # 0–1%: Very light gray
-        (0.01, "#d9e2dc"),  # 2–3%: Light muted green
-        (0.03, "#c2d8cf"),  # 4–5%: Soft teal
-        (0.05, "#a8cbc0"),  # 6–7%: Muted aqua
-        (0.07, "#85b8af"),  # 8–9%: Soft green
-        (0.09, "#6ba99f"),  # 10–11%: Matte green
-        (0.11, "#4a8b80"),  # 12–13%: Muted teal
-        (0.13, "#34695f"),  # 14–15%: Dark muted green
-        (0.15, "#2e5551"),  # 16–17%: Dark matte forest green
-        (0.17, "#243d3f"),  # 18–19%: Very dark green
-        (0.19, "#345b8a"),  # 20–21%: Soft blue-gray
-        (0.21, "#3e6799"),  # 22–23%: Muted navy blue
-        (0.23, "#4873a8"),  # 24–25%: Deep blue
-        (0.25, "#507bb7"),  # 26–27%: Rich blue
-        (0.27, "#5983c6"),  # 28–29%: Medium blue
-        (0.29, "#6179d5"),  # 30–31%: Muted royal blue
-        (0.31, "#6a8ee4"),  # 32–33%: Bright navy
-        (0.33, "#728df3"),  # 34–35%: Soft indigo
-        (0.35, "#7b7dfa"),  # 36–37%: Light indigo
-        (0.37, "#8375ff"),  # 38–39%: Muted violet
-        (0.39, "#8b6aff"),  # 40–41%: Rich violet
-        (0.41, "#9460ff"),  # 42–43%: Deep violet
-        (0.43, "#9b55ff"),  # 44–45%: Soft purple
-        (0.45, "#a44aff"),  # 46–47%: Rich purple
-        (0.47, "#ac3fff"),  # 48–49%: Matte purple
-        (0.49, "#b534ff"),  # 50–51%: Bold purple
-        (0.51, "#c229f8"),  # 52–53%: Deep pink-purple
-        (0.53, "#d71fe3"),  # 54–55%: Vibrant pink
-        (0.55, "#e015c9"),  # 56–57%: Muted magenta
-        (0.57, "#e60bb0"),  # 58–59%: Deep magenta
-        (0.59, "#ec0098"),  # 60–61%: Bright magenta
-        (0.61, "#f00081"),  # 62–63%: Matte fuchsia
-        (0.63, "#f40069"),  # 64–65%: Deep muted red
-        (0.65, "#f80052"),  # 66–67%: Rich red
-        (0.67, "#fc003b"),  # 68–69%: Vibrant red
-        (0.69, "#ff0024"),  # 70–71%: Bold red
-        (0.71, "#ff140d"),  # 72–73%: Bright crimson
-        (0.73, "#ff2900"),  # 74–75%: Deep crimson
-        (0.75, "#ff3f00"),  # 76–77%: Rich orange-red
-        (0.77, "#ff5500"),  # 78–79%: Deep orange
-        (0.79, "#ff6b00"),  # 80–81%: Vibrant orange
-        (0.81, "#ff8100"),  # 82–83%: Bright orange
-        (0.83, "#ff9700"),  # 84–85%: Soft orange
-        (0.85, "#ffad00"),  # 86–87%: Muted amber
-        (0.87, "#ffc300"),  # 88–89%: Rich gold
-        (0.89, "#ffdb00"),  # 90–91%: Vibrant yellow
-        (0.91, "#ffe000"),  # 92–93%: Bright yellow
-        (0.93, "#ffe600"),  # 94–95%: Soft yellow
-        (0.95, "#ffec00"),  # 96–97%: Pale yellow
-        (0.97, "#fff200"),  # 98–99%: Very light yellow
-        (1.00, "#fff700"),  # 100%: Brightest yellow
-    ]
 
+def load_insights(path: str) -> Tuple[List[str], Dict[int, List[str]]]:
+    # Field order and clusters from hierarchical-clustering.py --json_out.
+    with open(path, "r") as f:
+        insights = json.load(f)
+    clusters = {int(entry["id"]): entry["members"] for entry in insights.get("clusters", [])}
+    return insights["reordered_fields"], clusters
+
+
+def axis_positions(labels: List[str], order: Optional[List[str]]) -> Tuple[np.ndarray, List[str]]:
+    # Position of each graph label on the axes; fields missing from the order
+    # follow it in name order.
+    if order is None:
+        return np.arange(len(labels)), list(labels)
+    present = set(labels)
+    axis = [label for label in order if label in present]
+    listed = set(axis)
+    axis += sorted(label for label in labels if label not in listed)
+    index = {label: i for i, label in enumerate(axis)}
+    return np.array([index[label] for label in labels], dtype=np.int64), axis
+
+
+def reduce_cells(graph: kstruct_io.SparseAdjacency, position: np.ndarray, n_cells: int, reduce: str) -> np.ndarray:
+    # Adds (or takes the max of) the weights of every entry into the cell its
+    # row and column positions fall in; positions < 0 are left out. Works on
+    # the nonzero entries, so the full matrix is never built.
+    cells = np.zeros((n_cells, n_cells))
+    rows, cols = position[graph.rows], position[graph.cols]
+    keep = (rows >= 0) & (cols >= 0)
+    target = (rows[keep], cols[keep])
+    if reduce == "max":
+        np.maximum.at(cells, target, graph.weights[keep])
+    else:
+        np.add.at(cells, target, graph.weights[keep])
+    return cells
+
+
+def block_labels(axis: List[str], block: int) -> List[str]:
+    if block == 1:
+        return list(axis)
+    return [f"{axis[start]} .. {axis[min(start + block, len(axis)) - 1]} ({min(block, len(axis) - start)})"
+            for start in range(0, len(axis), block)]
+
+
+def build_view(graph: kstruct_io.SparseAdjacency, order: Optional[List[str]], clusters: Dict[int, List[str]],
+               aggregate_clusters: bool, zoom_cluster: Optional[int], max_cells: int) -> Tuple[pd.DataFrame, str]:
+    max_value = max(float(graph.weights.max()), 0.0) if graph.nnz else 0.0
+    if aggregate_clusters:
+        # Sum of the weights between (and within) clusters, relative to the
+        # largest cluster pair.
+        cluster_of = {field: i for i, members in enumerate(clusters.values()) for field in members}
+        names = [f"cluster {cid} ({len(members)})" for cid, members in clusters.items()]
+        if any(label not in cluster_of for label in graph.labels):
+            names.append("unclustered")
+        position = np.array([cluster_of.get(label, len(clusters)) for label in graph.labels], dtype=np.int64)
+        cells = reduce_cells(graph, position, len(names), "sum")
+        top = float(cells.max()) if cells.size else 0.0
+        return pd.DataFrame(cells / (top or 1.0) * 100, index=names, columns=names), "cluster pairs"
+
+    position, axis = axis_positions(graph.labels, order)
+    detail = ""
+    if zoom_cluster is not None:
+        members = set(clusters[zoom_cluster])
+        axis = [label for label in axis if label in members]
+        index = {label: i for i, label in enumerate(axis)}
+        position = np.array([index.get(label, -1) for label in graph.labels], dtype=np.int64)
+        detail = f", cluster {zoom_cluster}"
+    # Above max_cells fields per axis, consecutive fields are pooled into
+    # blocks keeping their strongest pair, so hot spots stay visible.
+    block = max(1, -(-len(axis) // max_cells))
+    cells = reduce_cells(graph, np.where(position >= 0, position // block, -1), -(-len(axis) // block), "max")
+    names = block_labels(axis, block)
+    if block > 1:
+        detail += f", {block}x{block} field blocks (max)"
+    return pd.DataFrame(cells / (max_value or 1.0) * 100, index=names, columns=names), f"fields{detail}"
+
+
+def build_figure(df_percentage: pd.DataFrame, title: str, text_max_fields: int):
     fig = px.imshow(
         df_percentage,
-        text_auto=True,
+        text_auto=len(df_percentage) <= text_max_fields,
         aspect="auto",
-        color_continuous_scale=color_scale,
+        color_continuous_scale=COLOR_SCALE,
         labels={"color": "Percentage"},
-        title="Heatmap Based on Percentage Relative to Max Value..",
+        title=title,
         zmin=0,
         zmax=100,
     )
@@ -91,10 +164,122 @@ def main():
         title_x=0.5,
         coloraxis_colorbar=dict(title="Percentage", ticks="outside"),
     )
+    return fig
+
+
+def color_map(percentage: np.ndarray) -> np.ndarray:
+    # RGB uint8 image of the percentages under COLOR_SCALE.
+    stops = np.array([stop for stop, _ in COLOR_SCALE])
+    colors = np.array([[int(color[i:i + 2], 16) for i in (1, 3, 5)] for _, color in COLOR_SCALE], dtype=np.float64)
+    fraction = np.clip(percentage / 100.0, 0.0, 1.0)
+    channels = [np.interp(fraction, stops, colors[:, i]) for i in range(3)]
+    return np.rint(np.stack(channels, axis=-1)).astype(np.uint8)
+
+
+def encode_png(rgb: np.ndarray) -> bytes:
+    # Truecolor PNG, every row with filter type 0.
+    height, width, _ = rgb.shape
+    raw = np.concatenate([np.zeros((height, 1), dtype=np.uint8), rgb.reshape(height, width * 3)], axis=1)
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(raw.tobytes(), 6)) + chunk(b"IEND", b""))
+
+
+def write_static(df: pd.DataFrame, path: str, title: str, text_max_fields: int, image_size: int) -> None:
+    # PNG: one square of pixels per cell. SVG: the same image embedded, with
+    # field names on the axes when there are few enough to read.
+    n = len(df)
+    cell = max(1, image_size // max(n, 1))
+    image = np.repeat(np.repeat(color_map(df.to_numpy()), cell, axis=0), cell, axis=1)
+    png = encode_png(image)
+    if not path.endswith(".svg"):
+        with open(path, "wb") as f:
+            f.write(png)
+        return
+
+    labelled = n <= text_max_fields
+    margin = 8 * max((len(label) for label in df.index), default=0) + 10 if labelled else 10
+    side = n * cell
+    out = [f'<svg xmlns="http://www.w3.org/2000/svg" width="{margin + side + 10}" height="{margin + side + 40}">',
+           f'<text x="{margin + side / 2}" y="20" text-anchor="middle" font-family="sans-serif" '
+           f'font-size="14">{escape(title)}</text>',
+           f'<image x="{margin}" y="30" width="{side}" height="{side}" style="image-rendering:pixelated" '
+           f'href="data:image/png;base64,{base64.b64encode(png).decode()}"/>']
+    if labelled:
+        for i, label in enumerate(df.index):
+            y = 30 + (i + 0.5) * cell
+            x = margin + (i + 0.5) * cell
+            out.append(f'<text x="{margin - 4}" y="{y}" text-anchor="end" dominant-baseline="middle" '
+                       f'font-family="monospace" font-size="{min(12, cell)}">{escape(label)}</text>')
+            out.append(f'<text transform="translate({x},{30 + side + 4}) rotate(90)" dominant-baseline="middle" '
+                       f'font-family="monospace" font-size="{min(12, cell)}">{escape(label)}</text>')
+    out.append("</svg>")
+    with open(path, "w") as f:
+        f.write("\n".join(out) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a heatmap based on percentages relative to the highest value.")
+    parser.add_argument("input_file", help="Path to the adjacency matrix: dense CSV, a,b,weight edge CSV, or .kcol store.")
+    parser.add_argument("output_file", help="Path to save the output HTML file.")
+    parser.add_argument("--order", type=str, default=None,
+                        help="insights JSON from hierarchical-clustering.py --json_out; orders the axes by its "
+                             "reordered fields so clusters show up as blocks.")
+    parser.add_argument("--aggregate_clusters", action="store_true",
+                        help="With --order, plot one cell per pair of clusters (sum of their weights).")
+    parser.add_argument("--zoom_cluster", type=int, default=None,
+                        help="With --order, plot only the fields of this cluster id at full detail.")
+    parser.add_argument("--max_cells", type=int, default=500,
+                        help="Most cells per axis; larger matrices are pooled into blocks of adjacent fields.")
+    parser.add_argument("--text_max_fields", type=int, default=60,
+                        help="Write the value into every cell only up to this many cells per axis.")
+    parser.add_argument("--static_out", type=str, default=None,
+                        help="Also write a static image for reports: .png, or .svg with the image embedded.")
+    parser.add_argument("--image_size", type=int, default=1024, help="Approximate side of the static image in pixels.")
+    kstruct_metrics.add_arguments(parser)
+    args = parser.parse_args()
+    metrics = kstruct_metrics.StageMetrics.from_args("gen-heatmap", args)
+
+    csv_file = args.input_file
+    output_file = args.output_file
+    if (args.aggregate_clusters or args.zoom_cluster is not None) and not args.order:
+        parser.error("--aggregate_clusters and --zoom_cluster need the clusters from --order")
+
+    try:
+        with metrics.phase("read"):
+            graph = kstruct_io.read_sparse_adjacency(csv_file)
+    except FileNotFoundError:
+        print(f"Error: The file '{csv_file}' was not found.")
+        return 1
+
+    order, clusters = load_insights(args.order) if args.order else (None, {})
+    if args.zoom_cluster is not None and args.zoom_cluster not in clusters:
+        print(f"Error: cluster {args.zoom_cluster} is not in '{args.order}'.")
+        return 1
+
+    # Only the rendered cells are materialised; the graph itself stays as
+    # nonzero entries whatever format it was stored in.
+    with metrics.phase("matrix_build"):
+        df_percentage, view = build_view(graph, order, clusters, args.aggregate_clusters, args.zoom_cluster,
+                                         args.max_cells)
+    metrics.count(fields=graph.n, edges=graph.nnz // 2, cells=df_percentage.size)
+    title = TITLE.format(view=view)
+
+    with metrics.phase("render"):
+        fig = build_figure(df_percentage, title, args.text_max_fields)
 
-    fig.write_html(output_file)
+    with metrics.phase("write"):
+        fig.write_html(output_file)
 
     print(f"Heatmap saved as {output_file}")
+    if args.static_out:
+        with metrics.phase("write_static"):
+            write_static(df_percentage, args.static_out, title, args.text_max_fields, args.image_size)
+        print(f"Static heatmap saved as {args.static_out}")
+    metrics.write()
     return 0
 
 if __name__ == "__main__":
@@ -0,0 +1,172 @@
+import argparse
+import gzip
+import json
+
+import numpy as np
+
+BLOCK_EVENTS = 1 << 20
+MEMBER_TYPES = {4: "unsigned int", 8: "u64", 16: "struct list_head"}
+
+
+def plant_clusters(n_fields, n_clusters, n_functions, rng):
+    # Fields are dealt to clusters at random, so neither names nor the
+    # declaration order give the clusters away.
+    names = [f"field_{i:04d}" for i in range(n_fields)]
+    assignment = rng.permutation(n_fields) % n_clusters
+    clusters = []
+    for c in range(n_clusters):
+        clusters.append({
+            "id": c,
+            "members": [names[i] for i in np.flatnonzero(assignment == c)],
+            "functions": [f"kst_cluster{c}_fn{j}" for j in range(n_functions)],
+        })
+    return names, clusters
+
+
+def write_pahole_stub(path, struct_name, names, rng, line_size=64):
+    # A pahole-style dump of the struct in declaration order, with natural
+    # alignment, holes and cacheline markers where pahole would print them.
+    sizes = rng.choice([4, 8, 8, 16], size=len(names))
+    out = [f"struct {struct_name} {{"]
+    offset, holes, hole_bytes, align = 0, 0, 0, 1
+    for name, size in zip(names, sizes.tolist()):
+        natural = min(size, 8)
+        align = max(align, natural)
+        start = (offset + natural - 1) // natural * natural
+        if start > offset:
+            out += ["", f"\t/* XXX {start - offset} bytes hole, try to pack */", ""]
+            holes, hole_bytes = holes + 1, hole_bytes + start - offset
+        if offset and start // line_size > (offset - 1) // line_size:
+            out.append(f"\t/* --- cacheline {start // line_size} boundary ({start // line_size * line_size} bytes) --- */")
+        decl = f"{MEMBER_TYPES[size]:<26} {name};"
+        out.append(f"\t{decl:<48} /* {start:5d} {size:5d} */")
+        offset = start + size
+    size = (offset + align - 1) // align * align
+    out += ["", f"\t/* size: {size}, cachelines: {(size + line_size - 1) // line_size}, members: {len(names)} */",
+            f"\t/* sum members: {int(sizes.sum())}, holes: {holes}, sum holes: {hole_bytes} */"]
+    if size > offset:
+        out.append(f"\t/* padding: {size - offset} */")
+    out.append("};")
+    with open(path, "w") as f:
+        f.write("\n".join(out) + "\n")
+
+
+class TraceModel:
+    # Accesses come in bursts: one process on one CPU works on one planted
+    # cluster, touching its fields with probability in_cluster and any field
+    # otherwise. Bursts are burst_gap apart on average, accesses within a
+    # burst event_interval apart, so the window and stack methods both see
+    # the clusters.
+    def __init__(self, args, names, clusters, rng):
+        self.args = args
+        self.rng = rng
+        self.n_fields = len(names)
+        self.sizes = np.array([len(c["members"]) for c in clusters])
+        index = {name: i for i, name in enumerate(names)}
+        self.members = np.zeros((len(clusters), max(self.sizes.max(), 1)), dtype=np.int64)
+        for c, cluster in enumerate(clusters):
+            self.members[c, :len(cluster["members"])] = [index[m] for m in cluster["members"]]
+        # Zipf-like popularity: a few clusters are hot.
+        popularity = 1.0 / np.arange(1, len(clusters) + 1)
+        self.popularity = popularity / popularity.sum()
+        self.time = args.start_time
+        self.fields = names
+        self.functions = [f for c in clusters for f in c["functions"]] + [f"kst_misc_fn{j}" for j in range(args.functions)]
+        self.processes = [(f"stress-{p % 4}", 1000 + p) for p in range(args.processes)]
+
+    def block(self, n_events):
+        args, rng = self.args, self.rng
+        lengths = rng.geometric(1.0 / args.burst_length, size=n_events // max(int(args.burst_length), 1) + 16)
+        while lengths.sum() < n_events:
+            lengths = np.concatenate([lengths, rng.geometric(1.0 / args.burst_length, size=len(lengths))])
+        ends = np.cumsum(lengths)
+        n_bursts = int(np.searchsorted(ends, n_events)) + 1
+        lengths = lengths[:n_bursts]
+        lengths[-1] -= int(ends[n_bursts - 1]) - n_events
+
+        burst_cluster = rng.choice(len(self.sizes), size=n_bursts, p=self.popularity)
+        burst_process = rng.integers(0, args.processes, size=n_bursts)
+        burst_cpu = rng.integers(0, args.cpus, size=n_bursts)
+        cluster = np.repeat(burst_cluster, lengths)
+        process = np.repeat(burst_process, lengths)
+        cpu = np.repeat(burst_cpu, lengths)
+
+        planted = rng.random(n_events) < args.in_cluster
+        slot = (rng.random(n_events) * self.sizes[cluster]).astype(np.int64)
+        field = np.where(planted, self.members[cluster, slot], rng.integers(0, self.n_fields, size=n_events))
+        n_functions = args.functions
+        function = np.where(planted, cluster * n_functions, len(self.sizes) * n_functions) + \
+            rng.integers(0, n_functions, size=n_events)
+        modify = rng.random(n_events) < args.modify_fraction
+        cross = rng.random(n_events) < args.cross_cpu_fraction
+        runqueue = np.where(cross, (cpu + rng.integers(1, max(args.cpus, 2), size=n_events)) % args.cpus, cpu)
+
+        gaps = rng.exponential(args.event_interval, size=n_events)
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        gaps[starts] += rng.exponential(args.burst_gap, size=n_bursts)
+        timestamps = self.time + np.cumsum(gaps)
+        self.time = float(timestamps[-1])
+        return timestamps, process, cpu, runqueue, field, function, modify
+
+    def lines(self, n_events):
+        timestamps, process, cpu, runqueue, field, function, modify = self.block(n_events)
+        procs = [f"{comm:>16} {pid:>5}" for comm, pid in self.processes]
+        struct = self.args.struct
+        kinds = ("access", "modify")
+        for t, p, c, r, f, fn, m in zip(timestamps.tolist(), process.tolist(), cpu.tolist(), runqueue.tolist(),
+                                        field.tolist(), function.tolist(), modify.tolist()):
+            yield (f"{procs[p]} [{c:03d}] {t:12.6f}: sched:core_rq_access: Accessed {struct}[{r}]->"
+                   f"{self.fields[f]} in {self.functions[fn]} ({kinds[m]})\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Write a synthetic perf script trace with planted field clusters and a matching pahole stub."
+    )
+    parser.add_argument("log_file", help="Trace to write (perf script format; gzip-compressed if it ends in .gz).")
+    parser.add_argument("pahole_file", help="pahole-style layout of the struct to write.")
+    parser.add_argument("--ground_truth", type=str, default=None,
+                        help="Optional JSON with the planted clusters, their functions and the generator settings.")
+    parser.add_argument("--events", type=int, default=1000000, help="Number of accesses to write.")
+    parser.add_argument("--fields", type=int, default=64, help="Number of struct members.")
+    parser.add_argument("--clusters", type=int, default=8, help="Number of planted co-access clusters.")
+    parser.add_argument("--functions", type=int, default=3, help="Functions per cluster (and for unplanted accesses).")
+    parser.add_argument("--cpus", type=int, default=8, help="Number of CPUs (and runqueues).")
+    parser.add_argument("--processes", type=int, default=16, help="Number of processes.")
+    parser.add_argument("--in_cluster", type=float, default=0.9,
+                        help="Probability that an access in a burst goes to the burst's cluster.")
+    parser.add_argument("--burst_length", type=float, default=8.0, help="Mean accesses per burst.")
+    parser.add_argument("--event_interval", type=float, default=5e-7, help="Mean seconds between accesses in a burst.")
+    parser.add_argument("--burst_gap", type=float, default=2e-5, help="Mean extra seconds between bursts.")
+    parser.add_argument("--modify_fraction", type=float, default=0.3, help="Fraction of accesses that modify.")
+    parser.add_argument("--cross_cpu_fraction", type=float, default=0.05,
+                        help="Fraction of accesses to another CPU's runqueue.")
+    parser.add_argument("--start_time", type=float, default=1.0, help="Timestamp of the first access.")
+    parser.add_argument("--struct", type=str, default="rq", help="Struct name in the trace and the pahole stub.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed.")
+
+    args = parser.parse_args()
+    if args.clusters < 1 or args.fields < args.clusters:
+        parser.error("need at least one cluster and at least as many fields as clusters")
+
+    rng = np.random.default_rng(args.seed)
+    names, clusters = plant_clusters(args.fields, args.clusters, args.functions, rng)
+    write_pahole_stub(args.pahole_file, args.struct, names, rng)
+
+    model = TraceModel(args, names, clusters, rng)
+    opener = gzip.open if args.log_file.endswith(".gz") else open
+    with opener(args.log_file, "wt") as f:
+        for start in range(0, args.events, BLOCK_EVENTS):
+            f.writelines(model.lines(min(BLOCK_EVENTS, args.events - start)))
+
+    if args.ground_truth:
+        with open(args.ground_truth, "w") as jf:
+            json.dump({"struct": args.struct, "clusters": clusters, "settings": vars(args)}, jf, indent=2)
+
+    print(f"Trace with {args.events} accesses written to {args.log_file}, pahole stub to {args.pahole_file}")
+    if args.ground_truth:
+        print(f"Planted clusters written to {args.ground_truth}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,71 +1,366 @@
-import pandas as pd
 import argparse
 import json
 import numpy as np
 from typing import Dict, List, Tuple, Any
 
+import kstruct_io
+import kstruct_metrics
+
+
+def cluster_graph(graph: kstruct_io.SparseAdjacency) -> Tuple[List[str], Dict[int, List[str]]]:
+    headers = graph.labels
+    n = graph.n
+    upper = (graph.rows < graph.cols) & (graph.weights > 0)
+    rows, cols, weights = graph.rows[upper], graph.cols[upper], graph.weights[upper]
+    order = np.lexsort((cols, rows, -weights))
+
+    # Union-find over field indices. Each root remembers the id its cluster is
+    # reported under and its members as a linked list in merge order, so a
+    # merge splices two lists in O(1).
+    parent = list(range(n))
+    size = [1] * n
+    cluster_id = list(range(n))
+    head = list(range(n))
+    tail = list(range(n))
+    next_member = [-1] * n
+
+    def find(x: int) -> int:
+        root = x
+        while parent[root] != root:
+            root = parent[root]
+        while parent[x] != root:
+            parent[x], x = root, parent[x]
+        return root
+
+    merges = 0
+    for i, j in zip(rows[order].tolist(), cols[order].tolist()):
+        if merges == n - 1:
+            break
+        root_i, root_j = find(i), find(j)
+        if root_i == root_j:
+            continue
+        # The cluster holding i keeps its id and its members come first.
+        next_member[tail[root_i]] = head[root_j]
+        first, last, cid = head[root_i], tail[root_j], cluster_id[root_i]
+        if size[root_i] < size[root_j]:
+            root_i, root_j = root_j, root_i
+        parent[root_j] = root_i
+        size[root_i] += size[root_j]
+        head[root_i], tail[root_i], cluster_id[root_i] = first, last, cid
+        merges += 1
+
+    member_indices: Dict[int, List[int]] = {}
+    for root in sorted((r for r in range(n) if parent[r] == r), key=lambda r: cluster_id[r]):
+        members = []
+        idx = head[root]
+        while idx != -1:
+            members.append(idx)
+            idx = next_member[idx]
+        member_indices[cluster_id[root]] = members
+
+    clusters = {cid: [headers[idx] for idx in members] for cid, members in member_indices.items()}
+    reordered_fields = [headers[idx] for members in member_indices.values() for idx in sorted(members)]
+    return reordered_fields, clusters
+
+
+def cluster_fields(headers: List[str], matrix) -> Tuple[List[str], Dict[int, List[str]]]:
+    rows, cols = np.nonzero(np.triu(matrix > 0, k=1))
+    return cluster_graph(kstruct_io.SparseAdjacency(headers, rows, cols, matrix[rows, cols]))
+
 
 def hierarchical_clustering(headers: List[str], matrix) -> List[str]:
-    n = len(headers)
-    clusters = {i: [headers[i]] for i in range(n)}
-    edges = [(matrix[i, j], i, j) for i in range(n) for j in range(i + 1, n) if matrix[i, j] > 0]
-    edges.sort(reverse=True, key=lambda x: x[0])
-
-    for weight, i, j in edges:
-        cluster_i = cluster_j = None
-        for cluster_id, members in clusters.items():
-            if headers[i] in members:
-                cluster_i = cluster_id
-            if headers[j] in members:
-                cluster_j = cluster_id
-            if cluster_i is not None and cluster_j is not None:
+    return cluster_fields(headers, matrix)[0]
+
+
+def select_top(values: np.ndarray, k: int) -> np.ndarray:
+    # Positions of the k largest values, largest first; equal values keep
+    # their position order, like a stable descending sort.
+    size = len(values)
+    if k <= 0 or size == 0:
+        return np.zeros(0, dtype=np.int64)
+    if k < size:
+        kth = values[np.argpartition(values, size - k)[size - k]]
+        above = np.flatnonzero(values > kth)
+        ties = np.flatnonzero(values == kth)[: k - len(above)]
+        candidates = np.concatenate([above, ties])
+    else:
+        candidates = np.arange(size)
+    return candidates[np.lexsort((candidates, -values[candidates]))]
+
+
+def compute_top_pairs(graph: kstruct_io.SparseAdjacency, top_n: int) -> List[Tuple[str, str, float]]:
+    cols = graph.labels
+    upper = (graph.rows < graph.cols) & (graph.weights > 0)
+    rows, others, weights = graph.rows[upper], graph.cols[upper], graph.weights[upper]
+    order = np.lexsort((others, rows))
+    rows, others, weights = rows[order], others[order], weights[order]
+    top = select_top(weights, top_n)
+    return [(cols[rows[t]], cols[others[t]], float(weights[t])) for t in top]
+
+
+def compute_field_strengths(graph: kstruct_io.SparseAdjacency) -> List[Tuple[str, float]]:
+    strengths = (np.bincount(graph.rows, weights=graph.weights, minlength=graph.n)
+                 + np.bincount(graph.cols, weights=graph.weights, minlength=graph.n)) / 2.0
+    order = np.argsort(-strengths, kind="stable")
+    cols = graph.labels
+    return [(cols[i], float(strengths[i])) for i in order]
+
+
+def compute_per_field_top_partners(graph: kstruct_io.SparseAdjacency, top_k: int) -> Dict[str, List[Tuple[str, float]]]:
+    cols = graph.labels
+    partners: Dict[str, List[Tuple[str, float]]] = {field: [] for field in cols}
+    if top_k <= 0:
+        return partners
+
+    keep = (graph.rows != graph.cols) & (graph.weights > 0)
+    rows, others, weights = graph.rows[keep], graph.cols[keep], graph.weights[keep]
+    order = np.lexsort((others, -weights, rows))
+    rows, others, weights = rows[order], others[order], weights[order]
+    rank = np.arange(len(rows)) - np.searchsorted(rows, rows, side="left")
+    keep = rank < top_k
+    for i, j, w in zip(rows[keep].tolist(), others[keep].tolist(), weights[keep].tolist()):
+        partners[cols[i]].append((cols[j], w))
+    return partners
+
+
+def cluster_labels(graph: kstruct_io.SparseAdjacency, clusters: Dict[int, List[str]]) -> Tuple[np.ndarray, np.ndarray]:
+    # Position of each field's cluster in `clusters`, and each field's
+    # position when clusters are laid out one after another in member order.
+    index = {field: idx for idx, field in enumerate(graph.labels)}
+    label = np.zeros(graph.n, dtype=np.int64)
+    position = np.zeros(graph.n, dtype=np.int64)
+    offset = 0
+    for cluster_pos, members in enumerate(clusters.values()):
+        member_idx = [index[field] for field in members]
+        label[member_idx] = cluster_pos
+        position[member_idx] = np.arange(offset, offset + len(members))
+        offset += len(members)
+    return label, position
+
+
+def compute_intercluster_links(graph: kstruct_io.SparseAdjacency, clusters: Dict[int, List[str]], top_n: int) -> List[Tuple[str, str, float]]:
+    ids = list(clusters)
+    n_clusters = len(ids)
+    if n_clusters < 2 or top_n <= 0:
+        return []
+    label, _ = cluster_labels(graph, clusters)
+    label_a, label_b = label[graph.rows], label[graph.cols]
+    between = label_a < label_b
+    keys = label_a[between] * n_clusters + label_b[between]
+    weights = graph.weights[between]
+
+    # Block maxima over the cluster-label vector, one per linked cluster pair.
+    order = np.argsort(keys, kind="stable")
+    keys, weights = keys[order], weights[order]
+    starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1]))) if len(keys) else np.zeros(0, dtype=np.int64)
+    pair_keys = keys[starts]
+    pair_max = np.maximum.reduceat(weights, starts) if len(keys) else weights
+    pair_max = np.maximum(pair_max, 0.0)
+
+    results = [(int(pair_keys[t]), float(pair_max[t])) for t in select_top(pair_max, top_n)]
+    if len(results) < top_n:
+        # Cluster pairs with no edge between them tie at 0.0 after every
+        # linked pair, in cluster order.
+        linked = set(pair_keys.tolist())
+        for a in range(n_clusters):
+            for b in range(a + 1, n_clusters):
+                if len(results) >= top_n:
+                    break
+                key = a * n_clusters + b
+                if key not in linked:
+                    results.append((key, 0.0))
+            if len(results) >= top_n:
                 break
+    return [(f"Cluster {ids[key // n_clusters]}", f"Cluster {ids[key % n_clusters]}", w) for key, w in results]
+
 
-        if cluster_i != cluster_j:
-            clusters[cluster_i].extend(clusters[cluster_j])
-            del clusters[cluster_j]
-    
-    reordered_indices = [idx for cluster in clusters.values() for idx in range(n) if headers[idx] in cluster]
-    return [headers[i] for i in reordered_indices]
-
-
-def compute_top_pairs(df: pd.DataFrame, top_n: int) -> List[Tuple[str, str, float]]:
-    pairs = []
-    cols = df.columns.tolist()
-    values = df.to_numpy()
-    n = len(cols)
-    for i in range(n):
-        for j in range(i + 1, n):
-            w = float(values[i, j])
-            if w > 0:
-                pairs.append((cols[i], cols[j], w))
-    pairs.sort(key=lambda x: x[2], reverse=True)
-    return pairs[:top_n]
-
-
-def compute_field_strengths(df: pd.DataFrame) -> List[Tuple[str, float]]:
-    strengths = (df.sum(axis=1) + df.sum(axis=0)) / 2.0
-    return sorted([(field, float(strengths[field])) for field in df.columns], key=lambda x: x[1], reverse=True)
-
-
-def compute_intercluster_links(df: pd.DataFrame, clusters: Dict[int, List[str]], top_n: int) -> List[Tuple[str, str, float]]:
-    results: List[Tuple[str, str, float]] = []
-    for cid_a, members_a in clusters.items():
-        for cid_b, members_b in clusters.items():
-            if cid_a >= cid_b:
-                continue
-            sub = df.loc[members_a, members_b]
-            max_val = float(sub.to_numpy().max()) if not sub.empty else 0.0
-            results.append((f"Cluster {cid_a}", f"Cluster {cid_b}", max_val))
-    results.sort(key=lambda x: x[2], reverse=True)
-    return results[:top_n]
+def compute_cluster_cohesion(graph: kstruct_io.SparseAdjacency, clusters: Dict[int, List[str]]) -> List[Dict[str, Any]]:
+    ids = list(clusters)
+    if not ids:
+        return []
+    label, position = cluster_labels(graph, clusters)
+    inside = (label[graph.rows] == label[graph.cols]) & (position[graph.rows] < position[graph.cols])
+    intra = np.bincount(label[graph.rows][inside], weights=graph.weights[inside], minlength=len(ids))
+    cohesion: List[Dict[str, Any]] = []
+    for cid, intra_sum in zip(ids, intra.tolist()):
+        n_members = len(clusters[cid])
+        if n_members > 1:
+            denom = n_members * (n_members - 1) / 2.0
+            density = intra_sum / denom if denom else 0.0
+        else:
+            intra_sum = 0.0
+            density = 0.0
+        cohesion.append({
+            "cluster_id": int(cid),
+            "size": n_members,
+            "intra_sum": float(intra_sum),
+            "density": density,
+        })
+    return cohesion
+
+
+def compute_graph_stats(graph: kstruct_io.SparseAdjacency) -> Dict[str, Any]:
+    num_fields = int(graph.n)
+    num_edges = int((graph.weights > 0).sum() // 2)
+    total_weight = float(graph.weights.sum() / 2.0)
+    max_edges = num_fields * (num_fields - 1) / 2.0
+    sparsity = 1.0 - (num_edges / max_edges if max_edges else 0.0)
+    return {
+        "num_fields": num_fields,
+        "num_edges_nonzero": num_edges,
+        "total_weight": total_weight,
+        "sparsity": sparsity,
+    }
+
+
+def dominant_functions(weights: Dict[str, float], top_k: int) -> List[Tuple[str, float, float]]:
+    # (function, weight, share of the total) for the top_k functions, then
+    # everything else as one "[other]" entry.
+    total = sum(weights.values())
+    if not total:
+        return []
+    named = sorted(((w, f) for f, w in weights.items() if f != kstruct_io.ATTRIBUTION_OTHER),
+                   key=lambda item: (-item[0], item[1]))
+    paths = [(f, w, w / total) for w, f in named[:top_k]]
+    rest = total - sum(w for _, w, _ in paths)
+    if rest > 0:
+        paths.append((kstruct_io.ATTRIBUTION_OTHER, rest, rest / total))
+    return paths
+
+
+def compute_pair_code_paths(top_pairs: List[Tuple[str, str, float]],
+                            attribution: Dict[Tuple[str, str], List[Tuple[str, float]]],
+                            top_k: int) -> List[List[Tuple[str, float, float]]]:
+    paths = []
+    for a, b, _ in top_pairs:
+        functions = attribution.get((a, b) if a < b else (b, a), [])
+        paths.append(dominant_functions(dict(functions), top_k))
+    return paths
+
+
+def compute_cluster_code_paths(clusters: Dict[int, List[str]],
+                               attribution: Dict[Tuple[str, str], List[Tuple[str, float]]],
+                               top_k: int) -> Dict[int, List[Tuple[str, float, float]]]:
+    # Functions behind the co-accesses within each cluster.
+    cluster_of = {field: cid for cid, members in clusters.items() for field in members}
+    weights: Dict[int, Dict[str, float]] = {cid: {} for cid in clusters}
+    for (a, b), functions in attribution.items():
+        cid = cluster_of.get(a)
+        if cid is None or cluster_of.get(b) != cid:
+            continue
+        for function, w in functions:
+            weights[cid][function] = weights[cid].get(function, 0.0) + w
+    return {cid: dominant_functions(weights[cid], top_k) for cid in clusters}
+
+
+def compute_insights(graph: kstruct_io.SparseAdjacency, top_n: int, per_field_top_k: int,
+                     attribution: Dict[Tuple[str, str], List[Tuple[str, float]]] = None,
+                     code_paths_top_k: int = 3) -> Dict[str, Any]:
+    reordered_fields, clusters = cluster_graph(graph)
+    insights = {
+        "reordered_fields": reordered_fields,
+        "clusters": clusters,
+        "top_pairs": compute_top_pairs(graph, top_n),
+        "field_strength": compute_field_strengths(graph),
+        "intercluster_links": compute_intercluster_links(graph, clusters, top_n),
+        "cluster_cohesion": compute_cluster_cohesion(graph, clusters),
+        "per_field_top_partners": compute_per_field_top_partners(graph, per_field_top_k),
+        "graph_stats": compute_graph_stats(graph),
+    }
+    if attribution is not None:
+        insights["pair_code_paths"] = compute_pair_code_paths(insights["top_pairs"], attribution, code_paths_top_k)
+        insights["cluster_code_paths"] = compute_cluster_code_paths(clusters, attribution, code_paths_top_k)
+    return insights
+
+
+def format_code_paths(paths: List[Tuple[str, float, float]]) -> str:
+    return ", ".join(f"{function} ({share:.1%})" for function, _, share in paths) if paths else "None"
+
+
+def write_text_insights(insights: Dict[str, Any], output_file: str) -> None:
+    with open(output_file, "w") as f:
+        f.write("Reordered Fields (suggested layout)\n")
+        f.write(", ".join(insights["reordered_fields"]) + "\n\n")
+
+        f.write("Clusters (order reflects merge sequence; for reference)\n")
+        for cid, members in insights["clusters"].items():
+            f.write(f"Cluster {cid}: " + ", ".join(members) + "\n")
+
+        f.write("\nTop Field Pairs (by co-access weight)\n")
+        for a, b, w in insights["top_pairs"]:
+            f.write(f"{a} <> {b}: {w}\n")
+
+        f.write("\nField Interaction Strength (descending)\n")
+        for field, score in insights["field_strength"]:
+            f.write(f"{field}: {score}\n")
+
+        f.write("\nStrongest Inter-Cluster Links (max edge between clusters)\n")
+        for ca, cb, w in insights["intercluster_links"]:
+            f.write(f"{ca} <> {cb}: {w}\n")
+
+        f.write("\nCluster Cohesion Metrics\n")
+        for entry in insights["cluster_cohesion"]:
+            f.write(f"Cluster {entry['cluster_id']}: size={entry['size']}, "
+                    f"intra_sum={entry['intra_sum']}, density={entry['density']}\n")
+
+        f.write("\nPer-Field Top Partners\n")
+        for field, topk in insights["per_field_top_partners"].items():
+            if topk:
+                parts = ", ".join([f"{p} ({w})" for p, w in topk])
+            else:
+                parts = "None"
+            f.write(f"{field}: {parts}\n")
+
+        if "pair_code_paths" in insights:
+            f.write("\nTop Pair Code Paths (functions completing the co-accesses, share of weight)\n")
+            for (a, b, _), paths in zip(insights["top_pairs"], insights["pair_code_paths"]):
+                f.write(f"{a} <> {b}: {format_code_paths(paths)}\n")
+
+            f.write("\nCluster Code Paths (functions behind intra-cluster co-accesses)\n")
+            for cid, paths in insights["cluster_code_paths"].items():
+                f.write(f"Cluster {cid}: {format_code_paths(paths)}\n")
+
+
+def build_json_payload(insights: Dict[str, Any]) -> Dict[str, Any]:
+    json_payload: Dict[str, Any] = {}
+    json_payload["reordered_fields"] = insights["reordered_fields"]
+    json_payload["clusters"] = [
+        {
+            "id": int(cid),
+            "members": members,
+            "size": len(members),
+        }
+        for cid, members in insights["clusters"].items()
+    ]
+    json_payload["top_pairs"] = [
+        {"a": a, "b": b, "weight": w} for a, b, w in insights["top_pairs"]
+    ]
+    json_payload["field_strength"] = [
+        {"field": f, "strength": s} for f, s in insights["field_strength"]
+    ]
+    json_payload["intercluster_links"] = [
+        {"cluster_a": ca, "cluster_b": cb, "max_weight": w} for ca, cb, w in insights["intercluster_links"]
+    ]
+    json_payload["cluster_cohesion"] = insights["cluster_cohesion"]
+    json_payload["per_field_top_partners"] = {
+        field: [{"partner": p, "weight": w} for p, w in topk]
+        for field, topk in insights["per_field_top_partners"].items()
+    }
+    json_payload["graph_stats"] = insights["graph_stats"]
+    if "pair_code_paths" in insights:
+        for entry, paths in zip(json_payload["top_pairs"], insights["pair_code_paths"]):
+            entry["functions"] = [{"function": f, "weight": w, "share": share} for f, w, share in paths]
+        for entry in json_payload["clusters"]:
+            entry["functions"] = [{"function": f, "weight": w, "share": share}
+                                  for f, w, share in insights["cluster_code_paths"][entry["id"]]]
+    return json_payload
 
 
 def main():
     parser = argparse.ArgumentParser(
         description="Perform hierarchical clustering on an adjacency matrix CSV and write insights to a file."
     )
-    parser.add_argument("input_csv", help="Path to input adjacency matrix CSV (rows/cols are field names).")
+    parser.add_argument("input_csv", help="Path to input adjacency matrix: dense CSV (rows/cols are field names), a,b,weight edge CSV, or .kcol store.")
     parser.add_argument(
         "--output_file",
         "-o",
@@ -90,151 +385,52 @@ def main():
         default=3,
         help="Top-k partners to report per field in JSON/text.",
     )
+    parser.add_argument(
+        "--attribution",
+        type=str,
+        default=None,
+        help="Per-function edge attribution from proximity-graph.py --attribution_out; adds the dominant "
+             "code paths of the top pairs and of each cluster.",
+    )
+    parser.add_argument(
+        "--code_paths_top_k",
+        type=int,
+        default=3,
+        help="Functions to list per top pair and per cluster with --attribution.",
+    )
 
-    args = parser.parse_args()
-
-    df = pd.read_csv(args.input_csv, index_col=0)
-    headers = df.columns.tolist()
-    matrix = df.to_numpy()
-
-    reordered_fields = hierarchical_clustering(headers, matrix)
-
-    with open(args.output_file, "w") as f:
-        f.write("Reordered Fields (suggested layout)\n")
-        f.write(", ".join(reordered_fields) + "\n\n")
-
-        f.write("Clusters (order reflects merge sequence; for reference)\n")
-  
-        # Rerun minimal clustering to capture the final cluster grouping
-        n = len(headers)
-        clusters = {i: [headers[i]] for i in range(n)}
-        edges = [(matrix[i, j], i, j) for i in range(n) for j in range(i + 1, n) if matrix[i, j] > 0]
-        edges.sort(reverse=True, key=lambda x: x[0])
-        for _, i, j in edges:
-            ci = cj = None
-            for cid, members in clusters.items():
-                if headers[i] in members:
-                    ci = cid
-                if headers[j] in members:
-                    cj = cid
-                if ci is not None and cj is not None:
-                    break
-            if ci != cj:
-                clusters[ci].extend(clusters[cj])
-                del clusters[cj]
-
-        for cid, members in clusters.items():
-            f.write(f"Cluster {cid}: " + ", ".join(members) + "\n")
-
-        # Additional insights
-        f.write("\nTop Field Pairs (by co-access weight)\n")
-        top_pairs = compute_top_pairs(df, args.top_n)
-        for a, b, w in top_pairs:
-            f.write(f"{a} <> {b}: {w}\n")
-
-        f.write("\nField Interaction Strength (descending)\n")
-        strengths = compute_field_strengths(df)
-        for field, score in strengths:
-            f.write(f"{field}: {score}\n")
+    kstruct_metrics.add_arguments(parser)
 
-        f.write("\nStrongest Inter-Cluster Links (max edge between clusters)\n")
-        inter_links = compute_intercluster_links(df, clusters, args.top_n)
-        for ca, cb, w in inter_links:
-            f.write(f"{ca} <> {cb}: {w}\n")
+    args = parser.parse_args()
+    metrics = kstruct_metrics.StageMetrics.from_args("hierarchical-clustering", args)
 
-        f.write("\nCluster Cohesion Metrics\n")
-        for cid, members in clusters.items():
-            sub = df.loc[members, members].to_numpy()
-            n_members = len(members)
-            if n_members > 1:
-                intra_sum = float(sub[np.triu_indices(n_members, k=1)].sum())
-                denom = n_members * (n_members - 1) / 2.0
-                density = intra_sum / denom if denom else 0.0
-                f.write(f"Cluster {cid}: size={n_members}, intra_sum={intra_sum}, density={density}\n")
-            else:
-                f.write(f"Cluster {cid}: size=1, intra_sum=0.0, density=0.0\n")
+    # Dense CSVs and edge lists alike are handled as nonzero entries only.
+    with metrics.phase("read"):
+        graph = kstruct_io.read_sparse_adjacency(args.input_csv)
+        attribution = None
+        if args.attribution:
+            try:
+                attribution = kstruct_io.read_attribution(args.attribution)
+            except ValueError as e:
+                raise SystemExit(f"Error: {e}")
+    metrics.count(fields=graph.n, edges=graph.nnz // 2)
 
-        f.write("\nPer-Field Top Partners\n")
-        for field in df.columns:
-            row = df.loc[field]
-            partners = [(p, float(w)) for p, w in row.items() if p != field and w > 0]
-            partners.sort(key=lambda x: x[1], reverse=True)
-            topk = partners[: args.per_field_top_k]
-            if topk:
-                parts = ", ".join([f"{p} ({w})" for p, w in topk])
-            else:
-                parts = "None"
-            f.write(f"{field}: {parts}\n")
+    with metrics.phase("clustering"):
+        insights = compute_insights(graph, args.top_n, args.per_field_top_k, attribution, args.code_paths_top_k)
+    metrics.count(clusters=len(insights["clusters"]))
 
-    if args.json_out:
-        json_payload: Dict[str, Any] = {}
-        json_payload["reordered_fields"] = reordered_fields
-        json_payload["clusters"] = [
-            {
-                "id": int(cid),
-                "members": members,
-                "size": len(members),
-            }
-            for cid, members in clusters.items()
-        ]
-        json_payload["top_pairs"] = [
-            {"a": a, "b": b, "weight": w} for a, b, w in top_pairs
-        ]
-        json_payload["field_strength"] = [
-            {"field": f, "strength": s} for f, s in strengths
-        ]
-        json_payload["intercluster_links"] = [
-            {"cluster_a": ca, "cluster_b": cb, "max_weight": w} for ca, cb, w in inter_links
-        ]
-        cohesion: List[Dict[str, Any]] = []
-        for cid, members in clusters.items():
-            sub = df.loc[members, members].to_numpy()
-            n_members = len(members)
-            if n_members > 1:
-                intra_sum = float(sub[np.triu_indices(n_members, k=1)].sum())
-                denom = n_members * (n_members - 1) / 2.0
-                density = intra_sum / denom if denom else 0.0
-            else:
-                intra_sum = 0.0
-                density = 0.0
-            cohesion.append({
-                "cluster_id": int(cid),
-                "size": n_members,
-                "intra_sum": intra_sum,
-                "density": density,
-            })
-        json_payload["cluster_cohesion"] = cohesion
-
-        per_field_top: Dict[str, List[Dict[str, Any]]] = {}
-        for field in df.columns:
-            row = df.loc[field]
-            partners = [(p, float(w)) for p, w in row.items() if p != field and w > 0]
-            partners.sort(key=lambda x: x[1], reverse=True)
-            topk = partners[: args.per_field_top_k]
-            per_field_top[field] = [{"partner": p, "weight": w} for p, w in topk]
-        json_payload["per_field_top_partners"] = per_field_top
-
-        vals = df.to_numpy()
-        num_fields = int(vals.shape[0])
-        num_edges = int((vals > 0).sum() // 2)
-        total_weight = float(vals.sum() / 2.0)
-        max_edges = num_fields * (num_fields - 1) / 2.0
-        sparsity = 1.0 - (num_edges / max_edges if max_edges else 0.0)
-        json_payload["graph_stats"] = {
-            "num_fields": num_fields,
-            "num_edges_nonzero": num_edges,
-            "total_weight": total_weight,
-            "sparsity": sparsity,
-        }
+    with metrics.phase("write"):
+        write_text_insights(insights, args.output_file)
 
-        with open(args.json_out, "w") as jf:
-            json.dump(json_payload, jf, indent=2)
+        if args.json_out:
+            with open(args.json_out, "w") as jf:
+                json.dump(build_json_payload(insights), jf, indent=2)
 
     print(f"Insights written to {args.output_file}")
     if args.json_out:
         print(f"JSON insights written to {args.json_out}")
+    metrics.write()
 
 
 if __name__ == "__main__":
     main()
-
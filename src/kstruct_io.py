@@ -0,0 +1,436 @@
+import importlib.util
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+# Columnar intermediate format shared by all stages.
+#
+# A store is a directory whose name ends in ".kcol":
+#
+#   meta.json        {"format": "kstruct-columns", "version": 1, "kind": "table" | "matrix",
+#                     "num_rows": N, "columns": [...], "labels": [...], "matrix": {...}}
+#   cNNNN.bin        one raw little-endian array per column, readable with np.memmap
+#   matrix.bin       (kind "matrix") row-major n x n float64 adjacency weights
+#   rows.bin, cols.bin, weights.bin
+#                    (kind "edges") int64 label indices and float64 weights of a
+#                    symmetric sparse adjacency, one entry per edge with row < col
+#
+# Each entry of "columns" is {"name", "file", "dtype"} plus "categories" for
+# dictionary-encoded string columns, whose file holds int32 codes (-1 = missing).
+#
+# Sparse adjacency can also be written as a plain triplet CSV with the header
+# "a,b,weight" and one line per edge (a < b); its labels are the sorted field
+# names that appear in it.
+
+COLUMNAR_SUFFIX = '.kcol'
+FORMAT_NAME = 'kstruct-columns'
+FORMAT_VERSION = 1
+META_FILE = 'meta.json'
+MATRIX_FILE = 'matrix.bin'
+EDGE_FILES = ('rows.bin', 'cols.bin', 'weights.bin')
+EDGE_HEADER = ['a', 'b', 'weight']
+CODE_DTYPE = np.dtype('<i4')
+
+
+def is_columnar(path):
+    return str(path).rstrip('/').endswith(COLUMNAR_SUFFIX)
+
+
+def read_meta(path):
+    with open(os.path.join(path, META_FILE), 'r') as f:
+        meta = json.load(f)
+    if meta.get('format') != FORMAT_NAME:
+        raise ValueError(f"'{path}' is not a {FORMAT_NAME} store")
+    if meta.get('version', 0) > FORMAT_VERSION:
+        raise ValueError(f"'{path}' uses {FORMAT_NAME} version {meta['version']}; this tool reads up to {FORMAT_VERSION}")
+    return meta
+
+
+def write_meta(path, meta):
+    meta = dict(meta, format=FORMAT_NAME, version=FORMAT_VERSION)
+    with open(os.path.join(path, META_FILE), 'w') as f:
+        json.dump(meta, f)
+
+
+def map_array(path, file_name, dtype, shape):
+    if int(np.prod(shape)) == 0:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(os.path.join(path, file_name), dtype=dtype, mode='r', shape=tuple(shape))
+
+
+class ColumnarWriter:
+    # Appends batches of rows or columns to a table store; string columns are
+    # dictionary-encoded as they arrive.
+    def __init__(self, path, schema):
+        self.path = path
+        self.schema = list(schema)
+        self.num_rows = 0
+        self.categories = [{} if dtype == 'category' else None for _, dtype in self.schema]
+        os.makedirs(path, exist_ok=True)
+        self.files = [open(os.path.join(path, f"c{i:04d}.bin"), 'wb') for i in range(len(self.schema))]
+
+    def write_rows(self, rows):
+        if rows:
+            self.write_columns(list(zip(*rows)))
+
+    def write_columns(self, columns):
+        for i, values in enumerate(columns):
+            lookup = self.categories[i]
+            if lookup is None:
+                array = np.asarray(pd.to_numeric(pd.Series(values), errors='coerce'), dtype=self.schema[i][1])
+            else:
+                # Empty strings are missing values, as they are when read back from CSV.
+                values = pd.Series(values, dtype=object).replace('', None)
+                uniques = values.dropna().unique()
+                for value in uniques:
+                    lookup.setdefault(value, len(lookup))
+                array = values.map(lookup).fillna(-1).to_numpy(dtype=np.int64)
+            self.files[i].write(np.ascontiguousarray(array, dtype=self.column_dtype(i)).tobytes())
+        self.num_rows += len(columns[0]) if columns else 0
+
+    def column_dtype(self, i):
+        return CODE_DTYPE if self.categories[i] is not None else np.dtype(self.schema[i][1]).newbyteorder('<')
+
+    def close(self):
+        for f in self.files:
+            f.close()
+        columns = []
+        for i, (name, _) in enumerate(self.schema):
+            column = {'name': name, 'file': f"c{i:04d}.bin", 'dtype': self.column_dtype(i).str}
+            if self.categories[i] is not None:
+                column['categories'] = [str(value) for value in self.categories[i]]
+            columns.append(column)
+        write_meta(self.path, {'kind': 'table', 'num_rows': self.num_rows, 'columns': columns})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_columnar_columns(path, columns=None):
+    meta = read_meta(path)
+    if meta['kind'] != 'table':
+        raise ValueError(f"'{path}' holds a {meta['kind']}, not a table")
+    stored = {column['name']: column for column in meta['columns']}
+    names = columns if columns is not None else [column['name'] for column in meta['columns']]
+    data = {}
+    for name in names:
+        column = stored[name]
+        values = map_array(path, column['file'], np.dtype(column['dtype']), (meta['num_rows'],))
+        if 'categories' in column:
+            data[name] = pd.Categorical.from_codes(np.asarray(values), categories=column['categories'])
+        else:
+            data[name] = values
+    return data
+
+
+def read_columnar_table(path, columns=None):
+    data = read_columnar_columns(path, columns)
+    return pd.DataFrame(data, columns=list(data))
+
+
+def table_columns(path):
+    if is_columnar(path):
+        return [column['name'] for column in read_meta(path)['columns']]
+    return pd.read_csv(path, nrows=0).columns.tolist()
+
+
+def read_columns(path, columns, dtype=None):
+    # Only the requested columns are touched; columnar stores hand back
+    # memory-mapped arrays without building a DataFrame.
+    if not is_columnar(path):
+        df = pd.read_csv(path, usecols=columns, dtype=dtype)
+        return {name: df[name] for name in columns}
+    data = read_columnar_columns(path, columns)
+    for name, target in (dtype or {}).items():
+        if name in data and target != 'category':
+            data[name] = np.asarray(data[name], dtype=target)
+    return data
+
+
+def concat_columnar_tables(paths, output_path):
+    first = read_meta(paths[0])
+    schema = [(column['name'], 'category' if 'categories' in column else column['dtype']) for column in first['columns']]
+    with ColumnarWriter(output_path, schema) as writer:
+        for path in paths:
+            df = read_columnar_table(path)
+            writer.write_columns([df[name].to_numpy(dtype=object) if dtype == 'category' else df[name].to_numpy()
+                                  for name, dtype in schema])
+
+
+class SparseAdjacency:
+    # Adjacency matrix as COO entries: every nonzero (row, col, weight), with
+    # both triangles present for symmetric graphs.
+    def __init__(self, labels, rows, cols, weights):
+        self.labels = [str(label) for label in labels]
+        self.rows = np.asarray(rows, dtype=np.int64)
+        self.cols = np.asarray(cols, dtype=np.int64)
+        self.weights = np.asarray(weights, dtype=np.float64)
+
+    @property
+    def n(self):
+        return len(self.labels)
+
+    @property
+    def nnz(self):
+        return len(self.weights)
+
+    @classmethod
+    def from_dense(cls, df):
+        values = df.to_numpy()
+        rows, cols = np.nonzero(values)
+        return cls(df.columns.tolist(), rows, cols, values[rows, cols])
+
+    @classmethod
+    def from_edges(cls, labels, rows, cols, weights):
+        # Mirror one-entry-per-edge (row < col) storage back to both triangles.
+        rows, cols = np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64)
+        weights = np.asarray(weights, dtype=np.float64)
+        order = np.lexsort((np.concatenate([cols, rows]), np.concatenate([rows, cols])))
+        return cls(labels, np.concatenate([rows, cols])[order], np.concatenate([cols, rows])[order],
+                   np.concatenate([weights, weights])[order])
+
+    def edges(self):
+        upper = self.rows < self.cols
+        return self.rows[upper], self.cols[upper], self.weights[upper]
+
+    def to_dense(self):
+        matrix = np.zeros((self.n, self.n))
+        matrix[self.rows, self.cols] = self.weights
+        return pd.DataFrame(matrix, index=self.labels, columns=self.labels)
+
+
+def is_edge_csv(path):
+    with open(path, 'r') as f:
+        return f.readline().strip().split(',') == EDGE_HEADER
+
+
+def write_edge_csv(graph, path):
+    rows, cols, weights = graph.edges()
+    labels = np.asarray(graph.labels, dtype=object)
+    pd.DataFrame({'a': labels[rows], 'b': labels[cols], 'weight': weights}).to_csv(path, index=False)
+
+
+def read_edge_csv(path):
+    edges = pd.read_csv(path, dtype={'a': str, 'b': str, 'weight': np.float64})
+    labels = sorted(set(edges['a']) | set(edges['b']))
+    index = {label: i for i, label in enumerate(labels)}
+    rows = edges['a'].map(index).to_numpy()
+    cols = edges['b'].map(index).to_numpy()
+    return SparseAdjacency.from_edges(labels, rows, cols, edges['weight'].to_numpy())
+
+
+def write_adjacency(adjacency, path):
+    if isinstance(adjacency, SparseAdjacency):
+        if not is_columnar(path):
+            write_edge_csv(adjacency, path)
+            return
+        os.makedirs(path, exist_ok=True)
+        files = []
+        for file_name, values in zip(EDGE_FILES, adjacency.edges()):
+            values = np.ascontiguousarray(values, dtype=values.dtype.newbyteorder('<'))
+            with open(os.path.join(path, file_name), 'wb') as f:
+                f.write(values.tobytes())
+            files.append({'file': file_name, 'dtype': values.dtype.str})
+        write_meta(path, {
+            'kind': 'edges',
+            'num_rows': int(adjacency.n),
+            'num_edges': int(len(adjacency.edges()[2])),
+            'labels': adjacency.labels,
+            'edges': files,
+        })
+        return
+
+    df = adjacency
+    if not is_columnar(path):
+        df.to_csv(path)
+        return
+    os.makedirs(path, exist_ok=True)
+    matrix = np.ascontiguousarray(df.to_numpy(), dtype='<f8')
+    with open(os.path.join(path, MATRIX_FILE), 'wb') as f:
+        f.write(matrix.tobytes())
+    write_meta(path, {
+        'kind': 'matrix',
+        'num_rows': int(matrix.shape[0]),
+        'labels': [str(label) for label in df.index],
+        'matrix': {'file': MATRIX_FILE, 'dtype': matrix.dtype.str, 'shape': list(matrix.shape)},
+    })
+
+
+def read_sparse_adjacency(path):
+    # Any adjacency format as COO entries; edge formats are never densified.
+    if not is_columnar(path):
+        if is_edge_csv(path):
+            return read_edge_csv(path)
+        return SparseAdjacency.from_dense(pd.read_csv(path, index_col=0))
+    meta = read_meta(path)
+    if meta['kind'] == 'edges':
+        arrays = [map_array(path, entry['file'], np.dtype(entry['dtype']), (meta['num_edges'],))
+                  for entry in meta['edges']]
+        return SparseAdjacency.from_edges(meta['labels'], *arrays)
+    return SparseAdjacency.from_dense(read_adjacency(path))
+
+
+def read_adjacency(path):
+    if not is_columnar(path):
+        if is_edge_csv(path):
+            return read_edge_csv(path).to_dense()
+        return pd.read_csv(path, index_col=0)
+    meta = read_meta(path)
+    if meta['kind'] == 'edges':
+        return read_sparse_adjacency(path).to_dense()
+    if meta['kind'] != 'matrix':
+        raise ValueError(f"'{path}' holds a {meta['kind']}, not an adjacency matrix")
+    matrix = map_array(path, meta['matrix']['file'], np.dtype(meta['matrix']['dtype']), meta['matrix']['shape'])
+    return pd.DataFrame(matrix, index=meta['labels'], columns=meta['labels'])
+
+
+# Partial aggregates: the pair counts of one or more scans, small enough to
+# ship from a collection host and merged by field name (merge-aggregates.py).
+# An .npz archive with:
+#
+#   format, version   "kstruct-aggregate", 1
+#   meta              JSON {"method", "param", "events", "inputs": [...]}
+#   labels            field names, sorted
+#   field_events      int64 accesses per label
+#   rows, cols, weights
+#                     int64 upper-triangle (row < col) entries of the finished,
+#                     symmetric adjacency weights, sorted by (row, col)
+#
+# Weights are sums over scans, so merging is associative and commutative.
+AGGREGATE_FORMAT = 'kstruct-aggregate'
+AGGREGATE_VERSION = 1
+
+
+def make_aggregate(labels, field_events, rows, cols, weights, meta):
+    # Canonical form: sorted labels, row < col, entries in (row, col) order.
+    order = np.argsort(np.asarray(labels, dtype=object), kind='stable')
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    rows, cols = rank[np.asarray(rows, dtype=np.int64)], rank[np.asarray(cols, dtype=np.int64)]
+    rows, cols = np.minimum(rows, cols), np.maximum(rows, cols)
+    entries = np.lexsort((cols, rows))
+    return {
+        'meta': meta,
+        'labels': [str(labels[i]) for i in order],
+        'field_events': np.asarray(field_events, dtype=np.int64)[order],
+        'rows': rows[entries],
+        'cols': cols[entries],
+        'weights': np.asarray(weights, dtype=np.int64)[entries],
+    }
+
+
+def write_aggregate(aggregate, path):
+    # np.savez appends .npz to names without it; keep the caller's path.
+    tmp_path = f"{path}.tmp.npz"
+    np.savez_compressed(tmp_path, format=AGGREGATE_FORMAT, version=AGGREGATE_VERSION,
+                        meta=json.dumps(aggregate['meta']), labels=np.asarray(aggregate['labels'], dtype=str),
+                        field_events=aggregate['field_events'], rows=aggregate['rows'], cols=aggregate['cols'],
+                        weights=aggregate['weights'])
+    os.replace(tmp_path, path)
+
+
+def read_aggregate(path):
+    with np.load(path) as data:
+        if 'format' not in data or str(data['format']) != AGGREGATE_FORMAT:
+            raise ValueError(f"'{path}' is not a {AGGREGATE_FORMAT} file")
+        if int(data['version']) > AGGREGATE_VERSION:
+            raise ValueError(f"'{path}' uses {AGGREGATE_FORMAT} version {int(data['version'])}; "
+                             f"this tool reads up to {AGGREGATE_VERSION}")
+        return {
+            'meta': json.loads(str(data['meta'])),
+            'labels': [str(label) for label in data['labels']],
+            'field_events': data['field_events'].astype(np.int64),
+            'rows': data['rows'].astype(np.int64),
+            'cols': data['cols'].astype(np.int64),
+            'weights': data['weights'].astype(np.int64),
+        }
+
+
+def merge_aggregates(aggregates):
+    # Sum by field name into a new aggregate of the same form.
+    if not aggregates:
+        raise ValueError("no aggregates to merge")
+    method, param = aggregates[0]['meta']['method'], aggregates[0]['meta']['param']
+    for aggregate in aggregates[1:]:
+        if (aggregate['meta']['method'], aggregate['meta']['param']) != (method, param):
+            raise ValueError(f"cannot merge --method {aggregate['meta']['method']} with parameter "
+                             f"{aggregate['meta']['param']} into --method {method} with parameter {param}")
+    labels = sorted(set().union(*(aggregate['labels'] for aggregate in aggregates)))
+    index = {label: i for i, label in enumerate(labels)}
+    n = len(labels)
+    field_events = np.zeros(n, dtype=np.int64)
+    keys, weights = [], []
+    for aggregate in aggregates:
+        remap = np.asarray([index[label] for label in aggregate['labels']], dtype=np.int64)
+        np.add.at(field_events, remap, aggregate['field_events'])
+        keys.append(remap[aggregate['rows']] * n + remap[aggregate['cols']])
+        weights.append(aggregate['weights'])
+    keys, inverse = np.unique(np.concatenate(keys), return_inverse=True)
+    summed = np.zeros(len(keys), dtype=np.int64)
+    np.add.at(summed, inverse, np.concatenate(weights))
+    rows, cols = np.divmod(keys, max(n, 1))
+    meta = {
+        'method': method,
+        'param': param,
+        'events': sum(int(aggregate['meta']['events']) for aggregate in aggregates),
+        'inputs': [name for aggregate in aggregates for name in aggregate['meta']['inputs']],
+    }
+    return {'meta': meta, 'labels': labels, 'field_events': field_events, 'rows': rows, 'cols': cols,
+            'weights': summed}
+
+
+def aggregate_adjacency(aggregate):
+    # Fields with no pairs are left out, as in proximity-graph.py output.
+    present = np.unique(np.concatenate([aggregate['rows'], aggregate['cols']]))
+    return SparseAdjacency.from_edges([aggregate['labels'][i] for i in present],
+                                      np.searchsorted(present, aggregate['rows']),
+                                      np.searchsorted(present, aggregate['cols']),
+                                      aggregate['weights'])
+
+
+# Per-function attribution of co-access edges (proximity-graph.py
+# --attribution_out): a CSV with the header "a,b,function,weight", a < b, one
+# line per function kept for an edge and one "[other]" line holding the rest of
+# its weight, so an edge's lines sum to its weight in the graph.
+ATTRIBUTION_HEADER = ['a', 'b', 'function', 'weight']
+ATTRIBUTION_OTHER = '[other]'
+
+
+def write_attribution(a, b, functions, weights, path):
+    pd.DataFrame({'a': a, 'b': b, 'function': functions, 'weight': weights},
+                 columns=ATTRIBUTION_HEADER).to_csv(path, index=False)
+
+
+def read_attribution(path):
+    # {(a, b): [(function, weight), ...]} with a < b, heaviest first and
+    # "[other]" last.
+    rows = pd.read_csv(path, dtype={'a': str, 'b': str, 'function': str, 'weight': np.float64},
+                       keep_default_na=False)
+    if list(rows.columns) != ATTRIBUTION_HEADER:
+        raise ValueError(f"'{path}' is not an attribution file (expected header {','.join(ATTRIBUTION_HEADER)})")
+    attribution = {}
+    for a, b, function, weight in rows.itertuples(index=False):
+        attribution.setdefault((a, b) if a < b else (b, a), []).append((function, float(weight)))
+    for functions in attribution.values():
+        functions.sort(key=lambda item: (item[0] == ATTRIBUTION_OTHER, -item[1]))
+    return attribution
+
+
+def import_script(name):
+    # Pipeline stages are hyphenated scripts next to this module; load one
+    # (e.g. "proximity-graph") as a module to reuse its functions.
+    module_name = name.replace('-', '_')
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), f"{name}.py")
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,126 @@
+import cProfile
+import json
+import os
+import platform
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+# Opt-in instrumentation shared by the stage scripts.
+#
+#   --metrics_out m.json   phases with wall and CPU seconds, counts, throughput,
+#                          peak RSS and per-chunk worker times as JSON
+#   --profile DIR          one cProfile dump per phase, DIR/<stage>.<phase>.prof
+#
+# CPU seconds are those of the main process; a phase whose CPU time is well
+# below its wall time waited on I/O or on worker processes, whose own time is
+# in "workers". Skew is the slowest chunk over the median one.
+METRICS_VERSION = 1
+
+
+def add_arguments(parser):
+    parser.add_argument("--metrics_out", type=str, default=None,
+                        help="Write per-phase timings, counts, throughput and peak memory as JSON to this path.")
+    parser.add_argument("--profile", type=str, default=None, metavar="DIR",
+                        help="Write a cProfile dump per phase to this directory (<stage>.<phase>.prof).")
+
+
+class StageMetrics:
+    def __init__(self, stage, metrics_out=None, profile_dir=None):
+        self.stage = stage
+        self.metrics_out = metrics_out
+        self.profile_dir = profile_dir
+        self.enabled = bool(metrics_out or profile_dir)
+        self.phases = []
+        self.counts = {}
+        self.chunks = []
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        if profile_dir:
+            os.makedirs(profile_dir, exist_ok=True)
+
+    @classmethod
+    def from_args(cls, stage, args):
+        return cls(stage, args.metrics_out, args.profile)
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        profiler = cProfile.Profile() if self.profile_dir else None
+        wall, cpu = time.perf_counter(), time.process_time()
+        if profiler:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler:
+                profiler.disable()
+                profiler.dump_stats(os.path.join(self.profile_dir, f"{self.stage}.{name}.prof"))
+            self.phases.append({
+                'name': name,
+                'wall_seconds': time.perf_counter() - wall,
+                'cpu_seconds': time.process_time() - cpu,
+            })
+
+    def count(self, **values):
+        for key, value in values.items():
+            self.counts[key] = self.counts.get(key, 0) + value
+
+    def chunk(self, worker, seconds, **values):
+        # One unit of work done in a Pool worker.
+        if self.enabled:
+            self.chunks.append(dict(worker=worker, seconds=seconds, **values))
+
+    def worker_summary(self):
+        if not self.chunks:
+            return None
+        seconds = sorted(chunk['seconds'] for chunk in self.chunks)
+        median = seconds[len(seconds) // 2]
+        busy = {}
+        for chunk in self.chunks:
+            busy[chunk['worker']] = busy.get(chunk['worker'], 0.0) + chunk['seconds']
+        return {
+            'chunks': len(seconds),
+            'workers': len(busy),
+            'chunk_seconds_min': seconds[0],
+            'chunk_seconds_median': median,
+            'chunk_seconds_max': seconds[-1],
+            'chunk_skew': seconds[-1] / median if median else None,
+            'worker_busy_seconds': sorted(busy.values(), reverse=True),
+            'per_chunk': self.chunks,
+        }
+
+    def report(self):
+        wall = time.perf_counter() - self.start_wall
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        events = self.counts.get('events')
+        return {
+            'version': METRICS_VERSION,
+            'stage': self.stage,
+            'argv': sys.argv,
+            'host': platform.node(),
+            'wall_seconds': wall,
+            'cpu_seconds': time.process_time() - self.start_cpu,
+            'worker_cpu_seconds': children.ru_utime + children.ru_stime,
+            'peak_rss_mb': own.ru_maxrss / 1024.0,
+            'worker_peak_rss_mb': children.ru_maxrss / 1024.0,
+            'events_per_second': events / wall if events and wall else None,
+            'phases': self.phases,
+            'counts': self.counts,
+            'workers': self.worker_summary(),
+        }
+
+    def write(self):
+        if not self.metrics_out:
+            return
+        with open(self.metrics_out, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        print(f"Metrics written to {self.metrics_out}")
+
+
+# Stands in where no metrics were asked for.
+DISABLED = StageMetrics(None)
@@ -0,0 +1,415 @@
+import argparse
+import json
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+import kstruct_io
+from pahole import aligned_attribute, parse_struct_layout, split_access_path
+
+
+def align_up(offset: int, align: int) -> int:
+    return (offset + align - 1) // align * align
+
+
+def member_alignment(member: Dict[str, Any]) -> int:
+    forced = aligned_attribute(member["attributes"])
+    if forced:
+        return forced
+    # Natural alignment of a scalar or aggregate, capped at 8 bytes, and never
+    # more than its current offset already satisfies.
+    size = member["size"]
+    natural = min(8, size & -size) if size else 1
+    offset = member["offset"]
+    return min(natural, offset & -offset) if offset else natural
+
+
+def top_level_name(label: str, struct_name: str) -> Optional[str]:
+    # Nested accesses such as "cfs.nr_running" weigh on their enclosing member;
+    # "task_struct->..." labels of other structs in the trace are skipped.
+    label_struct, path = split_access_path(label)
+    if label_struct not in (None, struct_name):
+        return None
+    return path.split(".")[0]
+
+
+def load_affinity(graph: kstruct_io.SparseAdjacency, names: List[str], struct_name: str) -> np.ndarray:
+    index = {name: i for i, name in enumerate(names)}
+    member = np.array([index.get(top_level_name(label, struct_name), -1) for label in graph.labels], dtype=np.int64)
+    affinity = np.zeros((len(names), len(names)))
+    if not graph.nnz:
+        return affinity
+    rows, cols = member[graph.rows], member[graph.cols]
+    keep = (rows >= 0) & (cols >= 0) & (rows != cols)
+    np.add.at(affinity, (rows[keep], cols[keep]), graph.weights[keep])
+    return affinity
+
+
+def load_access_counts(access_file: Optional[str], names: List[str], struct_name: str):
+    reads = np.zeros(len(names))
+    writes = np.zeros(len(names))
+    if not access_file:
+        return reads, writes
+    index = {name: i for i, name in enumerate(names)}
+    has_struct = "Struct" in kstruct_io.table_columns(access_file)
+    events = kstruct_io.read_columns(access_file, ["Field", "Access_Type"] + (["Struct"] if has_struct else []))
+    fields = np.asarray(events["Field"], dtype=object)
+    modify = np.asarray(events["Access_Type"], dtype=object) == "modify"
+    member = np.array([index.get(top_level_name(str(f), struct_name), -1) for f in fields], dtype=np.int64)
+    known = member >= 0
+    if has_struct:
+        known &= np.asarray(events["Struct"], dtype=object) == struct_name
+    np.add.at(writes, member[known & modify], 1)
+    np.add.at(reads, member[known & ~modify], 1)
+    return reads, writes
+
+
+def placement_units(members: List[Dict[str, Any]]) -> List[List[int]]:
+    # Members that move together: one per member, except that bitfields in the
+    # same storage unit (pahole gives them its offset and size) stay one unit.
+    units: List[List[int]] = []
+    for i, member in enumerate(members):
+        if units and member["bitfield"] and members[units[-1][-1]]["bitfield"]:
+            first = members[units[-1][0]]
+            if first["offset"] <= member["offset"] < first["offset"] + first["size"]:
+                units[-1].append(i)
+                continue
+        units.append([i])
+    return units
+
+
+def merge_units(members: List[Dict[str, Any]], units: List[List[int]], affinity: np.ndarray, reads: np.ndarray,
+                writes: np.ndarray):
+    # Unit-level members, affinity and access counts for optimize_layout.
+    unit_members = []
+    for unit in units:
+        start = members[unit[0]]["offset"]
+        end = max(members[i]["offset"] + members[i]["size"] for i in unit)
+        unit_members.append(dict(members[unit[0]], offset=start, size=end - start))
+    membership = np.zeros((len(members), len(units)))
+    for u, unit in enumerate(units):
+        membership[unit, u] = 1.0
+    unit_affinity = membership.T @ affinity @ membership
+    np.fill_diagonal(unit_affinity, 0.0)
+    return unit_members, unit_affinity, reads @ membership, writes @ membership
+
+
+def expand_units(members: List[Dict[str, Any]], units: List[List[int]], unit_members: List[Dict[str, Any]],
+                 unit_offsets: Dict[int, int], unit_aligns: List[int]):
+    offsets: Dict[int, int] = {}
+    aligns = [1] * len(members)
+    for u, start in unit_offsets.items():
+        for i in units[u]:
+            offsets[i] = start + members[i]["offset"] - unit_members[u]["offset"]
+            aligns[i] = unit_aligns[u]
+    return offsets, aligns
+
+
+def lines_of(offset: int, size: int, line_size: int) -> range:
+    return range(offset // line_size, (offset + max(size, 1) - 1) // line_size + 1)
+
+
+def score_layout(offsets: Dict[int, int], sizes: np.ndarray, affinity: np.ndarray, reads: np.ndarray,
+                 writes: np.ndarray, line_size: int) -> Dict[str, float]:
+    line_members: Dict[int, List[int]] = {}
+    for idx, offset in offsets.items():
+        for line in lines_of(offset, int(sizes[idx]), line_size):
+            line_members.setdefault(line, []).append(idx)
+
+    shared = np.zeros(affinity.shape, dtype=bool)
+    for members in line_members.values():
+        shared[np.ix_(members, members)] = True
+    np.fill_diagonal(shared, False)
+
+    # Both terms are fractions so that --write_penalty trades them off
+    # independently of trace length and window size.
+    total_events = float(reads.sum() + writes.sum()) or 1.0
+    mixing = 0.0
+    for members in line_members.values():
+        w, r = writes[members], reads[members] + writes[members]
+        # Writes to one field while other fields of the line are in use.
+        mixing += float(w.sum() * r.sum() - (w * r).sum())
+    total_affinity = float(np.triu(affinity + affinity.T, k=1).sum()) / 2.0 or 1.0
+    intra = float(np.triu(np.where(shared, affinity + affinity.T, 0.0), k=1).sum()) / 2.0
+    hotness = (affinity + affinity.T).sum(axis=1) + reads + writes
+    touched = [line for line, members in line_members.items() if hotness[members].sum() > 0]
+    return {
+        "intra_line_weight": intra,
+        "intra_line_fraction": intra / total_affinity,
+        "write_sharing": mixing / total_events ** 2,
+        "hot_cache_lines": len(touched),
+    }
+
+
+def optimize_layout(members: List[Dict[str, Any]], affinity: np.ndarray, reads: np.ndarray, writes: np.ndarray,
+                    line_size: int, write_penalty: float):
+    n = len(members)
+    sizes = np.array([m["size"] for m in members], dtype=np.int64)
+    aligns = [member_alignment(m) for m in members]
+    pair_affinity = affinity + affinity.T
+    hotness = pair_affinity.sum(axis=1) + reads + writes
+    total_events = float(reads.sum() + writes.sum()) or 1.0
+    total_affinity = float(pair_affinity.sum()) / 2.0 or 1.0
+    hot = [i for i in np.argsort(-hotness, kind="stable").tolist() if hotness[i] > 0]
+    cold = [i for i in range(n) if hotness[i] <= 0]
+    offsets: Dict[int, int] = {}
+    offset = 0
+
+    def place(idx: int) -> None:
+        nonlocal offset
+        offsets[idx] = align_up(offset, aligns[idx])
+        offset = offsets[idx] + int(sizes[idx])
+
+    def fill_gap(end: int) -> None:
+        # Best fit of cold members into [offset, end), largest first.
+        while True:
+            fitting = [i for i in cold if align_up(offset, aligns[i]) + sizes[i] <= end]
+            if not fitting:
+                return
+            best = max(fitting, key=lambda i: (sizes[i], -aligns[i]))
+            cold.remove(best)
+            place(best)
+
+    while hot:
+        line_start = offset // line_size * line_size
+        line_end = line_start + line_size
+        if offset == line_start:
+            # Seed an empty line with the hottest member left; pad with cold
+            # members first if it needs a stricter alignment.
+            seed = hot.pop(0)
+            fill_gap(align_up(offset, aligns[seed]))
+            place(seed)
+            continue
+
+        in_line = [i for i, start in offsets.items() if start < line_end and start + sizes[i] > line_start]
+        best, best_key = None, None
+        for i in hot:
+            if align_up(offset, aligns[i]) + sizes[i] > line_end:
+                continue
+            gain = pair_affinity[i, in_line].sum() / total_affinity
+            conflict = (writes[i] * (reads[in_line] + writes[in_line]).sum()
+                        + (reads[i] + writes[i]) * writes[in_line].sum()) / total_events ** 2
+            score = gain - write_penalty * conflict
+            # Highest score; among members that neither gain nor cost, the
+            # one that fills the line best rather than leaving a hole.
+            key = (score, sizes[i])
+            if best_key is None or key > best_key:
+                best, best_key = i, key
+        if best is None or best_key[0] < 0:
+            fill_gap(line_end)
+            if offset < line_end and best is not None and align_up(offset, aligns[best]) + sizes[best] <= line_end:
+                # Cold members ran out: a hot member that costs a little
+                # beats a hole that costs a line.
+                hot.remove(best)
+                place(best)
+                continue
+            offset = line_end
+            continue
+        hot.remove(best)
+        fill_gap(align_up(offset, aligns[best]))
+        place(best)
+
+    # Remaining cold members, strictest alignment first to keep holes small.
+    for idx in sorted(cold, key=lambda i: (-aligns[i], -sizes[i])):
+        place(idx)
+
+    return offsets, aligns
+
+
+def struct_size(offsets: Dict[int, int], sizes: np.ndarray, struct_align: int) -> int:
+    end = max((offset + int(sizes[idx]) for idx, offset in offsets.items()), default=0)
+    return align_up(end, struct_align)
+
+
+def regressions(score: Dict[str, float], original: Dict[str, float], allow_write_regression: bool,
+                allow_growth: bool) -> List[str]:
+    # Scores the proposal may not make worse than the original layout.
+    checked = ([] if allow_write_regression else ["write_sharing"]) + ([] if allow_growth else ["size", "hot_cache_lines"])
+    return [key for key in checked if score[key] > original[key]]
+
+
+# When the proposal at --write_penalty regresses, penalties up to
+# 2 ** PENALTY_STEPS times larger are tried on a geometric grid of
+# PENALTY_GRID points per doubling, and the smallest one without a regression
+# is used: larger penalties keep writers apart at the cost of co-access gain.
+# The grid is scanned rather than bisected because the greedy packing is not
+# monotonic in the penalty.
+PENALTY_STEPS = 10
+PENALTY_GRID = 8
+
+
+def propose_layout(members: List[Dict[str, Any]], affinity: np.ndarray, reads: np.ndarray, writes: np.ndarray,
+                   line_size: int, write_penalty: float, allow_write_regression: bool = False,
+                   allow_growth: bool = False, struct_align: int = 1):
+    # Optimizes placement units and scores the members. Returns offsets,
+    # aligns, scores, the penalty used and the scores the proposal at
+    # write_penalty made worse if no penalty avoided that (the original
+    # layout is returned then).
+    sizes = np.array([m["size"] for m in members], dtype=np.int64)
+    units = placement_units(members)
+    unit_members, unit_affinity, unit_reads, unit_writes = merge_units(members, units, affinity, reads, writes)
+    original = {i: m["offset"] for i, m in enumerate(members)}
+    original_aligns = [member_alignment(m) for m in members]
+    original_score = score_layout(original, sizes, affinity, reads, writes, line_size)
+    original_score["size"] = struct_size(original, sizes, max([struct_align] + original_aligns))
+
+    def attempt(penalty: float):
+        unit_offsets, unit_aligns = optimize_layout(unit_members, unit_affinity, unit_reads, unit_writes, line_size,
+                                                    penalty)
+        offsets, aligns = expand_units(members, units, unit_members, unit_offsets, unit_aligns)
+        score = score_layout(offsets, sizes, affinity, reads, writes, line_size)
+        score["size"] = struct_size(offsets, sizes, max([struct_align] + aligns))
+        return offsets, aligns, score, regressions(score, original_score, allow_write_regression, allow_growth)
+
+    offsets, aligns, score, worse = attempt(write_penalty)
+    if not worse:
+        return offsets, aligns, {"original": original_score, "proposed": score}, write_penalty, []
+    for step in range(1, PENALTY_STEPS * PENALTY_GRID + 1):
+        penalty = max(write_penalty, 1.0) * 2 ** (step / PENALTY_GRID)
+        offsets, aligns, score, rejected = attempt(penalty)
+        if not rejected:
+            return offsets, aligns, {"original": original_score, "proposed": score}, penalty, []
+    return original, original_aligns, {"original": original_score, "proposed": original_score}, write_penalty, worse
+
+
+def describe_layout(name: str, members: List[Dict[str, Any]], offsets: Dict[int, int], aligns: List[int],
+                    struct_align: int, line_size: int) -> Dict[str, Any]:
+    order = sorted(offsets, key=lambda i: offsets[i])
+    fields, holes = [], []
+    end = member_bytes = 0
+    for idx in order:
+        if offsets[idx] > end:
+            holes.append({"offset": end, "size": offsets[idx] - end})
+        # Bitfields sharing a storage unit count its bytes once.
+        member_bytes += max(offsets[idx] + members[idx]["size"] - max(offsets[idx], end), 0)
+        fields.append({
+            "name": members[idx]["name"],
+            "type": members[idx]["type"],
+            "attributes": members[idx]["attributes"],
+            "decl": members[idx]["decl"],
+            "offset": offsets[idx],
+            "original_offset": members[idx]["offset"],
+            "size": members[idx]["size"],
+            "align": aligns[idx],
+            "bitfield": members[idx]["bitfield"],
+        })
+        end = max(end, offsets[idx] + members[idx]["size"])
+    size = align_up(end, struct_align)
+    return {
+        "struct": name,
+        "cache_line_size": line_size,
+        "size": size,
+        "align": struct_align,
+        "cachelines": (size + line_size - 1) // line_size,
+        "fields": fields,
+        "holes": holes,
+        "member_bytes": member_bytes,
+        "padding": size - end,
+    }
+
+
+def render_layout(layout: Dict[str, Any]) -> str:
+    line_size = layout["cache_line_size"]
+    out = [f"struct {layout['struct']} {{"]
+    holes = {hole["offset"]: hole["size"] for hole in layout["holes"]}
+    boundary = 0
+    for field in layout["fields"]:
+        hole_start = next((start for start, size in holes.items() if start + size == field["offset"]), None)
+        if hole_start is not None:
+            out.append(f"\n\t/* XXX {holes[hole_start]} bytes hole, try to pack */\n")
+        line = field["offset"] // line_size
+        if line > boundary:
+            boundary = line
+            out.append(f"\t/* --- cacheline {line} boundary ({line * line_size} bytes) --- */")
+        decl = f"{field['decl']};"
+        out.append(f"\t{decl:<60} /* {field['offset']:5d} {field['size']:5d} */")
+        boundary = max(boundary, (field["offset"] + field["size"] - 1) // line_size)
+    out.append("")
+    out.append(f"\t/* size: {layout['size']}, cachelines: {layout['cachelines']}, members: {len(layout['fields'])} */")
+    out.append(f"\t/* sum members: {layout['member_bytes']}, holes: {len(layout['holes'])}, "
+               f"sum holes: {sum(h['size'] for h in layout['holes'])} */")
+    if layout["padding"]:
+        out.append(f"\t/* padding: {layout['padding']} */")
+    suffix = f" __attribute__((__aligned__({layout['align']})))" if layout["align"] > 8 else ""
+    out.append(f"}}{suffix};")
+    return "\n".join(out) + "\n"
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Propose a cache-line-aware struct layout from an adjacency matrix and pahole data."
+    )
+    parser.add_argument("input_graph", help="Adjacency matrix (dense CSV, a,b,weight edge CSV, or .kcol store).")
+    parser.add_argument("pahole_file", help="pahole output for the struct to lay out.")
+    parser.add_argument("--output_file", "-o", default="proposed_layout.txt",
+                        help="Path to write the proposed struct layout.")
+    parser.add_argument("--json_out", type=str, default=None,
+                        help="Optional path to also write the layout (offsets, holes, scores) as JSON.")
+    parser.add_argument("--access_file", type=str, default=None,
+                        help="Parsed access log (struct-parser.py output) for per-field read/write counts.")
+    parser.add_argument("--struct", type=str, default=None,
+                        help="Struct to lay out when the pahole file holds several (default: the first one).")
+    parser.add_argument("--cache_line_size", type=int, default=64, help="Cache line size in bytes.")
+    parser.add_argument("--write_penalty", type=float, default=1.0,
+                        help="Weight of mixing written and read fields in one line against co-access gain; "
+                             "raised until neither write sharing nor size nor hot cache lines are worse than in "
+                             "the original layout.")
+    parser.add_argument("--allow_write_regression", action="store_true",
+                        help="Keep the layout found with --write_penalty even if it raises write sharing "
+                             "(reported in the output).")
+    parser.add_argument("--allow_growth", action="store_true",
+                        help="Keep a layout that makes the struct larger or touches more hot cache lines than the "
+                             "original (reported in the output).")
+
+    args = parser.parse_args()
+
+    struct = parse_struct_layout(args.pahole_file, args.struct)
+    members = struct["members"]
+    names = [m["name"] for m in members]
+
+    affinity = load_affinity(kstruct_io.read_sparse_adjacency(args.input_graph), names, struct["name"])
+    reads, writes = load_access_counts(args.access_file, names, struct["name"])
+
+    offsets, aligns, score, penalty, rejected = propose_layout(
+        members, affinity, reads, writes, args.cache_line_size, args.write_penalty, args.allow_write_regression,
+        args.allow_growth, struct["align"] or 1)
+    struct_align = max([struct["align"] or 1] + aligns)
+    layout = describe_layout(struct["name"], members, offsets, aligns, struct_align, args.cache_line_size)
+    layout["score"] = score
+    layout["original_size"] = struct["size"]
+    layout["write_penalty"] = {"requested": args.write_penalty, "used": penalty}
+    layout["rejected"] = rejected
+    layout["regressions"] = regressions(score["proposed"], score["original"], False, False)
+    layout["write_sharing_regression"] = "write_sharing" in layout["regressions"]
+
+    if rejected:
+        note = (f"No layout up to write penalty {max(args.write_penalty, 1.0) * 2 ** PENALTY_STEPS:g} avoided a "
+                f"regression in {', '.join(rejected)} against the original; the original layout is kept.")
+    elif penalty != args.write_penalty:
+        note = f"Write penalty raised from {args.write_penalty:g} to {penalty:g} to avoid a regression against the original."
+    elif layout["regressions"]:
+        note = f"Regression against the original layout in {', '.join(layout['regressions'])}."
+    else:
+        note = None
+
+    with open(args.output_file, "w") as f:
+        f.write(render_layout(layout))
+        f.write("\nLayout Score (original -> proposed)\n")
+        for key in layout["score"]["original"]:
+            f.write(f"{key}: {layout['score']['original'][key]} -> {layout['score']['proposed'][key]}\n")
+        if note:
+            f.write(f"\n{note}\n")
+
+    if args.json_out:
+        with open(args.json_out, "w") as jf:
+            json.dump(layout, jf, indent=2)
+
+    if note:
+        print(note)
+    print(f"Proposed layout written to {args.output_file}")
+    if args.json_out:
+        print(f"JSON layout written to {args.json_out}")
+
+
+if __name__ == "__main__":
+    main()
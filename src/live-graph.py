@@ -0,0 +1,245 @@
+import argparse
+import json
+import os
+import signal
+import sys
+import time
+
+import numpy as np
+
+import kstruct_io
+
+proximity = kstruct_io.import_script("proximity-graph")
+clustering = kstruct_io.import_script("hierarchical-clustering")
+struct_parser = kstruct_io.import_script("struct-parser")
+
+# Field codes grow as new fields show up, so pair keys use a fixed stride.
+FIELD_KEY_SPACE = 1 << 31
+BATCH_SIZE = 65536
+# Batches over at most this many fields are counted densely, which lets dense
+# windows use per-field prefix counts; the n x n matrix (512 KiB at the limit)
+# is allocated per batch, so larger field sets are counted sparsely.
+DENSE_FIELD_LIMIT = 256
+STATE_FILE = 'state.npz'
+STATE_VERSION = 2
+
+
+class LiveGraph:
+    # Incremental proximity counts over a stream of accesses, with the same
+    # pairs and weights as an offline proximity-graph.py run over the same
+    # events. Only the events whose window is still open, or the top of the
+    # LRU stack, are kept between batches. perf merges per-CPU buffers, so in
+    # window mode each batch is sorted by time together with the open events;
+    # an event older than one already counted and dropped is late: its pairs
+    # with dropped events are lost, and it is counted in late_events.
+    def __init__(self, method, param):
+        self.method = method
+        self.param = param
+        self.fields = {}
+        self.counts = proximity.PairCounts(FIELD_KEY_SPACE, sparse=True)
+        self.timestamps = np.zeros(0, dtype=np.float32)
+        self.codes = np.zeros(0, dtype=np.int32)
+        self.pending_timestamps = []
+        self.pending_codes = []
+        self.events = 0
+        self.lines = 0
+        self.skipped_lines = 0
+        self.late_events = 0
+        self.closed_until = -np.inf
+
+    def add(self, timestamp, struct, field):
+        code = self.fields.setdefault((struct, field), len(self.fields))
+        self.pending_timestamps.append(timestamp)
+        self.pending_codes.append(code)
+        self.events += 1
+        if len(self.pending_codes) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.pending_codes:
+            return
+        timestamps = np.concatenate([self.timestamps, np.asarray(self.pending_timestamps, dtype=np.float32)])
+        codes = np.concatenate([self.codes, np.asarray(self.pending_codes, dtype=np.int32)])
+        self.pending_timestamps, self.pending_codes = [], []
+        if self.method == "window":
+            if np.any(timestamps[1:] < timestamps[:-1]):
+                order = np.argsort(timestamps, kind='stable')
+                timestamps, codes = timestamps[order], codes[order]
+                late = int(np.count_nonzero(timestamps < self.closed_until))
+                if late and not self.late_events:
+                    print(f"Warning: {late} events arrived after events up to {self.closed_until} were counted; "
+                          f"their pairs with those events are lost (see late_events in status.json).",
+                          file=sys.stderr)
+                self.late_events += late
+            # Events whose window already ends before the newest event are
+            # final: count the pairs they open and drop them.
+            hi = proximity.window_bounds(timestamps, self.param)
+            n_closed = int(np.searchsorted(hi, len(timestamps), side='left'))
+            self.add_counts(lambda n_fields, sparse: proximity.window_pair_counts(
+                timestamps, codes, n_fields, self.param, n_closed, sparse))
+            if n_closed:
+                self.closed_until = max(self.closed_until, float(timestamps[n_closed - 1]))
+            self.timestamps, self.codes = timestamps[n_closed:], codes[n_closed:]
+            return
+        n_warmup = len(self.codes)
+        self.add_counts(lambda n_fields, sparse: proximity.stack_pair_counts(
+            codes, n_fields, self.param, n_warmup, sparse))
+        # Replaying the last access of each of the top threshold + 1 fields
+        # rebuilds the part of the stack the next batch can reach.
+        top = list(dict.fromkeys(codes[::-1].tolist()))[:max(int(self.param), 0) + 1]
+        self.codes = np.asarray(top[::-1], dtype=np.int32)
+        self.timestamps = np.zeros(len(self.codes), dtype=np.float32)
+
+    def add_counts(self, count, into=None):
+        # count(n_fields, sparse) -> PairCounts for the current field codes,
+        # re-keyed into the fixed key space.
+        into = self.counts if into is None else into
+        n_fields = len(self.fields)
+        if n_fields > DENSE_FIELD_LIMIT:
+            into.add(count(FIELD_KEY_SPACE, True))
+            return
+        dense = count(n_fields, False).dense
+        rows, cols = np.nonzero(dense)
+        into.merge(rows.astype(np.int64) * FIELD_KEY_SPACE + cols, dense[rows, cols])
+
+    def snapshot_counts(self):
+        # Counts as if the stream ended now; open windows stay open in the state.
+        self.flush()
+        counts = proximity.PairCounts(FIELD_KEY_SPACE, sparse=True).add(self.counts)
+        if self.method == "window" and len(self.codes):
+            self.add_counts(lambda n_fields, sparse: proximity.window_pair_counts(
+                self.timestamps, self.codes, n_fields, self.param, sparse=sparse), counts)
+        return proximity.finish_pair_counts(self.method, counts)
+
+    def labels(self):
+        names = [None] * len(self.fields)
+        qualify = len({struct for struct, _ in self.fields}) > 1
+        for (struct, field), code in self.fields.items():
+            names[code] = f"{struct}->{field}" if qualify else field
+        return names
+
+    def adjacency(self):
+        # Labels in name order, as offline runs produce them.
+        graph = proximity.create_adjacency_matrix(self.labels(), self.snapshot_counts())
+        order = np.argsort(np.asarray(graph.labels, dtype=object), kind='stable')
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        rows, cols = rank[graph.rows], rank[graph.cols]
+        entries = np.lexsort((cols, rows))
+        return kstruct_io.SparseAdjacency([graph.labels[i] for i in order], rows[entries], cols[entries],
+                                          graph.weights[entries])
+
+    def save_state(self, path):
+        self.flush()
+        structs, fields = zip(*self.fields) if self.fields else ((), ())
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(tmp_path, version=STATE_VERSION, method=self.method, param=self.param,
+                 structs=np.asarray(structs, dtype=str), fields=np.asarray(fields, dtype=str),
+                 keys=self.counts.keys, values=self.counts.values,
+                 timestamps=self.timestamps, codes=self.codes, closed_until=self.closed_until,
+                 totals=np.asarray([self.events, self.lines, self.skipped_lines, self.late_events], dtype=np.int64))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load_state(cls, path, method, param):
+        with np.load(path) as state:
+            if int(state['version']) > STATE_VERSION:
+                raise SystemExit(f"Error: '{path}' uses state version {int(state['version'])}; "
+                                 f"this tool reads up to {STATE_VERSION}.")
+            if str(state['method']) != method or float(state['param']) != float(param):
+                raise SystemExit(f"Error: '{path}' was written by --method {state['method']} with parameter "
+                                 f"{state['param']}; resume with the same settings.")
+            graph = cls(method, param)
+            graph.fields = {(str(s), str(f)): i for i, (s, f) in enumerate(zip(state['structs'], state['fields']))}
+            graph.counts.keys, graph.counts.values = state['keys'], state['values']
+            graph.timestamps, graph.codes = state['timestamps'], state['codes']
+            graph.events, graph.lines, graph.skipped_lines = (int(v) for v in state['totals'][:3])
+            if 'closed_until' in state:
+                graph.closed_until = float(state['closed_until'])
+                graph.late_events = int(state['totals'][3])
+        return graph
+
+
+def write_checkpoint(graph, checkpoint_dir, sparse, top_n, per_field_top_k):
+    adjacency = graph.adjacency()
+    graph_file = os.path.join(checkpoint_dir, 'graph.csv')
+    kstruct_io.write_adjacency(adjacency if sparse else adjacency.to_dense(), graph_file)
+    if adjacency.nnz:
+        insights = clustering.compute_insights(adjacency, top_n, per_field_top_k)
+        clustering.write_text_insights(insights, os.path.join(checkpoint_dir, 'insights.out'))
+        with open(os.path.join(checkpoint_dir, 'insights.json'), 'w') as jf:
+            json.dump(clustering.build_json_payload(insights), jf, indent=2)
+    graph.save_state(os.path.join(checkpoint_dir, STATE_FILE))
+    status = {
+        'time': time.time(),
+        'lines': graph.lines,
+        'skipped_lines': graph.skipped_lines,
+        'events': graph.events,
+        'late_events': graph.late_events,
+        'fields': len(graph.fields),
+        'edges': int(adjacency.nnz // 2),
+    }
+    with open(os.path.join(checkpoint_dir, 'status.json'), 'w') as f:
+        json.dump(status, f, indent=2)
+    print(f"Checkpoint: {status['events']} events, {status['fields']} fields, {status['edges']} edges",
+          file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build the proximity graph incrementally from perf script lines on stdin or a FIFO."
+    )
+    parser.add_argument("input", nargs="?", default="-", help="Trace to read, '-' for stdin (default), or a FIFO.")
+    parser.add_argument("--checkpoint_dir", required=True,
+                        help="Directory for the periodic graph.csv, insights.out/json, status.json and resumable state.")
+    parser.add_argument("--method", choices=["window", "stack"], required=True,
+                        help="Method to use: 'window' or 'stack'.")
+    parser.add_argument("--window_size", type=float, default=3e-6, help="Window size for 'window' method.")
+    parser.add_argument("--stack_distance_threshold", type=int, default=10, help="Stack distance threshold for 'stack' method.")
+    parser.add_argument("--exclude_cross_cpu", action="store_true", help="Skip cross-CPU accesses, as struct-parser.py does.")
+    parser.add_argument("--checkpoint_interval", type=float, default=60.0,
+                        help="Seconds between checkpoints (checked as lines arrive).")
+    parser.add_argument("--checkpoint_events", type=int, default=1000000, help="Events between checkpoints.")
+    parser.add_argument("--resume", action="store_true", help="Continue from the state in --checkpoint_dir.")
+    parser.add_argument("--sparse", action="store_true", help="Write graph.csv as a,b,weight edges instead of a dense matrix.")
+    parser.add_argument("--top_n", type=int, default=20, help="How many top pairs and inter-cluster links to include.")
+    parser.add_argument("--per_field_top_k", type=int, default=3, help="Top-k partners to report per field.")
+
+    args = parser.parse_args()
+
+    param = args.window_size if args.method == "window" else args.stack_distance_threshold
+    os.makedirs(args.checkpoint_dir, exist_ok=True)
+    state_path = os.path.join(args.checkpoint_dir, STATE_FILE)
+    if args.resume and os.path.exists(state_path):
+        graph = LiveGraph.load_state(state_path, args.method, param)
+    else:
+        graph = LiveGraph(args.method, param)
+
+    # SIGTERM ends the run like Ctrl-C: with a final checkpoint.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    stream = sys.stdin if args.input == "-" else open(args.input, 'r')
+    last_checkpoint, last_events = time.monotonic(), graph.events
+    try:
+        for line in stream:
+            graph.lines += 1
+            entry = struct_parser.parse_log_line(line)
+            if entry is None or (args.exclude_cross_cpu and struct_parser.is_cross_cpu(entry)):
+                graph.skipped_lines += 1
+                continue
+            graph.add(entry.timestamp, entry.struct, entry.field)
+            if (graph.events - last_events >= args.checkpoint_events
+                    or time.monotonic() - last_checkpoint >= args.checkpoint_interval):
+                write_checkpoint(graph, args.checkpoint_dir, args.sparse, args.top_n, args.per_field_top_k)
+                last_checkpoint, last_events = time.monotonic(), graph.events
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+    write_checkpoint(graph, args.checkpoint_dir, args.sparse, args.top_n, args.per_field_top_k)
+    print(f"Final checkpoint written to {args.checkpoint_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+import argparse
+
+import kstruct_io
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Merge partial aggregates from proximity-graph.py --aggregate_out by field name."
+    )
+    parser.add_argument("inputs", nargs="+", help="Partial aggregate files (.npz), e.g. one per host or run.")
+    parser.add_argument("--output_file", "-o", type=str, default=None,
+                        help="Path to write the merged aggregate, which can be merged again.")
+    parser.add_argument("--graph_out", type=str, default=None,
+                        help="Path to write the merged adjacency matrix (CSV, or a .kcol path for the columnar format).")
+    parser.add_argument("--sparse", action="store_true",
+                        help="Write --graph_out as a,b,weight edges (or a .kcol edge store) instead of a dense matrix.")
+
+    args = parser.parse_args()
+    if not args.output_file and not args.graph_out:
+        parser.error("nothing to write; give --output_file and/or --graph_out")
+
+    try:
+        merged = kstruct_io.merge_aggregates([kstruct_io.read_aggregate(path) for path in args.inputs])
+    except ValueError as e:
+        raise SystemExit(f"Error: {e}")
+
+    if args.output_file:
+        kstruct_io.write_aggregate(merged, args.output_file)
+        print(f"Merged aggregate written to {args.output_file}")
+    if args.graph_out:
+        adjacency = kstruct_io.aggregate_adjacency(merged)
+        kstruct_io.write_adjacency(adjacency if args.sparse else adjacency.to_dense(), args.graph_out)
+        print(f"Merged adjacency matrix written to {args.graph_out}")
+    print(f"{len(args.inputs)} aggregates, {merged['meta']['events']} events, {len(merged['labels'])} fields, "
+          f"{len(merged['weights'])} edges")
+
+
+if __name__ == "__main__":
+    main()
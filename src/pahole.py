@@ -0,0 +1,198 @@
+import hashlib
+import json
+import os
+import re
+
+# <type> <name> [__attribute__((...))];   /* <offset>[:<bit>] <size> */
+MEMBER_RE = re.compile(r'^(?P<decl>[^/]*?);\s*/\*\s*(?P<offset>\d+)(?::\s*(?P<bit>\d+))?\s+(?P<size>\d+)\s*\*/')
+STRUCT_START_RE = re.compile(r'^struct\s+(?P<name>\w+)\s*\{')
+TYPE_START_RE = re.compile(r'^(?P<kind>struct|union)\s+(?P<name>\w+)\s*\{')
+NESTED_START_RE = re.compile(r'^(?:struct|union)\s*(?:\w+\s*)?\{')
+STRUCT_SIZE_RE = re.compile(r'/\*\s*size:\s*(?P<size>\d+)')
+ALIGNED_RE = re.compile(r'__aligned__\((?P<align>\d+)\)')
+FUNC_PTR_RE = re.compile(r'\(\s*\*\s*(?P<name>\w+)\s*\)')
+
+
+def split_declaration(decl):
+    # "struct cfs_rq cfs __attribute__((__aligned__(128)))" -> type, name, attributes
+    body, _, attributes = decl.partition('__attribute__')
+    body = body.strip()
+    func_ptr = FUNC_PTR_RE.search(body)
+    if func_ptr:
+        return body, func_ptr.group('name'), attributes.strip()
+    data_type, _, name = body.rpartition(' ')
+    # "flags[4]" and bitfields such as "sched_remote_wakeup:1" are named without the suffix.
+    return data_type.strip(), name.split('[')[0].split(':')[0].lstrip('*'), attributes.strip()
+
+
+def aligned_attribute(attributes):
+    match = ALIGNED_RE.search(attributes or '')
+    return int(match.group('align')) if match else None
+
+
+def parse_struct_layout(file_path, struct_name=None):
+    # Top-level members of the first struct in a pahole dump (or of
+    # struct_name), in offset order, with the struct's size and forced alignment.
+    layout = None
+    depth = 0
+    with open(file_path, 'r') as file:
+        for raw in file:
+            line = raw.strip()
+            if layout is None:
+                match = STRUCT_START_RE.match(line)
+                if match and struct_name in (None, match.group('name')):
+                    layout = {'name': match.group('name'), 'size': None, 'align': None, 'members': []}
+                    depth = 1
+                continue
+            if line.startswith('}'):
+                depth -= line.count('}')
+                if depth == 0:
+                    layout['align'] = aligned_attribute(line)
+                    break
+            size = STRUCT_SIZE_RE.search(line)
+            if size and depth == 1:
+                layout['size'] = int(size.group('size'))
+            member = MEMBER_RE.match(line)
+            if member and depth == 1 and 'XXX' not in line:
+                # A nested anonymous union/struct is one member, recorded at its closing line.
+                data_type, name, attributes = split_declaration(member.group('decl').lstrip('} ').strip())
+                layout['members'].append({
+                    'name': name,
+                    'type': data_type or 'union/struct',
+                    'attributes': attributes,
+                    'decl': member.group('decl').strip(),
+                    'offset': int(member.group('offset')),
+                    'size': int(member.group('size')),
+                    # Bitfields report their storage unit's offset and size.
+                    'bitfield': member.group('bit') is not None,
+                })
+            if line.startswith('}'):
+                depth += line.count('{')
+            else:
+                depth += line.count('{') - line.count('}')
+    if layout is None:
+        raise ValueError(f"No struct {struct_name or 'definition'} found in '{file_path}'")
+    return layout
+
+
+INDEX_VERSION = 2
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def member_entry(decl, offset, size):
+    # [data type, attributes, offset, size] of one member, as struct-parser.py stores it.
+    tokens = decl.split('__attribute__')
+    data_type = " ".join(tokens[0].strip().split(" ")[:-1]).strip()
+    attributes = tokens[1] if len(tokens) == 2 else ''
+    return [data_type, attributes, int(offset), int(size)]
+
+
+def build_struct_index(file_path):
+    # One pass over a pahole dump of any size: {struct: {'kind', 'size', 'members'}}
+    # with members keyed by name. Members of anonymous unions/structs are
+    # reachable by their own name, as in C; members of named inline blocks
+    # as "block.member".
+    index = {}
+    current = None
+    blocks = []
+    with open(file_path, 'r') as file:
+        for raw in file:
+            line = raw.strip()
+            if current is None:
+                match = TYPE_START_RE.match(line)
+                if match:
+                    current = index[match.group('name')] = {'kind': match.group('kind'), 'size': None, 'members': {}}
+                    blocks = [current['members']]
+                continue
+            if NESTED_START_RE.match(line):
+                blocks.append({})
+                continue
+            if line.startswith('}'):
+                if len(blocks) == 1:
+                    current = None
+                    continue
+                inner = blocks.pop()
+                member = MEMBER_RE.match(line)
+                name = split_declaration(member.group('decl').lstrip('} ').strip())[1] if member else ''
+                if name:
+                    blocks[-1].setdefault(name, ['', '', int(member.group('offset')), int(member.group('size'))])
+                    inner = {f"{name}.{key}": value for key, value in inner.items()}
+                for key, value in inner.items():
+                    blocks[-1].setdefault(key, value)
+                continue
+            size = STRUCT_SIZE_RE.search(line)
+            if size and len(blocks) == 1:
+                current['size'] = int(size.group('size'))
+                continue
+            member = MEMBER_RE.match(line)
+            if member and 'XXX' not in line:
+                decl = member.group('decl').strip()
+                blocks[-1].setdefault(split_declaration(decl)[1],
+                                      member_entry(decl, member.group('offset'), member.group('size')))
+    return index
+
+
+def file_digest(file_path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def default_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'kstruct-tuner', 'pahole')
+
+
+def load_struct_index(file_path, cache_dir=None):
+    # The index is cached as JSON under the dump's content hash, so re-runs on
+    # the same vmlinux dump skip the parse. cache_dir=None disables caching.
+    if cache_dir is None:
+        return build_struct_index(file_path)
+    cache_file = os.path.join(cache_dir, f"{file_digest(file_path)}.v{INDEX_VERSION}.json")
+    if os.path.exists(cache_file):
+        with open(cache_file, 'r') as f:
+            return json.load(f)
+    index = build_struct_index(file_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_file, cache_file)
+    return index
+
+
+def split_access_path(label):
+    # "rq->cfs.avg" -> ("rq", "cfs.avg"); unqualified labels have no struct.
+    struct_name, arrow, path = label.partition('->')
+    return (struct_name, path) if arrow else (None, label)
+
+
+def member_struct(data_type):
+    # "struct cfs_rq" -> "cfs_rq"; pointers and other types cannot be descended into.
+    parts = data_type.split()
+    if len(parts) == 2 and parts[0] in ('struct', 'union'):
+        return parts[1]
+    return None
+
+
+def resolve_member(index, struct_name, path):
+    # "cfs.avg.load_avg" in struct_name -> [data type, attributes, offset, size],
+    # the offset counted from the start of struct_name; None if unknown.
+    struct = index.get(struct_name)
+    if struct is None:
+        return None
+    members = struct['members']
+    parts = path.split('.')
+    for k in range(len(parts), 0, -1):
+        entry = members.get('.'.join(parts[:k]))
+        if entry is None:
+            continue
+        if k == len(parts):
+            return entry
+        nested = resolve_member(index, member_struct(entry[0]), '.'.join(parts[k:]))
+        if nested is None:
+            return None
+        return [nested[0], nested[1], entry[2] + nested[2], nested[3]]
+    return None
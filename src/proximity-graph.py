@@ -1,114 +1,810 @@
 import pandas as pd
 import numpy as np
-from multiprocessing import Pool
+from multiprocessing import Pool, shared_memory
+from collections import OrderedDict
+from itertools import islice
 import argparse
+import json
+import os
+import platform
+import time
 
-def process_chunk_window(chunk_data, window_size):
-    field_pairs = {}
-    chunk_data = chunk_data.sort_values('Timestamp')
-    timestamps = chunk_data['Timestamp'].values
-    fields = chunk_data['Field'].values
-    
-    for i in range(len(chunk_data)):
-        current_time = timestamps[i]
-        current_field = fields[i]
-        
-        j = i - 1
-        while j >= 0 and current_time - timestamps[j] <= window_size:
-            if fields[j] != current_field:
-                pair = tuple(sorted([current_field, fields[j]]))
-                field_pairs[pair] = field_pairs.get(pair, 0) + 1
-            j -= 1
-        
-        j = i + 1
-        while j < len(chunk_data) and timestamps[j] - current_time <= window_size:
-            if fields[j] != current_field:
-                pair = tuple(sorted([current_field, fields[j]]))
-                field_pairs[pair] = field_pairs.get(pair, 0) + 1
-            j += 1
-    
-    return field_pairs
-
-
-def process_chunk_stack(chunk_data, stack_distance_threshold):
-    field_pairs = {}
-    access_stack = []
-    
-    for _, row in chunk_data.iterrows():
-        current_field = row['Field']
-        
-        if current_field in access_stack:
-            access_stack.remove(current_field)
-        access_stack.append(current_field)
-        
-        for distance, stack_field in enumerate(reversed(access_stack[:-1]), start=1):
-            if distance > stack_distance_threshold:
-                break
-            if current_field != stack_field:
-                pair = tuple(sorted([current_field, stack_field]))
-                field_pairs[pair] = field_pairs.get(pair, 0) + 1
-    
-    return field_pairs
-
-
-def merge_field_pairs_incrementally(new_pairs, merged_pairs):
-    for pair, count in new_pairs.items():
-        merged_pairs[pair] = merged_pairs.get(pair, 0) + count
-    return merged_pairs
-
-
-def create_adjacency_matrix(field_pairs):
-    fields = sorted(set([field for pair in field_pairs.keys() for field in pair]))
-    adj_matrix = np.zeros((len(fields), len(fields)))
-    field_index = {field: idx for idx, field in enumerate(fields)}
-    
-    for pair, count in field_pairs.items():
-        i, j = field_index[pair[0]], field_index[pair[1]]
-        adj_matrix[i, j] = count
-        adj_matrix[j, i] = count
-    
+import kstruct_io
+import kstruct_metrics
+
+PAIR_BLOCK_SIZE = 1 << 22
+# Partition of events without a --partition_by value, written as "...-none".
+MISSING_PARTITION = -1
+ATTRIBUTION_HEADROOM = 4
+
+
+def encode_fields(fields):
+    if isinstance(fields.dtype, pd.CategoricalDtype):
+        # factorize orders categoricals by category, not by name.
+        fields = pd.Categorical(fields)
+        fields = fields.set_categories(sorted(fields.categories))
+    codes, labels = pd.factorize(fields, sort=True)
+    return codes.astype(np.int32), [str(label) for label in labels]
+
+
+def window_bounds(timestamps, window_size, start=0, stop=None):
+    # End (exclusive) of the window opened by each event in [start, stop).
+    n = len(timestamps)
+    stop = n if stop is None else stop
+    idx = np.arange(start, stop)
+    owned = timestamps[start:stop]
+    hi = np.searchsorted(timestamps, owned + window_size, side='right')
+    hi = np.maximum(hi, idx + 1)
+    # t_i + w rounds differently from t_j - t_i, so settle the edge on the
+    # same difference the scalar scan compared against the window.
+    while True:
+        grow = hi < n
+        grow[grow] = timestamps[hi[grow]] - owned[grow] <= window_size
+        if not grow.any():
+            break
+        hi[grow] += 1
+    while True:
+        shrink = hi > idx + 1
+        shrink[shrink] = timestamps[hi[shrink] - 1] - owned[shrink] > window_size
+        if not shrink.any():
+            break
+        hi[shrink] -= 1
+    return hi
+
+
+def sum_by_key(keys, values):
+    # Sorted unique keys and the summed values of each.
+    order = np.argsort(keys, kind='stable')
+    keys, values = keys[order], values[order]
+    if not len(keys):
+        return keys, values
+    starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+    return keys[starts], np.add.reduceat(values, starts)
+
+
+class PairCounts:
+    # Counts of ordered (a, b) field-code pairs, kept either as a dense
+    # n x n matrix or, when sparse, as sorted unique a * n + b keys.
+    # attribution, when set, is the PairAttribution of the same pairs.
+    def __init__(self, n_fields, sparse=False):
+        self.n_fields = n_fields
+        self.sparse = sparse
+        self.attribution = None
+        if sparse:
+            self.keys = np.zeros(0, dtype=np.int64)
+            self.values = np.zeros(0, dtype=np.int64)
+        else:
+            self.dense = np.zeros((n_fields, n_fields), dtype=np.int64)
+
+    def add_keys(self, keys):
+        keys = np.asarray(keys, dtype=np.int64)
+        if not self.sparse:
+            self.dense += np.bincount(keys, minlength=self.n_fields * self.n_fields).reshape(self.n_fields, self.n_fields)
+            return
+        keys, values = np.unique(keys, return_counts=True)
+        self.merge(keys, values)
+
+    def add_pairs(self, a, b):
+        self.add_keys(a.astype(np.int64) * self.n_fields + b)
+
+    def merge(self, keys, values):
+        self.keys, self.values = sum_by_key(np.concatenate([self.keys, keys]), np.concatenate([self.values, values]))
+
+    def add(self, other):
+        if self.sparse and not other.sparse:
+            rows, cols = np.nonzero(other.dense)
+            self.merge(rows.astype(np.int64) * self.n_fields + cols, other.dense[rows, cols])
+        elif self.sparse:
+            self.merge(other.keys, other.values)
+        else:
+            self.dense += other.dense
+        return self
+
+    def symmetric(self, scale=1):
+        # counts + counts.T, multiplied by scale.
+        result = PairCounts(self.n_fields, self.sparse)
+        if not self.sparse:
+            result.dense = scale * (self.dense + self.dense.T)
+            return result
+        rows, cols = np.divmod(self.keys, self.n_fields)
+        result.merge(np.concatenate([self.keys, cols * self.n_fields + rows]),
+                     scale * np.concatenate([self.values, self.values]))
+        return result
+
+
+class PairAttribution:
+    # Counts of (a, b) field pairs by the function of the access that
+    # completes the pair (the later event of a window pair, the current access
+    # of a stack pair), as sorted unique (a * n + b) * n_functions + f keys.
+    # While counting, each pair keeps its ATTRIBUTION_HEADROOM * top_k heaviest
+    # functions after every block and merge, and finish() keeps top_k; the
+    # rest of a pair's count goes to other_keys/other_values. Memory stays
+    # bounded per pair, pair totals stay exact, and a kept function's count is
+    # a lower bound once a pair has had more functions than were kept.
+    def __init__(self, n_fields, n_functions, top_k):
+        self.n_fields = n_fields
+        self.n_functions = max(n_functions, 1)
+        self.top_k = top_k
+        self.function_labels = None
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.values = np.zeros(0, dtype=np.int64)
+        self.other_keys = np.zeros(0, dtype=np.int64)
+        self.other_values = np.zeros(0, dtype=np.int64)
+
+    def add_triples(self, pair_keys, functions):
+        keys = np.asarray(pair_keys, dtype=np.int64) * self.n_functions + np.asarray(functions, dtype=np.int64)
+        keys, values = np.unique(keys, return_counts=True)
+        self.merge(keys, values)
+
+    def merge(self, keys, values, other_keys=None, other_values=None):
+        self.keys, self.values = sum_by_key(np.concatenate([self.keys, keys]),
+                                            np.concatenate([self.values, values]))
+        if other_keys is not None and len(other_keys):
+            self.other_keys, self.other_values = sum_by_key(np.concatenate([self.other_keys, other_keys]),
+                                                            np.concatenate([self.other_values, other_values]))
+
+    def compact(self, limit=None):
+        # Keep the heaviest functions of every pair, ties to the lower code.
+        limit = ATTRIBUTION_HEADROOM * self.top_k if limit is None else limit
+        pairs = self.keys // self.n_functions
+        order = np.lexsort((self.keys, -self.values, pairs))
+        pairs = pairs[order]
+        starts = np.flatnonzero(np.concatenate(([True], pairs[1:] != pairs[:-1]))) if len(pairs) else pairs
+        rank = np.arange(len(pairs)) - np.repeat(starts, np.diff(np.append(starts, len(pairs))))
+        keep = order[rank < limit]
+        drop = order[rank >= limit]
+        if len(drop):
+            self.other_keys, self.other_values = sum_by_key(
+                np.concatenate([self.other_keys, self.keys[drop] // self.n_functions]),
+                np.concatenate([self.other_values, self.values[drop]]))
+        keep.sort()
+        self.keys, self.values = self.keys[keep], self.values[keep]
+        return self
+
+    def add(self, other):
+        self.merge(other.keys, other.values, other.other_keys, other.other_values)
+        return self.compact()
+
+    def finish(self, scale=1):
+        # Per unordered pair, stored as a * n + b with a < b, scaled like the
+        # pair counts.
+        def fold(pair_keys):
+            a, b = np.divmod(pair_keys, self.n_fields)
+            return np.minimum(a, b) * self.n_fields + np.maximum(a, b)
+
+        result = PairAttribution(self.n_fields, self.n_functions, self.top_k)
+        result.function_labels = self.function_labels
+        pairs, functions = np.divmod(self.keys, self.n_functions)
+        result.merge(fold(pairs) * self.n_functions + functions, scale * self.values,
+                     fold(self.other_keys), scale * self.other_values)
+        return result.compact(self.top_k)
+
+
+class PairHistogram:
+    # Counts of ordered (a, b) field-code pairs split by the first sweep value
+    # (window size or stack threshold) that includes them, as bins x n x n.
+    def __init__(self, n_fields, n_bins):
+        self.n_fields = n_fields
+        self.dense = np.zeros((n_bins, n_fields, n_fields), dtype=np.int64)
+
+    def add_keys(self, keys):
+        self.dense += np.bincount(np.asarray(keys, dtype=np.int64),
+                                  minlength=self.dense.size).reshape(self.dense.shape)
+
+    def add(self, other):
+        self.dense += other.dense
+        return self
+
+    def cumulative(self):
+        # One PairCounts per sweep value: every pair at or below it.
+        result = []
+        for dense in np.cumsum(self.dense, axis=0):
+            counts = PairCounts(self.n_fields)
+            counts.dense = dense
+            result.append(counts)
+        return result
+
+
+def window_pair_counts(timestamps, codes, n_fields, window_size, n_owned=None, sparse=False, functions=None,
+                       attribution=None):
+    # counts[a, b] is the number of event pairs (earlier a, later b) no more
+    # than window_size apart; timestamps must be sorted. Only pairs opened by
+    # the first n_owned events are counted, the rest is halo. With functions
+    # (per-event function codes), pairs are also tallied into attribution.
+    counts = PairCounts(n_fields, sparse)
+    counts.attribution = attribution
+    n = len(timestamps) if n_owned is None else n_owned
+    if n < 1:
+        return counts
+
+    hi = window_bounds(timestamps, window_size, 0, n)
+    lens = hi - np.arange(1, n + 1)
+    total_pairs = int(lens.sum())
+
+    if not sparse and total_pairs > 4 * n * n_fields:
+        # Dense windows: per-field prefix counts beat expanding every pair.
+        first = np.arange(1, n + 1)
+        if attribution is not None:
+            # The same, per (field, function) of the later event.
+            combos = codes[:hi[-1]].astype(np.int64) * attribution.n_functions + functions[:hi[-1]]
+            for combo in np.unique(combos).tolist():
+                b = combo // attribution.n_functions
+                seen = np.concatenate(([0], np.cumsum(combos == combo)))
+                pairs = np.bincount(codes[:n], weights=seen[hi] - seen[first], minlength=n_fields).astype(np.int64)
+                pairs[b] = 0
+                counts.dense[:, b] += pairs
+                rows = np.flatnonzero(pairs)
+                attribution.merge((rows * n_fields + b) * attribution.n_functions + combo % attribution.n_functions,
+                                  pairs[rows])
+            attribution.compact()
+            return counts
+        for b in range(n_fields):
+            seen = np.concatenate(([0], np.cumsum(codes[:hi[-1]] == b)))
+            counts.dense[:, b] += np.bincount(codes[:n], weights=seen[hi] - seen[first], minlength=n_fields).astype(np.int64)
+        np.fill_diagonal(counts.dense, 0)
+        return counts
+
+    ends = np.cumsum(lens)
+    start = 0
+    while start < n:
+        base = ends[start - 1] if start else 0
+        stop = int(np.searchsorted(ends, base + PAIR_BLOCK_SIZE, side='right'))
+        stop = min(max(stop, start + 1), n)
+        block_lens = lens[start:stop]
+        left = np.repeat(np.arange(start, stop), block_lens)
+        offsets = np.cumsum(block_lens) - block_lens
+        right = left + 1 + np.arange(len(left)) - np.repeat(offsets, block_lens)
+        a, b = codes[left], codes[right]
+        keep = a != b
+        counts.add_pairs(a[keep], b[keep])
+        if attribution is not None:
+            attribution.add_triples(a[keep].astype(np.int64) * n_fields + b[keep], functions[right[keep]])
+            attribution.compact()
+        start = stop
+
+    return counts
+
+
+def window_pair_histogram(timestamps, codes, n_fields, window_sizes, n_owned=None):
+    # window_pair_counts for every window size at once: each pair opened by
+    # the first n_owned events is binned by its time delta, compared in the
+    # timestamps' precision as the single-size scan does.
+    limits = np.asarray(window_sizes, dtype=timestamps.dtype)
+    counts = PairHistogram(n_fields, len(limits))
+    n = len(timestamps) if n_owned is None else n_owned
+    if n < 1:
+        return counts
+
+    hi = window_bounds(timestamps, float(window_sizes[-1]), 0, n)
+    lens = hi - np.arange(1, n + 1)
+    ends = np.cumsum(lens)
+    start = 0
+    while start < n:
+        base = ends[start - 1] if start else 0
+        stop = int(np.searchsorted(ends, base + PAIR_BLOCK_SIZE, side='right'))
+        stop = min(max(stop, start + 1), n)
+        block_lens = lens[start:stop]
+        left = np.repeat(np.arange(start, stop), block_lens)
+        offsets = np.cumsum(block_lens) - block_lens
+        right = left + 1 + np.arange(len(left)) - np.repeat(offsets, block_lens)
+        a, b = codes[left], codes[right]
+        keep = a != b
+        bins = np.searchsorted(limits, timestamps[right[keep]] - timestamps[left[keep]], side='left')
+        counts.add_keys((bins * n_fields + a[keep]) * n_fields + b[keep])
+        start = stop
+
+    return counts
+
+
+def stack_pair_counts(codes, n_fields, stack_distance_threshold, n_warmup=0, sparse=False, functions=None,
+                      attribution=None):
+    # counts[a, b] is the number of accesses to a whose LRU stack held b
+    # within stack_distance_threshold distinct fields. The first n_warmup
+    # events only rebuild the stack and are not counted. With functions, each
+    # pair is also tallied into attribution under the function of the access.
+    counts = PairCounts(n_fields, sparse)
+    counts.attribution = attribution
+    depth = max(int(stack_distance_threshold), 0)
+    if depth == 0:
+        return counts
+
+    # Recency order by last access: move-to-front is O(1) and the walk down
+    # the stack stops after `depth` entries.
+    access_stack = OrderedDict()
+    for code in codes[:n_warmup].tolist():
+        access_stack[code] = None
+        access_stack.move_to_end(code)
+
+    def flush(keys, key_functions):
+        counts.add_keys(keys)
+        if attribution is not None:
+            attribution.add_triples(keys, key_functions)
+            attribution.compact()
+
+    keys, key_functions = [], []
+    access_functions = functions[n_warmup:].tolist() if attribution is not None else None
+    for pos, code in enumerate(codes[n_warmup:].tolist()):
+        access_stack[code] = None
+        access_stack.move_to_end(code)
+        row = code * n_fields
+        pairs = [row + other for other in islice(reversed(access_stack), 1, depth + 1)]
+        keys.extend(pairs)
+        if access_functions is not None:
+            key_functions.extend([access_functions[pos]] * len(pairs))
+        if len(keys) >= PAIR_BLOCK_SIZE:
+            flush(keys, key_functions)
+            keys, key_functions = [], []
+    if keys:
+        flush(keys, key_functions)
+
+    return counts
+
+
+def stack_pair_histogram(codes, n_fields, thresholds, n_warmup=0):
+    # stack_pair_counts for every threshold at once: each pair is binned by
+    # its stack distance (1 for the most recent other field).
+    counts = PairHistogram(n_fields, len(thresholds))
+    depth = max(int(thresholds[-1]), 0)
+    if depth == 0:
+        return counts
+    depth_bin = np.searchsorted(np.asarray(thresholds), np.arange(depth + 1), side='left').tolist()
+    plane = n_fields * n_fields
+
+    access_stack = OrderedDict()
+    for code in codes[:n_warmup].tolist():
+        access_stack[code] = None
+        access_stack.move_to_end(code)
+
+    keys = []
+    for code in codes[n_warmup:].tolist():
+        access_stack[code] = None
+        access_stack.move_to_end(code)
+        row = code * n_fields
+        keys.extend([depth_bin[distance] * plane + row + other
+                     for distance, other in enumerate(islice(reversed(access_stack), 1, depth + 1), 1)])
+        if len(keys) >= PAIR_BLOCK_SIZE:
+            counts.add_keys(keys)
+            keys = []
+    if keys:
+        counts.add_keys(keys)
+
+    return counts
+
+
+def stack_halo_start(codes, start, stack_distance_threshold, n_fields):
+    # Earliest event needed to rebuild the top of the LRU stack at `start`:
+    # the last access of the (threshold + 1)-th most recent distinct field.
+    need = min(max(int(stack_distance_threshold), 0) + 1, n_fields)
+    seen = set()
+    pos = start
+    block = max(4 * need, 1024)
+    while pos > 0:
+        lo = max(pos - block, 0)
+        recent = codes[lo:pos][::-1]
+        for code in pd.unique(recent):
+            if code in seen:
+                continue
+            seen.add(code)
+            if len(seen) >= need:
+                return pos - 1 - int(np.flatnonzero(recent == code)[0])
+        pos = lo
+        block *= 2
+    return 0
+
+
+def create_adjacency_matrix(labels, counts):
+    # Fields that never pair with another field are left out, as before.
+    if counts.sparse:
+        rows, cols = np.divmod(counts.keys, counts.n_fields)
+        present = np.unique(rows)
+        return kstruct_io.SparseAdjacency([labels[i] for i in present], np.searchsorted(present, rows),
+                                          np.searchsorted(present, cols), counts.values)
+    present = np.flatnonzero((counts.dense > 0).any(axis=1))
+    fields = [labels[i] for i in present]
+    adj_matrix = counts.dense[np.ix_(present, present)].astype(np.float64)
     return pd.DataFrame(adj_matrix, index=fields, columns=fields)
 
 
-def process_in_chunks(filename, method, param, output_file, n_jobs):
-    merged_field_pairs = {}
+def finish_pair_counts(method, counts):
+    # Window counts see each event pair from both of its events, as in the
+    # original scan; stack counts once per access.
+    scale = 2 if method == "window" else 1
+    result = counts.symmetric(scale)
+    if counts.attribution is not None:
+        result.attribution = counts.attribution.finish(scale)
+    return result
+
+
+def pair_entries(counts):
+    # Nonzero (row < col) entries of finished, symmetric counts.
+    if counts.sparse:
+        rows, cols = np.divmod(counts.keys, counts.n_fields)
+        upper = rows < cols
+        return rows[upper], cols[upper], counts.values[upper]
+    rows, cols = np.nonzero(np.triu(counts.dense, 1))
+    return rows, cols, counts.dense[rows, cols]
+
+
+def write_attribution(attribution, labels, path):
+    # Finished attribution as a,b,function,weight lines: each edge's kept
+    # functions, heaviest first, then its "[other]" remainder.
+    pairs, functions = np.divmod(attribution.keys, attribution.n_functions)
+    n_named = len(attribution.function_labels)
+    pairs = np.concatenate([pairs, attribution.other_keys])
+    functions = np.concatenate([functions, np.full(len(attribution.other_keys), n_named)])
+    weights = np.concatenate([attribution.values, attribution.other_values])
+    order = np.lexsort((functions, -weights, functions == n_named, pairs))
+    rows, cols = np.divmod(pairs[order], attribution.n_fields)
+    labels = np.asarray(labels, dtype=object)
+    names = np.asarray(list(attribution.function_labels) + [kstruct_io.ATTRIBUTION_OTHER], dtype=object)
+    kstruct_io.write_attribution(labels[rows], labels[cols], names[functions[order]], weights[order], path)
+
+
+def qualify_fields(codes, labels, struct_codes, structs):
+    # With more than one struct in the trace, fields become "struct->field".
+    pairs = struct_codes.astype(np.int64) * len(labels) + codes
+    present, codes = np.unique(pairs, return_inverse=True)
+    return codes.astype(np.int32), [f"{structs[p // len(labels)]}->{labels[p % len(labels)]}" for p in present]
+
+
+def load_events(filename, method, partition_by=None, with_functions=False):
+    columns = ['Timestamp', 'Field'] + ([partition_by] if partition_by else []) + (['Function'] if with_functions else [])
+    has_struct = 'Struct' in kstruct_io.table_columns(filename)
+    events = kstruct_io.read_columns(filename, columns + (['Struct'] if has_struct else []),
+                                     dtype={'Timestamp': 'float32', 'Field': 'category', 'Struct': 'category',
+                                            'Function': 'category'})
+    timestamps = np.asarray(events['Timestamp'])
+    codes, labels = encode_fields(events['Field'])
+    if has_struct:
+        struct_codes, structs = encode_fields(events['Struct'])
+        if len(structs) > 1:
+            codes, labels = qualify_fields(codes, labels, struct_codes, structs)
+    partition = np.zeros(len(codes), dtype=np.int64)
+    if partition_by:
+        # Events without a value (Runqueue_CPU of structs other than rq) share one partition.
+        values = pd.to_numeric(pd.Series(np.asarray(events[partition_by])), errors='coerce')
+        partition = values.fillna(MISSING_PARTITION).to_numpy(dtype=np.int64)
+    # Events are grouped by partition; within one, window mode needs time
+    # order and stack mode keeps log order.
+    within = timestamps if method == "window" else np.arange(len(codes))
+    order = np.lexsort((within, partition))
+    timestamps, codes, partition = timestamps[order], codes[order], partition[order]
+    functions, function_labels = None, []
+    if with_functions:
+        functions, function_labels = encode_fields(events['Function'].astype(str))
+        functions = np.ascontiguousarray(functions[order])
+    starts = np.flatnonzero(np.concatenate(([True], partition[1:] != partition[:-1]))) if len(partition) else []
+    bounds = list(starts) + [len(partition)]
+    partitions = [(int(partition[begin]), int(begin), int(end)) for begin, end in zip(bounds, bounds[1:])]
+    return (np.ascontiguousarray(timestamps, dtype=np.float32), np.ascontiguousarray(codes), labels, partitions,
+            functions, function_labels)
+
+
+_shared_events = {}
+
+
+def share_array(array):
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+    return shm
+
+
+def attach_shared_events(timestamps_name, codes_name, n_events, n_fields, sparse=False, functions_name=None,
+                         n_functions=0, top_k=0):
+    timestamps_shm = shared_memory.SharedMemory(name=timestamps_name)
+    codes_shm = shared_memory.SharedMemory(name=codes_name)
+    _shared_events['segments'] = (timestamps_shm, codes_shm)
+    _shared_events['timestamps'] = np.ndarray((n_events,), dtype=np.float32, buffer=timestamps_shm.buf)
+    _shared_events['codes'] = np.ndarray((n_events,), dtype=np.int32, buffer=codes_shm.buf)
+    _shared_events['n_fields'] = n_fields
+    _shared_events['sparse'] = sparse
+    _shared_events['functions'] = None
+    if functions_name:
+        functions_shm = shared_memory.SharedMemory(name=functions_name)
+        _shared_events['segments'] += (functions_shm,)
+        _shared_events['functions'] = np.ndarray((n_events,), dtype=np.int32, buffer=functions_shm.buf)
+        _shared_events['n_functions'] = n_functions
+        _shared_events['top_k'] = top_k
+
+
+def count_range(task):
+    # Each chunk owns [start, stop) of its partition [begin, end) and reads
+    # the neighbouring events its pairs reach into straight from shared
+    # memory, so nothing is lost at chunk boundaries and nothing crosses
+    # partitions.
+    # A tuple of parameters is a sweep, counted as one histogram.
+    method, param, part, begin, end, start, stop = task
+    timestamps = _shared_events['timestamps'][begin:end]
+    codes = _shared_events['codes'][begin:end]
+    n_fields, sparse = _shared_events['n_fields'], _shared_events['sparse']
+    start, stop = start - begin, stop - begin
+    if isinstance(param, tuple):
+        if method == "window":
+            halo_end = int(window_bounds(timestamps, param[-1], stop - 1, stop)[0])
+            return part, window_pair_histogram(timestamps[start:halo_end], codes[start:halo_end], n_fields, param,
+                                               stop - start)
+        halo_start = stack_halo_start(codes, start, param[-1], n_fields)
+        return part, stack_pair_histogram(codes[halo_start:stop], n_fields, param, start - halo_start)
+    functions, attribution = _shared_events['functions'], None
+    if functions is not None:
+        functions = functions[begin:end]
+        attribution = PairAttribution(n_fields, _shared_events['n_functions'], _shared_events['top_k'])
+    if method == "window":
+        halo_end = int(window_bounds(timestamps, param, stop - 1, stop)[0])
+        return part, window_pair_counts(timestamps[start:halo_end], codes[start:halo_end], n_fields, param,
+                                        stop - start, sparse,
+                                        None if functions is None else functions[start:halo_end], attribution)
+    halo_start = stack_halo_start(codes, start, param, n_fields)
+    return part, stack_pair_counts(codes[halo_start:stop], n_fields, param, start - halo_start, sparse,
+                                   None if functions is None else functions[halo_start:stop], attribution)
 
-    chunk_iter = pd.read_csv(filename, chunksize=100000, dtype={'Timestamp': 'float32', 'Field': 'category'})
-    
-    with Pool(n_jobs) as pool:
-        results = []
-        for chunk in chunk_iter:
-            if method == "window":
-                results.append(pool.apply_async(process_chunk_window, (chunk, param)))
-            elif method == "stack":
-                results.append(pool.apply_async(process_chunk_stack, (chunk, param)))
-        
-        for result in results:
-            new_field_pairs = result.get()
-            merged_field_pairs = merge_field_pairs_incrementally(new_field_pairs, merged_field_pairs)
-    
-    adj_matrix = create_adjacency_matrix(merged_field_pairs)
-    adj_matrix.to_csv(output_file)
+
+def timed_count_range(task):
+    start = time.perf_counter()
+    part, counts = count_range(task)
+    return part, counts, os.getpid(), time.perf_counter() - start, task[-1] - task[-2]
+
+
+def partition_path(output_file, partition_by, key):
+    # log.graph.csv -> log.graph.Runqueue_CPU-3.csv, log.graph.kcol -> log.graph.Runqueue_CPU-3.kcol
+    base, dot, ext = output_file.rstrip('/').rpartition('.')
+    if not dot or '/' in ext:
+        base, ext = output_file.rstrip('/'), ''
+    return f"{base}.{partition_by}-{key}" + (f".{ext}" if ext else '')
+
+
+def count_in_chunks(filename, method, param, n_jobs, chunk_size=100000, sparse=False, partition_by=None,
+                    metrics=kstruct_metrics.DISABLED, attribution_top_k=None):
+    # With attribution_top_k, the combined counts also carry a PairAttribution
+    # (counts.attribution, its function names in .function_labels).
+    attributing = bool(attribution_top_k) and not isinstance(param, tuple)
+    with metrics.phase("read"):
+        timestamps, codes, labels, partitions, functions, function_labels = load_events(
+            filename, method, partition_by, attributing)
+    n_events, n_fields = len(codes), len(labels)
+    field_events = np.bincount(codes, minlength=n_fields).astype(np.int64)
+    if isinstance(param, tuple):
+        counts = PairHistogram(n_fields, len(param))
+        partition_counts = None
+    else:
+        counts = PairCounts(n_fields, sparse)
+        # Sparse whatever the combined counts are: partitions x fields^2 dense
+        # matrices do not fit for per-CPU partitions of a large struct.
+        partition_counts = [PairCounts(n_fields, True) for _ in partitions] if partition_by else None
+    attribution = PairAttribution(n_fields, len(function_labels), attribution_top_k) if attributing else None
+
+    tasks = [(method, param, part, begin, end, start, min(start + chunk_size, end))
+             for part, (_, begin, end) in enumerate(partitions)
+             for start in range(begin, end, chunk_size)]
+    segments = [share_array(timestamps), share_array(codes)] + ([share_array(functions)] if attributing else [])
+    try:
+        with metrics.phase(f"{method}_scan"), Pool(
+                n_jobs, initializer=attach_shared_events,
+                initargs=(segments[0].name, segments[1].name, n_events, n_fields, sparse,
+                          segments[2].name if attributing else None, len(function_labels),
+                          attribution_top_k)) as pool:
+            for part, chunk_counts, worker, seconds, events in pool.imap_unordered(timed_count_range, tasks):
+                metrics.chunk(worker, seconds, events=events)
+                if partition_counts is not None:
+                    partition_counts[part].add(chunk_counts)
+                counts.add(chunk_counts)
+                if attribution is not None:
+                    attribution.add(chunk_counts.attribution)
+    finally:
+        for shm in segments:
+            shm.close()
+            shm.unlink()
+    if attribution is not None:
+        attribution.function_labels = function_labels
+        counts.attribution = attribution
+    if metrics.enabled:
+        metrics.count(events=n_events, fields=n_fields, partitions=len(partitions), chunks=len(tasks),
+                      pairs=int((counts.values if getattr(counts, 'sparse', False) else counts.dense).sum()))
+        if attribution is not None:
+            metrics.count(functions=len(function_labels), attribution_entries=len(attribution.keys))
+    return labels, field_events, partitions, counts, partition_counts
+
+
+def process_in_chunks(filename, method, param, output_file, n_jobs, chunk_size=100000, sparse=False,
+                      partition_by=None, aggregate_out=None, metrics=kstruct_metrics.DISABLED,
+                      attribution_out=None, attribution_top_k=5):
+    labels, field_events, partitions, counts, partition_counts = count_in_chunks(
+        filename, method, param, n_jobs, chunk_size, sparse, partition_by, metrics,
+        attribution_top_k if attribution_out else None)
+    with metrics.phase("matrix_build"):
+        finished = finish_pair_counts(method, counts)
+        adj_matrix = create_adjacency_matrix(labels, finished)
+    if metrics.enabled:
+        metrics.count(edges=int((adj_matrix.nnz if sparse else np.count_nonzero(adj_matrix.to_numpy())) // 2))
+    with metrics.phase("write"):
+        kstruct_io.write_adjacency(adj_matrix, output_file)
+    if aggregate_out:
+        events = int(field_events.sum())
+        meta = {
+            'method': method,
+            'param': param,
+            'events': events,
+            'inputs': [{'file': os.path.abspath(filename), 'host': platform.node(), 'events': events,
+                        'partition_by': partition_by}],
+        }
+        aggregate = kstruct_io.make_aggregate(labels, field_events, *pair_entries(finished), meta)
+        with metrics.phase("write_aggregate"):
+            kstruct_io.write_aggregate(aggregate, aggregate_out)
+    if attribution_out:
+        with metrics.phase("write_attribution"):
+            write_attribution(finished.attribution, labels, attribution_out)
+    if partition_counts is not None:
+        with metrics.phase("partition_matrices"):
+            for (key, _, _), part_counts in zip(partitions, partition_counts):
+                part_matrix = create_adjacency_matrix(labels, finish_pair_counts(method, part_counts))
+                if not sparse:
+                    part_matrix = part_matrix.to_dense()
+                key = 'none' if key == MISSING_PARTITION else key
+                kstruct_io.write_adjacency(part_matrix, partition_path(output_file, partition_by, key))
+
+
+def adjusted_rand_index(a, b):
+    # Agreement of two clusterings of the same fields, 1.0 for identical ones.
+    n = len(a)
+    if n < 2:
+        return 1.0
+    _, a = np.unique(a, return_inverse=True)
+    _, b = np.unique(b, return_inverse=True)
+    contingency = np.bincount(a * (b.max() + 1) + b)
+    pairs = lambda x: float((x * (x - 1) // 2).sum())
+    index = pairs(contingency)
+    row, col = pairs(np.bincount(a)), pairs(np.bincount(b))
+    expected = row * col / (n * (n - 1) / 2)
+    maximum = (row + col) / 2
+    return 1.0 if maximum == expected else (index - expected) / (maximum - expected)
+
+
+def rank_correlation(order_a, order_b):
+    # Spearman correlation of the positions of the fields both orders share.
+    common = set(order_a) & set(order_b)
+    if len(common) < 2:
+        return 1.0
+    rank_a = np.array([i for i, field in enumerate(f for f in order_a if f in common)], dtype=np.float64)
+    position = {field: i for i, field in enumerate(f for f in order_b if f in common)}
+    rank_b = np.array([position[field] for field in order_a if field in common], dtype=np.float64)
+    if rank_a.std() == 0 or rank_b.std() == 0:
+        return 1.0
+    return float(np.corrcoef(rank_a, rank_b)[0, 1])
+
+
+SWEEP_TOP_PAIRS = 20
+
+
+def process_sweep(filename, method, values, output_file, n_jobs, chunk_size=100000, sparse=False,
+                  partition_by=None, metrics=kstruct_metrics.DISABLED):
+    # One scan for all values; each matrix goes next to output_file, e.g.
+    # log.graph.window_size-5e-06.csv.
+    clustering = kstruct_io.import_script("hierarchical-clustering")
+    values = tuple(sorted(set(values)))
+    labels, _, _, histogram, _ = count_in_chunks(filename, method, values, n_jobs, chunk_size, False, partition_by,
+                                                 metrics)
+    name = "window_size" if method == "window" else "stack_distance_threshold"
+
+    with metrics.phase("sweep_matrices"):
+        report = []
+        previous = None
+        for value, counts in zip(values, histogram.cumulative()):
+            graph = kstruct_io.SparseAdjacency.from_dense(
+                create_adjacency_matrix(labels, finish_pair_counts(method, counts)))
+            path = partition_path(output_file, name, value)
+            kstruct_io.write_adjacency(graph if sparse else graph.to_dense(), path)
+            assignment, order, top_pairs = {}, [], set()
+            if graph.nnz:
+                order, clusters = clustering.cluster_graph(graph)
+                for cluster_id, fields in clusters.items():
+                    assignment.update((field, cluster_id) for field in fields)
+                top_pairs = {(a, b) for a, b, _ in clustering.compute_top_pairs(graph, SWEEP_TOP_PAIRS)}
+            entry = {
+                'method': method,
+                name: value,
+                'output_file': path,
+                'fields': graph.n,
+                'edges': int(graph.nnz // 2),
+                'total_weight': float(graph.weights.sum() / 2),
+                'clusters': len(set(assignment.values())),
+                'adjusted_rand_index': None,
+                'order_rank_correlation': None,
+                'top_pairs_overlap': None,
+            }
+            if previous is not None:
+                # Stability against the previous (smaller) value.
+                prev_assignment, prev_order, prev_top = previous
+                common = sorted(set(prev_assignment) & set(assignment))
+                entry['adjusted_rand_index'] = adjusted_rand_index(np.array([prev_assignment[f] for f in common]),
+                                                                   np.array([assignment[f] for f in common]))
+                entry['order_rank_correlation'] = rank_correlation(prev_order, order)
+                union = prev_top | top_pairs
+                entry['top_pairs_overlap'] = len(prev_top & top_pairs) / len(union) if union else 1.0
+            report.append(entry)
+            previous = assignment, order, top_pairs
+    return report
+
+
+def write_sweep_report(reports, report_file):
+    with open(report_file, 'w') as f:
+        json.dump(reports, f, indent=2)
+    for entry in reports:
+        name = 'window_size' if entry['method'] == 'window' else 'stack_distance_threshold'
+        stability = '-' if entry['adjusted_rand_index'] is None else (
+            f"ARI {entry['adjusted_rand_index']:.3f}, order rho {entry['order_rank_correlation']:.3f}, "
+            f"top-{SWEEP_TOP_PAIRS} pair overlap {entry['top_pairs_overlap']:.2f}")
+        print(f"{entry['method']} {name}={entry[name]}: {entry['fields']} fields, {entry['edges']} edges, "
+              f"{entry['clusters']} clusters; vs previous: {stability}")
 
 
 def main():
 
     parser = argparse.ArgumentParser(description="Generate adjacency matrix based on method.")
 
-    parser.add_argument("--method", choices=["window", "stack"], required=True,
-                        help="Method to use: 'window' or 'stack'.")
+    parser.add_argument("--method", choices=["window", "stack"],
+                        help="Method to use: 'window' or 'stack'. Not needed with a sweep.")
     parser.add_argument("--window_size", type=float, default=3e-6, help="Window size for 'window' method.")
     parser.add_argument("--stack_distance_threshold", type=int, default=10, help="Stack distance threshold for 'stack' method.")
     parser.add_argument("--n_jobs", type=int, default=4, help="Number of parallel jobs.")
-    parser.add_argument("--input_file", type=str, required=True, help="Input CSV file.")
-    parser.add_argument("--output_file", type=str, required=True, help="Output CSV file.")
+    parser.add_argument("--chunk_size", type=int, default=100000,
+                        help="Events owned by each parallel chunk (neighbouring events are shared as halo).")
+    parser.add_argument("--input_file", type=str, required=True, help="Input CSV file or .kcol columnar store.")
+    parser.add_argument("--output_file", type=str, required=True, help="Output CSV file, or a .kcol path for the columnar format.")
+    parser.add_argument("--sparse", action="store_true",
+                        help="Count pairs sparsely and write only nonzero edges (a,b,weight triplets, or a .kcol edge store).")
+    parser.add_argument("--partition_by", choices=["Runqueue_CPU", "CPU_ID", "Process_ID"], default=None,
+                        help="Count pairs only within each partition of the events, in parallel; writes the combined "
+                             "matrix to --output_file and one matrix per partition next to it.")
+    parser.add_argument("--sweep_window_sizes", type=float, nargs="+", default=None,
+                        help="Window sizes to sweep in one pass; one matrix per size is written next to --output_file.")
+    parser.add_argument("--sweep_thresholds", type=int, nargs="+", default=None,
+                        help="Stack distance thresholds to sweep in one pass; one matrix per threshold.")
+    parser.add_argument("--sweep_report", type=str, default="sweep_report.json",
+                        help="JSON report of a sweep: edges, clusters and cluster stability (adjusted Rand index "
+                             "against the previous value) per parameter.")
+    parser.add_argument("--aggregate_out", type=str, default=None,
+                        help="Also write the pair counts and per-field event totals as a partial aggregate (.npz) "
+                             "for merge-aggregates.py.")
+    parser.add_argument("--attribution_out", type=str, default=None,
+                        help="Also write, per edge, the functions whose accesses complete its pairs as "
+                             "a,b,function,weight lines (for hierarchical-clustering.py --attribution).")
+    parser.add_argument("--attribution_top_k", type=int, default=5,
+                        help="Functions kept per edge in --attribution_out; the rest is summed as '[other]'.")
+
+    kstruct_metrics.add_arguments(parser)
 
     args = parser.parse_args()
-    
+    metrics = kstruct_metrics.StageMetrics.from_args("proximity-graph", args)
+
+    if args.sweep_window_sizes or args.sweep_thresholds:
+        if args.aggregate_out:
+            parser.error("--aggregate_out holds one parameter's counts and cannot be combined with a sweep")
+        if args.attribution_out:
+            parser.error("--attribution_out cannot be combined with a sweep")
+        reports = []
+        if args.sweep_window_sizes:
+            reports += process_sweep(args.input_file, "window", args.sweep_window_sizes, args.output_file,
+                                     args.n_jobs, args.chunk_size, args.sparse, args.partition_by, metrics)
+        if args.sweep_thresholds:
+            reports += process_sweep(args.input_file, "stack", args.sweep_thresholds, args.output_file,
+                                     args.n_jobs, args.chunk_size, args.sparse, args.partition_by, metrics)
+        write_sweep_report(reports, args.sweep_report)
+        metrics.write()
+        return
+    if args.method is None:
+        parser.error("--method is required unless --sweep_window_sizes or --sweep_thresholds is given")
+    if args.attribution_top_k < 1:
+        parser.error("--attribution_top_k must be at least 1")
+
     if args.method == "window":
-        process_in_chunks(args.input_file, "window", args.window_size, args.output_file, args.n_jobs)
+        process_in_chunks(args.input_file, "window", args.window_size, args.output_file, args.n_jobs,
+                          args.chunk_size, args.sparse, args.partition_by, args.aggregate_out, metrics,
+                          args.attribution_out, args.attribution_top_k)
     elif args.method == "stack":
-        process_in_chunks(args.input_file, "stack", args.stack_distance_threshold, args.output_file, args.n_jobs)
+        process_in_chunks(args.input_file, "stack", args.stack_distance_threshold, args.output_file, args.n_jobs,
+                          args.chunk_size, args.sparse, args.partition_by, args.aggregate_out, metrics,
+                          args.attribution_out, args.attribution_top_k)
+    metrics.write()
 
 if __name__ == "__main__":
     main()
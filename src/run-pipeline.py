@@ -0,0 +1,215 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import kstruct_io
+import kstruct_metrics
+from pahole import default_cache_dir as pahole_cache_dir, file_digest, load_struct_index
+
+struct_parser = kstruct_io.import_script("struct-parser")
+proximity = kstruct_io.import_script("proximity-graph")
+clustering = kstruct_io.import_script("hierarchical-clustering")
+heatmap = kstruct_io.import_script("gen-heatmap")
+
+# Bump when a stage's cached output changes meaning or format.
+PIPELINE_CACHE_VERSION = 2
+
+
+def default_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'kstruct-tuner', 'pipeline')
+
+
+def stage_key(stage, inputs, params):
+    # Content address of a stage output: the hashes (or upstream keys) of its
+    # inputs and the parameters that change its result.
+    payload = json.dumps({'stage': stage, 'version': PIPELINE_CACHE_VERSION, 'inputs': inputs, 'params': params},
+                         sort_keys=True)
+    return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+
+
+class StageCache:
+    # One directory per stage output, <cache_dir>/<stage>/<key>/, written
+    # under a temporary name and renamed into place once complete.
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.log = []
+
+    def run(self, stage, key, build):
+        path = os.path.join(self.cache_dir, stage, key)
+        if os.path.isdir(path):
+            self.log.append({'stage': stage, 'key': key, 'path': path, 'cached': True, 'seconds': 0.0})
+            print(f"{stage}: cached ({key[:12]})")
+            return path, True
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = tempfile.mkdtemp(prefix=f".{key}.", dir=os.path.dirname(path))
+        start = time.perf_counter()
+        try:
+            build(tmp_path)
+            try:
+                os.replace(tmp_path, path)
+            except OSError:
+                # Another run stored the same key first; its output is identical.
+                if not os.path.isdir(path):
+                    raise
+                shutil.rmtree(tmp_path, ignore_errors=True)
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        seconds = time.perf_counter() - start
+        self.log.append({'stage': stage, 'key': key, 'path': path, 'cached': False, 'seconds': seconds})
+        print(f"{stage}: computed in {seconds:.2f} s ({key[:12]})")
+        return path, False
+
+
+def parse_stage(args, cache, metrics):
+    inputs = {'log': file_digest(args.log_file), 'pahole': file_digest(args.pahole_file)}
+    key = stage_key('parse', inputs, {'exclude_cross_cpu': args.exclude_cross_cpu})
+
+    def build(out_dir):
+        table = os.path.join(out_dir, 'access.kcol')
+        struct_index = load_struct_index(args.pahole_file, None if args.no_cache else pahole_cache_dir())
+        if args.n_jobs > 1 and not struct_parser.is_compressed(args.log_file):
+            struct_parser.parse_in_parallel(args.log_file, struct_index, table, args.n_jobs, args.exclude_cross_cpu,
+                                            metrics=metrics)
+            return
+        with metrics.phase('parse'):
+            entries = struct_parser.enrich_entries(struct_parser.iter_log_entries(args.log_file), struct_index)
+            if args.exclude_cross_cpu:
+                entries = struct_parser.exclude_cross_cpu(entries)
+            struct_parser.write_entries(entries, table)
+
+    path, _ = cache.run('parse', key, build)
+    # Handed on as a memory-mapped columnar store; nothing is re-parsed.
+    return key, os.path.join(path, 'access.kcol')
+
+
+def proximity_stage(args, cache, metrics, parse_key, table):
+    param = args.window_size if args.method == "window" else args.stack_distance_threshold
+    key = stage_key('proximity', {'parse': parse_key},
+                    {'method': args.method, 'param': param, 'partition_by': args.partition_by})
+    graph = None
+
+    def build(out_dir):
+        nonlocal graph
+        labels, _, _, counts, _ = proximity.count_in_chunks(table, args.method, param, args.n_jobs, args.chunk_size,
+                                                            args.sparse, args.partition_by, metrics)
+        with metrics.phase('matrix_build'):
+            graph = proximity.create_adjacency_matrix(labels, proximity.finish_pair_counts(args.method, counts))
+            if not isinstance(graph, kstruct_io.SparseAdjacency):
+                graph = kstruct_io.SparseAdjacency.from_dense(graph)
+        kstruct_io.write_adjacency(graph, os.path.join(out_dir, 'graph.kcol'))
+
+    path, cached = cache.run('proximity', key, build)
+    if cached:
+        graph = kstruct_io.read_sparse_adjacency(os.path.join(path, 'graph.kcol'))
+    return key, graph
+
+
+def clustering_stage(args, cache, metrics, proximity_key, graph):
+    key = stage_key('clustering', {'proximity': proximity_key},
+                    {'top_n': args.top_n, 'per_field_top_k': args.per_field_top_k})
+
+    def build(out_dir):
+        with metrics.phase('clustering'):
+            insights = clustering.compute_insights(graph, args.top_n, args.per_field_top_k)
+        clustering.write_text_insights(insights, os.path.join(out_dir, 'insights.out'))
+        with open(os.path.join(out_dir, 'insights.json'), 'w') as jf:
+            json.dump(clustering.build_json_payload(insights), jf, indent=2)
+
+    path, _ = cache.run('clustering', key, build)
+    return path
+
+
+def heatmap_stage(args, cache, metrics, proximity_key, graph, insights_path):
+    order, clusters = heatmap.load_insights(insights_path)
+    # Keyed on the field order and clusters only, so --top_n does not redraw it.
+    layout = hashlib.blake2b(json.dumps([order, sorted(clusters.items())]).encode(), digest_size=16).hexdigest()
+    key = stage_key('heatmap', {'proximity': proximity_key, 'order': layout},
+                    {'max_cells': args.max_cells, 'text_max_fields': args.text_max_fields,
+                     'png': args.heatmap_png and args.image_size})
+
+    def build(out_dir):
+        with metrics.phase('render'):
+            df_percentage, view = heatmap.build_view(graph, order, clusters, False, None, args.max_cells)
+            title = heatmap.TITLE.format(view=view)
+            fig = heatmap.build_figure(df_percentage, title, args.text_max_fields)
+            fig.write_html(os.path.join(out_dir, 'heatmap.html'))
+            if args.heatmap_png:
+                heatmap.write_static(df_percentage, os.path.join(out_dir, 'heatmap.png'), title,
+                                     args.text_max_fields, args.image_size)
+
+    path, _ = cache.run('heatmap', key, build)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run parse, proximity graph, clustering and heatmap in one process, reusing cached stage outputs."
+    )
+    parser.add_argument("log_file", help="Trace to parse (plain, gzip or zstd).")
+    parser.add_argument("pahole_file", help="pahole output for the traced structs.")
+    parser.add_argument("--output_dir", "-o", default="pipeline_out",
+                        help="Directory for graph.csv, insights.out/json, heatmap.html and manifest.json.")
+    parser.add_argument("--cache_dir", default=default_cache_dir(),
+                        help="Stage output cache, keyed by input hashes and stage parameters (default: %(default)s).")
+    parser.add_argument("--no_cache", action="store_true", help="Compute every stage and keep nothing afterwards.")
+    parser.add_argument("--exclude_cross_cpu", action="store_true", help="Exclude cross-CPU accesses.")
+    parser.add_argument("--n_jobs", type=int, default=4, help="Parallel jobs for parsing and pair counting.")
+    parser.add_argument("--method", choices=["window", "stack"], default="window",
+                        help="Method to use: 'window' or 'stack'.")
+    parser.add_argument("--window_size", type=float, default=3e-6, help="Window size for 'window' method.")
+    parser.add_argument("--stack_distance_threshold", type=int, default=10, help="Stack distance threshold for 'stack' method.")
+    parser.add_argument("--chunk_size", type=int, default=100000, help="Events owned by each parallel chunk.")
+    parser.add_argument("--partition_by", choices=["Runqueue_CPU", "CPU_ID", "Process_ID"], default=None,
+                        help="Count pairs only within each partition of the events.")
+    parser.add_argument("--sparse", action="store_true",
+                        help="Count pairs sparsely and write graph.csv as a,b,weight edges.")
+    parser.add_argument("--top_n", type=int, default=20, help="How many top pairs and inter-cluster links to include.")
+    parser.add_argument("--per_field_top_k", type=int, default=3, help="Top-k partners to report per field.")
+    parser.add_argument("--no_heatmap", action="store_true", help="Stop after clustering.")
+    parser.add_argument("--max_cells", type=int, default=500, help="Most heatmap cells per axis.")
+    parser.add_argument("--text_max_fields", type=int, default=60, help="Heatmap cell text up to this many fields.")
+    parser.add_argument("--heatmap_png", action="store_true", help="Also write heatmap.png.")
+    parser.add_argument("--image_size", type=int, default=1024, help="Approximate side of heatmap.png in pixels.")
+    kstruct_metrics.add_arguments(parser)
+
+    args = parser.parse_args()
+    metrics = kstruct_metrics.StageMetrics.from_args("run-pipeline", args)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    with tempfile.TemporaryDirectory(prefix="kstruct-pipeline-") as scratch:
+        cache = StageCache(scratch if args.no_cache else args.cache_dir)
+        parse_key, table = parse_stage(args, cache, metrics)
+        proximity_key, graph = proximity_stage(args, cache, metrics, parse_key, table)
+        with metrics.phase('write'):
+            kstruct_io.write_adjacency(graph if args.sparse else graph.to_dense(),
+                                       os.path.join(args.output_dir, 'graph.csv'))
+        insights_path = clustering_stage(args, cache, metrics, proximity_key, graph)
+        outputs = [os.path.join(insights_path, name) for name in ('insights.out', 'insights.json')]
+        if not args.no_heatmap and graph.nnz:
+            heatmap_path = heatmap_stage(args, cache, metrics, proximity_key, graph,
+                                         os.path.join(insights_path, 'insights.json'))
+            outputs += [os.path.join(heatmap_path, name) for name in sorted(os.listdir(heatmap_path))]
+        for output in outputs:
+            shutil.copyfile(output, os.path.join(args.output_dir, os.path.basename(output)))
+
+    manifest = {
+        'log_file': os.path.abspath(args.log_file),
+        'pahole_file': os.path.abspath(args.pahole_file),
+        'cache_dir': None if args.no_cache else os.path.abspath(args.cache_dir),
+        'stages': cache.log,
+    }
+    with open(os.path.join(args.output_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    print(f"Pipeline outputs written to {args.output_dir}")
+    metrics.write()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,60 @@
 import csv
 import argparse
+import gzip
+import io
+import mmap
+import os
+import re
+import shutil
+import time
+from itertools import islice
+from multiprocessing import Pool
+
+import kstruct_io
+import kstruct_metrics
+from pahole import default_cache_dir, load_struct_index, resolve_member
+
+CSV_FIELDS = [
+    'Process_Name', 'Process_ID', 'CPU_ID', 'Timestamp', 'Runqueue_CPU', 'Field',
+    'Function', 'Access_Type', 'Data_Type', 'Attributes', 'Offset', 'Size (Bytes)', 'Struct', 'Instance'
+]
+
+# Runqueue_CPU is empty (NaN) for structs other than RUNQUEUE_STRUCT, like
+# Offset and Size for unresolved members.
+COLUMN_TYPES = [
+    'category', 'int64', 'int64', 'float64', 'float64', 'category',
+    'category', 'category', 'category', 'category', 'float64', 'float64', 'category', 'int64'
+]
+
+# Only the index of rq[cpu] names a CPU; other structs' [idx] just tells
+# their instances apart (the Instance column).
+RUNQUEUE_STRUCT = 'rq'
+
+WRITE_BATCH_SIZE = 10000
+RANGES_PER_JOB = 4
+
+# <comm> <pid> [<cpu>] <ts>: <event>: Accessed <struct>[<idx>]-><a.b.c> in <function> (<access>)
+LOG_LINE_RE = re.compile(
+    r'^\s*(?P<process_name>.+?)\s+(?P<process_id>\d+)\s+\[(?P<cpu_id>\d+)\]\s+(?P<timestamp>[\d.]+):'
+    r'\s+\S+\s+\S+\s+(?P<struct>\w+)\[(?P<instance>\d+)\]->(?P<field>\S+)'
+    r'\s+\S+\s+(?P<function>\S+)\s+\((?P<access_type>\w+)\)'
+)
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
 
 class LogEntry:
-    def __init__(self, process_name, process_id, cpu_id, timestamp, runqueue_cpu, field, function, access_type):
+    __slots__ = ('process_name', 'process_id', 'cpu_id', 'timestamp', 'runqueue_cpu', 'field',
+                 'function', 'access_type', 'data_type', 'attributes', 'offset', 'size', 'struct', 'instance')
+
+    def __init__(self, process_name, process_id, cpu_id, timestamp, instance, field, function, access_type,
+                 struct):
         self.process_name = process_name
         self.process_id = process_id
         self.cpu_id = cpu_id
         self.timestamp = float(timestamp)
-        self.runqueue_cpu = runqueue_cpu
+        self.instance = instance
+        self.runqueue_cpu = instance if struct == RUNQUEUE_STRUCT else None
         self.field = field
         self.function = function
         self.access_type = access_type
@@ -15,22 +62,15 @@ class LogEntry:
         self.attributes = None
         self.offset = None
         self.size = None
+        self.struct = struct
+
+    def to_row(self):
+        return (self.process_name, self.process_id, self.cpu_id, self.timestamp, self.runqueue_cpu, self.field,
+                self.function, self.access_type, self.data_type, self.attributes, self.offset, self.size,
+                self.struct, self.instance)
 
     def to_dict(self):
-        return {
-            'Process_Name': self.process_name,
-            'Process_ID': self.process_id,
-            'CPU_ID': self.cpu_id,
-            'Timestamp': self.timestamp,
-            'Runqueue_CPU': self.runqueue_cpu,
-            'Field': self.field,
-            'Function': self.function,
-            'Access_Type': self.access_type,
-            'Data_Type': self.data_type,
-            'Attributes': self.attributes,
-            'Offset': self.offset,
-            'Size (Bytes)': self.size
-        }
+        return dict(zip(CSV_FIELDS, self.to_row()))
 
 class LogDAO:
     def __init__(self):
@@ -40,87 +80,212 @@ class LogDAO:
         self.entries.append(log_entry)
 
     def save_to_csv(self, csv_file):
-        csv_fields = [
-            'Process_Name', 'Process_ID', 'CPU_ID', 'Timestamp', 'Runqueue_CPU', 'Field',
-            'Function', 'Access_Type', 'Data_Type', 'Attributes', 'Offset', 'Size (Bytes)'
-        ]
-        with open(csv_file, mode='w', newline='') as file:
-            writer = csv.DictWriter(file, fieldnames=csv_fields)
-            writer.writeheader()
-            for entry in self.entries:
-                writer.writerow(entry.to_dict())
+        write_entries(self.entries, csv_file)
 
     def filter_cross_cpu_access(self):
-        self.entries = [entry for entry in self.entries if int(entry.cpu_id) == int(entry.runqueue_cpu)]
+        self.entries = list(exclude_cross_cpu(self.entries))
 
 def parse_log_line(line):
-    parts = line.split()
-    process_name = parts[0]
-    process_id = parts[1]
-    cpu_id = parts[2][1:-1]
-    timestamp = parts[3][:-1]
-    runqueue_part = parts[6]
-    runqueue_cpu = runqueue_part.split('[')[1].split(']')[0]
-    field = runqueue_part.split('->')[1]
-    function = parts[8]
-    access_type = parts[9][1:-1]
-    return LogEntry(process_name, process_id, cpu_id, timestamp, runqueue_cpu, field, function, access_type)
+    match = LOG_LINE_RE.match(line)
+    if match is None:
+        return None
+    return LogEntry(*match.group('process_name', 'process_id', 'cpu_id', 'timestamp', 'instance',
+                                 'field', 'function', 'access_type', 'struct'))
 
-def parse_log_file(file_path):
-    log_dao = LogDAO()
-    with open(file_path, 'r') as f:
+def open_log(file_path):
+    with open(file_path, 'rb') as f:
+        magic = f.read(4)
+    if magic.startswith(GZIP_MAGIC):
+        return gzip.open(file_path, 'rt')
+    if magic.startswith(ZSTD_MAGIC):
+        try:
+            import zstandard
+        except ImportError:
+            raise SystemExit(f"Error: '{file_path}' is zstd-compressed; install the 'zstandard' package to read it.")
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(file_path, 'rb'), closefd=True))
+    return open(file_path, 'r')
+
+def iter_log_entries(file_path):
+    with open_log(file_path) as f:
         for line in f:
             entry = parse_log_line(line)
-            log_dao.add_entry(entry)
+            if entry is not None:
+                yield entry
+
+def is_compressed(file_path):
+    with open(file_path, 'rb') as f:
+        magic = f.read(4)
+    return magic.startswith(GZIP_MAGIC) or magic.startswith(ZSTD_MAGIC)
+
+def split_byte_ranges(file_path, n_ranges):
+    size = os.path.getsize(file_path)
+    if size == 0:
+        return []
+    bounds = [0]
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for k in range(1, n_ranges):
+            pos = max(size * k // n_ranges, bounds[-1])
+            newline = mm.find(b'\n', pos)
+            bounds.append(size if newline == -1 else newline + 1)
+    bounds.append(size)
+    return [(start, stop) for start, stop in zip(bounds, bounds[1:]) if stop > start]
+
+def iter_range_entries(file_path, start, stop):
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        mm.seek(start)
+        while mm.tell() < stop:
+            entry = parse_log_line(mm.readline().decode())
+            if entry is not None:
+                yield entry
+
+def parse_log_file(file_path):
+    log_dao = LogDAO()
+    for entry in iter_log_entries(file_path):
+        log_dao.add_entry(entry)
     return log_dao
 
-def parse_pahole_data(file_path):
-    parsed_data = {}
-    with open(file_path, 'r') as file:
-        for line in file:
-            line = line.strip()
-            if "/*" in line and 'XXX' not in line:
-                parts = line.split("/*")
-                field_info = parts[0].strip()
-                if not field_info:
-                    continue
-                tokens = field_info.split("__attribute__")
-                data_type = " ".join(tokens[0].strip().split(" ")[:-1]).strip()
-                field_name = tokens[0].strip().split(" ")[-1].replace(";", "")
-                attributes = tokens[1].replace(";", "") if len(tokens) == 2 else ''
-                try:
-                    size_info = (' '.join(parts[1].split()).replace("*/", "")).split(" ")
-                    parsed_data[field_name] = [data_type, attributes, size_info[0], size_info[1]]
-                except (ValueError, AttributeError):
-                    continue
-    return parsed_data
-
-def merge_data(log_dao, pahole_data):
-    for entry in log_dao.entries:
-        if entry.field in pahole_data:
-            entry.data_type, entry.attributes, entry.offset, entry.size = pahole_data[entry.field]
+def enrich_entries(entries, struct_index):
+    # Access paths resolve once per (struct, path); the trace repeats them.
+    resolved = {}
+    for entry in entries:
+        key = (entry.struct, entry.field)
+        if key not in resolved:
+            resolved[key] = resolve_member(struct_index, entry.struct, entry.field)
+        if resolved[key] is not None:
+            entry.data_type, entry.attributes, entry.offset, entry.size = resolved[key]
+        yield entry
+
+def is_cross_cpu(entry):
+    # Only runqueue accesses have a home CPU; other structs are never cross-CPU.
+    return entry.runqueue_cpu is not None and int(entry.cpu_id) != int(entry.runqueue_cpu)
+
+def exclude_cross_cpu(entries):
+    for entry in entries:
+        if not is_cross_cpu(entry):
+            yield entry
+
+def write_entries(entries, output_file, batch_size=WRITE_BATCH_SIZE, header=True):
+    written = 0
+    entries = iter(entries)
+    if kstruct_io.is_columnar(output_file):
+        with kstruct_io.ColumnarWriter(output_file, zip(CSV_FIELDS, COLUMN_TYPES)) as writer:
+            while True:
+                batch = [entry.to_row() for entry in islice(entries, batch_size)]
+                if not batch:
+                    break
+                writer.write_rows(batch)
+                written += len(batch)
+        return written
+
+    with open(output_file, mode='w', newline='') as file:
+        writer = csv.writer(file)
+        if header:
+            writer.writerow(CSV_FIELDS)
+        while True:
+            batch = [entry.to_row() for entry in islice(entries, batch_size)]
+            if not batch:
+                break
+            writer.writerows(batch)
+            written += len(batch)
+    return written
+
+_worker_state = {}
+
+def init_range_worker(struct_index, exclude_cross_cpu_access):
+    _worker_state['struct_index'] = struct_index
+    _worker_state['exclude_cross_cpu'] = exclude_cross_cpu_access
+
+def parse_byte_range(task):
+    file_path, start, stop, output_path, header = task
+    entries = enrich_entries(iter_range_entries(file_path, start, stop), _worker_state['struct_index'])
+    if _worker_state['exclude_cross_cpu']:
+        entries = exclude_cross_cpu(entries)
+    return write_entries(entries, output_path, header=header)
+
+def timed_parse_byte_range(task):
+    begin = time.perf_counter()
+    written = parse_byte_range(task)
+    return written, os.getpid(), time.perf_counter() - begin, task[2] - task[1]
+
+def shard_path(csv_file, index):
+    if kstruct_io.is_columnar(csv_file):
+        return f"{csv_file.rstrip('/')[:-len(kstruct_io.COLUMNAR_SUFFIX)]}.part{index:04d}{kstruct_io.COLUMNAR_SUFFIX}"
+    return f"{csv_file}.part{index:04d}"
+
+def parse_in_parallel(log_file, struct_index, csv_file, n_jobs, exclude_cross_cpu_access=False, keep_shards=False,
+                      metrics=kstruct_metrics.DISABLED):
+    ranges = split_byte_ranges(log_file, n_jobs * RANGES_PER_JOB)
+    tasks = [(log_file, start, stop, shard_path(csv_file, i), keep_shards) for i, (start, stop) in enumerate(ranges)]
+    written = 0
+    with metrics.phase('parse'), Pool(n_jobs, initializer=init_range_worker,
+                                      initargs=(struct_index, exclude_cross_cpu_access)) as pool:
+        for shard_written, worker, seconds, n_bytes in pool.imap(timed_parse_byte_range, tasks):
+            metrics.chunk(worker, seconds, events=shard_written, bytes=n_bytes)
+            written += shard_written
+    if keep_shards:
+        return written
+
+    # Shards come back in file order, so concatenating them keeps one ordered CSV.
+    with metrics.phase('merge'):
+        if kstruct_io.is_columnar(csv_file):
+            shards = [task[3] for task in tasks]
+            kstruct_io.concat_columnar_tables(shards, csv_file)
+            for shard in shards:
+                shutil.rmtree(shard)
+            return written
+
+        with open(csv_file, mode='w', newline='') as out:
+            csv.writer(out).writerow(CSV_FIELDS)
+            for task in tasks:
+                with open(task[3], 'r', newline='') as shard:
+                    shutil.copyfileobj(shard, out)
+                os.remove(task[3])
+    return written
 
 def main():
     parser = argparse.ArgumentParser(description='Parse log and pahole data files and export combined data to CSV.')
-    parser.add_argument('log_file', help='Path to the log file to be parsed')
-    parser.add_argument('pahole_file', help='Path to the pahole data file to be parsed')
-    parser.add_argument('csv_file', help='Path to save the combined CSV file')
-    parser.add_argument('--exclude_cross_cpu', action='store_true', 
+    parser.add_argument('log_file', help='Path to the log file to be parsed (plain, gzip or zstd)')
+    parser.add_argument('pahole_file', help='Path to the pahole data file to be parsed (one struct or a full vmlinux dump)')
+    parser.add_argument('csv_file', help='Path to save the combined CSV file (a path ending in .kcol writes the columnar format)')
+    parser.add_argument('--exclude_cross_cpu', action='store_true',
                         help='Exclude cross-CPU access entries from the final CSV')
+    parser.add_argument('--n_jobs', type=int, default=1,
+                        help='Parse newline-aligned byte ranges of the log in this many processes')
+    parser.add_argument('--keep_shards', action='store_true',
+                        help='With --n_jobs > 1, leave one CSV per byte range (csv_file.partNNNN) instead of one ordered CSV')
+    parser.add_argument('--pahole_cache_dir', default=default_cache_dir(),
+                        help='Directory caching the parsed pahole index by file hash (default: %(default)s)')
+    parser.add_argument('--no_pahole_cache', action='store_true',
+                        help='Always re-parse the pahole file and do not write the cache')
 
-    args = parser.parse_args()
-
-    log_dao = parse_log_file(args.log_file)
-    pahole_data = parse_pahole_data(args.pahole_file)
+    kstruct_metrics.add_arguments(parser)
 
-    merge_data(log_dao, pahole_data)
+    args = parser.parse_args()
+    metrics = kstruct_metrics.StageMetrics.from_args('struct-parser', args)
 
-    if args.exclude_cross_cpu:
-        log_dao.filter_cross_cpu_access()
+    with metrics.phase('pahole'):
+        struct_index = load_struct_index(args.pahole_file, None if args.no_pahole_cache else args.pahole_cache_dir)
+    metrics.count(input_bytes=os.path.getsize(args.log_file))
 
-    log_dao.save_to_csv(args.csv_file)
+    # Compressed logs cannot be split by byte offset, so they always stream serially.
+    if args.n_jobs > 1 and not is_compressed(args.log_file):
+        written = parse_in_parallel(args.log_file, struct_index, args.csv_file, args.n_jobs,
+                                    args.exclude_cross_cpu, args.keep_shards, metrics)
+        metrics.count(events=written)
+        if args.keep_shards:
+            print(f"Data successfully parsed, merged, and saved to shards named like {shard_path(args.csv_file, 0)}")
+            metrics.write()
+            return
+    else:
+        # Reading, parsing and writing are streamed together.
+        with metrics.phase('parse'):
+            entries = enrich_entries(iter_log_entries(args.log_file), struct_index)
+            if args.exclude_cross_cpu:
+                entries = exclude_cross_cpu(entries)
+            metrics.count(events=write_entries(entries, args.csv_file))
 
     print(f"Data successfully parsed, merged, and saved to {args.csv_file}")
+    metrics.write()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,74 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import kstruct_io  # noqa: E402
+
+cache_sim = kstruct_io.import_script("cache-sim")
+
+# (cpu, line, write, field) on two CPUs with one 2-way set each.
+HAND_TRACE = [
+    (0, 0, False, 0),  # miss
+    (0, 0, True, 1),   # hit, cpu 0 modifies line 0 (field 1)
+    (1, 0, False, 0),  # miss, transfer of field 1 from cpu 0
+    (1, 0, True, 0),   # hit, invalidates cpu 0's copy
+    (0, 0, False, 1),  # miss, transfer of field 0 from cpu 1
+    (0, 1, False, 2),  # miss
+    (0, 2, False, 2),  # miss, evicts line 0 from cpu 0
+    (0, 0, False, 0),  # miss, evicts line 1
+    (0, 0, True, 1),   # hit, invalidates cpu 1's copy
+    (0, 0, False, 0),  # hit
+    (0, 0, True, 2),   # hit, line 0 now dirty in field 2
+    (1, 0, False, 1),  # miss, transfer of field 2 from cpu 0
+]
+
+
+def columns(trace):
+    cpus, lines, writes, fields = zip(*trace)
+    return (np.array(cpus, dtype=np.int64), np.array(lines, dtype=np.int64), np.array(writes, dtype=bool),
+            np.array(fields, dtype=np.int64))
+
+
+@pytest.mark.parametrize("collapse", [False, True])
+def test_hand_computed_lru_and_coherence(collapse):
+    sim = cache_sim.simulate_caches(*columns(HAND_TRACE), n_sets=1, ways=2, n_fields=3, collapse=collapse)
+    assert sim['misses'].tolist() == [3, 2, 2]
+    assert sim['transfers'].tolist() == [1, 1, 1]
+    assert sim['invalidations'] == 2
+
+
+def test_collapse_keeps_first_access_and_last_write_of_each_run():
+    cpus, lines, writes, _ = columns(HAND_TRACE)
+    assert cache_sim.collapse_repeats(cpus, lines, writes).tolist() == [0, 1, 2, 3, 4, 5, 6, 7, 10, 11]
+
+
+def synthetic_trace(seed, n=20000):
+    # Runs of accesses by one CPU to a few lines of a shared struct, so that
+    # repeats, evictions, transfers and invalidations all occur.
+    rng = np.random.default_rng(seed)
+    n_runs = n // 4
+    run_cpus = rng.integers(0, 4, n_runs)
+    run_lines = rng.integers(0, 24, n_runs)
+    lengths = rng.integers(1, 8, n_runs)
+    cpus = np.repeat(run_cpus, lengths)[:n]
+    lines = np.repeat(run_lines, lengths)[:n]
+    writes = rng.random(len(cpus)) < 0.3
+    fields = lines * 4 + rng.integers(0, 4, len(cpus))
+    return cpus, lines, writes, fields
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("n_sets,ways", [(1, 1), (1, 4), (4, 2), (64, 8)])
+def test_collapsed_replay_matches_uncollapsed(seed, n_sets, ways):
+    cpus, lines, writes, fields = synthetic_trace(seed)
+    assert len(cache_sim.collapse_repeats(cpus, lines, writes)) < len(lines)
+    full = cache_sim.simulate_caches(cpus, lines, writes, fields, n_sets, ways, 96, collapse=False)
+    collapsed = cache_sim.simulate_caches(cpus, lines, writes, fields, n_sets, ways, 96)
+    assert full['misses'].sum() and full['transfers'].sum() and full['invalidations']
+    np.testing.assert_array_equal(collapsed['misses'], full['misses'])
+    np.testing.assert_array_equal(collapsed['transfers'], full['transfers'])
+    assert collapsed['invalidations'] == full['invalidations']
@@ -0,0 +1,105 @@
+import os
+import sys
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import kstruct_io  # noqa: E402
+
+false_sharing = kstruct_io.import_script("false-sharing")
+
+LINE_SIZE = 64
+WINDOW = 20.0
+# Two fields in each of two cache lines of one struct.
+OFFSETS = {'lock': 0, 'nr_running': 8, 'clock': 64, 'clock_task': 72}
+
+
+def synthetic_trace(n=1500, seed=3):
+    # Integer timestamps keep the window comparisons exact.
+    rng = np.random.default_rng(seed)
+    fields = rng.choice(list(OFFSETS), n)
+    return pd.DataFrame({
+        'CPU_ID': rng.integers(0, 4, n),
+        'Timestamp': np.sort(rng.integers(0, 8 * n, n)).astype(np.float64),
+        'Field': fields,
+        'Access_Type': np.where(rng.random(n) < 0.3, 'modify', 'access'),
+        'Offset': [OFFSETS[field] for field in fields],
+        'Instance': rng.integers(0, 2, n),
+        'Struct': 'rq',
+    })
+
+
+def reference_report(df):
+    # Every event against every earlier event of the same line and struct
+    # instance within the window, one count per other (CPU, field).
+    df = df.sort_values('Timestamp', kind='stable')
+    rows = list(df.itertuples(index=False))
+    false_counts, true_counts, pair_counts = defaultdict(int), defaultdict(int), defaultdict(int)
+    for i, event in enumerate(rows):
+        line = event.Offset // LINE_SIZE
+        recent = defaultdict(bool)
+        for other in rows[:i]:
+            if (other.Instance, other.Offset // LINE_SIZE) != (event.Instance, line) or other.CPU_ID == event.CPU_ID:
+                continue
+            if event.Timestamp - other.Timestamp > WINDOW:
+                continue
+            key = (other.CPU_ID, other.Field)
+            recent[key] |= other.Access_Type == 'modify'
+        for (_, field), modified in recent.items():
+            if not (event.Access_Type == 'modify' or modified):
+                continue
+            if field == event.Field:
+                true_counts[line] += 1
+            else:
+                false_counts[line] += 1
+                pair_counts[tuple(sorted((field, event.Field)))] += 1
+    return dict(false_counts), dict(true_counts), dict(pair_counts)
+
+
+def run(df, tmp_path, chunk_size):
+    path = tmp_path / "access.csv"
+    df.to_csv(path, index=False)
+    contention = false_sharing.LineContention(WINDOW)
+    for chunk in false_sharing.iter_access_chunks(str(path), chunk_size):
+        contention.observe_chunk(chunk, LINE_SIZE)
+    contention.finish()
+    report = contention.report(LINE_SIZE, top_n=100)
+    false_counts = {entry['cacheline']: entry['false_sharing'] for entry in report['lines'] if entry['false_sharing']}
+    true_counts = {entry['cacheline']: entry['true_sharing'] for entry in report['lines'] if entry['true_sharing']}
+    pair_counts = {(entry['a'], entry['b']): entry['count'] for entry in report['field_pairs']}
+    return (false_counts, true_counts, pair_counts), report
+
+
+@pytest.mark.parametrize("chunk_size", [100000, 1, 37, 250])
+def test_counts_match_pairwise_scan(tmp_path, chunk_size):
+    df = synthetic_trace()
+    expected = reference_report(df)
+    assert all(expected)
+    counts, report = run(df, tmp_path, chunk_size)
+    assert counts == expected
+    assert report['late_events'] == 0
+
+
+@pytest.mark.parametrize("chunk_size", [100000, 1, 37])
+def test_out_of_order_within_a_window(tmp_path, chunk_size):
+    # perf merges per-CPU buffers: events arrive up to a window out of order.
+    df = synthetic_trace()
+    rng = np.random.default_rng(11)
+    shuffled = df.iloc[np.argsort(df['Timestamp'].to_numpy() + rng.uniform(0, WINDOW, len(df)), kind='stable')]
+    assert not shuffled['Timestamp'].is_monotonic_increasing
+    counts, report = run(shuffled, tmp_path, chunk_size)
+    assert counts == reference_report(df)
+    assert report['late_events'] == 0
+
+
+def test_late_events_are_skipped_and_counted(tmp_path):
+    df = synthetic_trace()
+    late = df.iloc[[0]].copy()
+    moved = pd.concat([df.iloc[1:], late])
+    counts, report = run(moved, tmp_path, chunk_size=100)
+    assert report['late_events'] == 1
+    assert counts == reference_report(df.iloc[1:])
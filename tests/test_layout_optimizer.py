@@ -0,0 +1,142 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import kstruct_io  # noqa: E402
+
+layout_optimizer = kstruct_io.import_script("layout-optimizer")
+
+LINE_SIZE = 64
+
+
+def member(name, offset, size, data_type="u64", attributes="", bitfield=False):
+    return {"name": name, "type": data_type, "attributes": attributes, "decl": f"{data_type} {name}",
+            "offset": offset, "size": size, "bitfield": bitfield}
+
+
+def sample_struct():
+    # Two co-accessed readers a line apart, a written counter, two bitfields
+    # in one storage unit, a 64-byte aligned block and cold padding members.
+    members = [
+        member("reader_a", 0, 8),
+        member("flag_a", 8, 4, "unsigned int", bitfield=True),
+        member("flag_b", 8, 4, "unsigned int", bitfield=True),
+        member("spare_int", 12, 4, "int"),
+        member("cold_0", 16, 8),
+        member("cold_1", 24, 8),
+        member("cold_2", 32, 8),
+        member("cold_3", 40, 8),
+        member("cold_4", 48, 8),
+        member("cold_5", 56, 8),
+        member("block", 64, 64, "struct block", "__attribute__((__aligned__(64)))"),
+        member("reader_b", 128, 8),
+        member("counter", 136, 8),
+        member("cold_6", 144, 2, "u16"),
+    ]
+    index = {m["name"]: i for i, m in enumerate(members)}
+    affinity = np.zeros((len(members), len(members)))
+
+    def pair(a, b, weight):
+        affinity[index[a], index[b]] = affinity[index[b], index[a]] = weight
+
+    pair("reader_a", "reader_b", 50)
+    pair("reader_a", "flag_b", 10)
+    pair("block", "counter", 1)
+    reads = np.zeros(len(members))
+    writes = np.zeros(len(members))
+    reads[[index["reader_a"], index["reader_b"], index["flag_a"]]] = 20
+    writes[index["counter"]] = 40
+    return members, index, affinity, reads, writes
+
+
+def propose(members, affinity, reads, writes, write_penalty=1.0, **kwargs):
+    offsets, aligns, score, penalty, rejected = layout_optimizer.propose_layout(
+        members, affinity, reads, writes, LINE_SIZE, write_penalty, **kwargs)
+    layout = layout_optimizer.describe_layout("sample", members, offsets, aligns, max(aligns), LINE_SIZE)
+    return offsets, aligns, score, penalty, rejected, layout
+
+
+def test_offsets_alignment_and_padding():
+    members, index, affinity, reads, writes = sample_struct()
+    offsets, aligns, score, penalty, rejected, layout = propose(members, affinity, reads, writes)
+    assert not rejected
+    assert sorted(offsets) == list(range(len(members)))
+    assert offsets[index["block"]] % 64 == 0
+    for i, offset in offsets.items():
+        assert offset % aligns[i] == 0
+    # Bitfields of one storage unit stay together; nothing else overlaps.
+    assert offsets[index["flag_a"]] == offsets[index["flag_b"]]
+    spans = sorted((offsets[i], offsets[i] + members[i]["size"]) for i in offsets if i != index["flag_b"])
+    assert all(end <= start for (_, end), (start, _) in zip(spans, spans[1:]))
+    # The co-accessed readers and the bitfield read with them share a line.
+    lines = {name: offsets[index[name]] // LINE_SIZE for name in ("reader_a", "reader_b", "flag_b")}
+    assert len(set(lines.values())) == 1
+    assert offsets[index["counter"]] // LINE_SIZE != lines["reader_a"]
+
+    end = max(offset + members[i]["size"] for i, offset in offsets.items())
+    assert layout["size"] == layout_optimizer.align_up(end, 64) == score["proposed"]["size"]
+    assert layout["padding"] == layout["size"] - end
+    assert layout["member_bytes"] + sum(h["size"] for h in layout["holes"]) + layout["padding"] == layout["size"]
+    assert layout["member_bytes"] == sum(m["size"] for m in members) - members[index["flag_b"]]["size"]
+
+
+def test_proposal_never_regresses():
+    members, index, affinity, reads, writes = sample_struct()
+    for write_penalty in (0.0, 0.5, 1.0, 4.0, 64.0):
+        _, _, score, penalty, rejected, _ = propose(members, affinity, reads, writes, write_penalty)
+        assert penalty >= write_penalty
+        for key in ("write_sharing", "size", "hot_cache_lines"):
+            assert score["proposed"][key] <= score["original"][key]
+        assert score["proposed"]["intra_line_fraction"] > score["original"]["intra_line_fraction"]
+
+
+def growth_struct():
+    # A written member shares a line with the fields it is (weakly)
+    # co-accessed with. Cold members can fill a line of its own, but moving
+    # it there costs a second hot line.
+    members = [member("writer", 0, 8), member("reader", 8, 8), member("hot_x", 16, 8), member("hot_y", 24, 8)]
+    members += [member(f"cold_{k}", 32 + 8 * k, 8) for k in range(12)]
+    affinity = np.zeros((len(members), len(members)))
+    affinity[0, 1] = affinity[1, 0] = 1
+    affinity[2, 3] = affinity[3, 2] = 99
+    reads = np.zeros(len(members))
+    writes = np.zeros(len(members))
+    reads[1:4] = [100, 10, 10]
+    writes[0] = 100
+    return members, affinity, reads, writes
+
+
+def test_growth_is_rejected_unless_allowed():
+    members, affinity, reads, writes = growth_struct()
+    offsets, _, score, _, rejected, layout = propose(members, affinity, reads, writes)
+    assert rejected == ["hot_cache_lines"]
+    assert offsets == {i: m["offset"] for i, m in enumerate(members)}
+    assert score["proposed"] == score["original"]
+
+    offsets, _, score, penalty, rejected, layout = propose(members, affinity, reads, writes, allow_growth=True)
+    assert not rejected and penalty == 1.0
+    assert offsets[0] // LINE_SIZE != offsets[1] // LINE_SIZE
+    assert score["proposed"]["write_sharing"] < score["original"]["write_sharing"]
+    assert score["proposed"]["hot_cache_lines"] == 2 and layout["size"] == 128
+    assert not layout["holes"] and not layout["padding"]
+    assert layout_optimizer.regressions(score["proposed"], score["original"], False, False) == ["hot_cache_lines"]
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_random_affinity_never_regresses(seed):
+    rng = np.random.default_rng(seed)
+    members, _, _, _, _ = sample_struct()
+    n = len(members)
+    affinity = np.triu(rng.integers(0, 5, (n, n)) * (rng.random((n, n)) < 0.3), 1).astype(float)
+    affinity += affinity.T
+    reads = rng.integers(0, 20, n).astype(float)
+    writes = rng.integers(0, 20, n) * (rng.random(n) < 0.4)
+    offsets, _, score, _, rejected, _ = propose(members, affinity, reads, writes)
+    if rejected:
+        assert offsets == {i: m["offset"] for i, m in enumerate(members)}
+    for key in ("write_sharing", "size", "hot_cache_lines"):
+        assert score["proposed"][key] <= score["original"][key]
@@ -0,0 +1,156 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import kstruct_io  # noqa: E402
+
+proximity_graph = kstruct_io.import_script("proximity-graph")
+
+FIELDS = ['avg', 'clock', 'curr', 'idle', 'lock', 'nr_running', 'nr_switches', 'online']
+FUNCTIONS = ['enqueue_task', 'dequeue_task', 'pick_next_task', 'update_curr', 'try_to_wake_up']
+
+
+@pytest.fixture(scope="module")
+def trace(tmp_path_factory):
+    # Integer timestamps keep every window comparison exact in float32; a
+    # few ties check that equal timestamps stay in log order.
+    rng = np.random.default_rng(7)
+    n = 600
+    timestamps = np.sort(rng.integers(0, 1500, n))
+    df = pd.DataFrame({
+        'Timestamp': timestamps.astype(np.float64),
+        'Field': rng.choice(FIELDS, n),
+        'Function': rng.choice(FUNCTIONS, n, p=[0.4, 0.3, 0.15, 0.1, 0.05]),
+        'Runqueue_CPU': rng.integers(0, 3, n),
+    })
+    path = tmp_path_factory.mktemp("trace") / "log.csv"
+    df.to_csv(path, index=False)
+    return df, str(path)
+
+
+def reference_counts(df, method, param):
+    # Straightforward O(n^2) window and list-based LRU stack scans over the
+    # trace, as ordered unordered-pair matrices over sorted FIELDS, and the
+    # same counts per function of the access completing each pair.
+    labels = sorted(FIELDS)
+    functions = sorted(FUNCTIONS)
+    codes = [labels.index(field) for field in df['Field']]
+    calls = [functions.index(function) for function in df['Function']]
+    counts = np.zeros((len(labels), len(labels)), dtype=np.int64)
+    attribution = np.zeros((len(labels), len(labels), len(functions)), dtype=np.int64)
+    if method == "window":
+        order = np.argsort(df['Timestamp'].to_numpy(), kind='stable')
+        timestamps = df['Timestamp'].to_numpy(dtype=np.float32)[order]
+        codes = [codes[i] for i in order]
+        calls = [calls[i] for i in order]
+        for i in range(len(codes)):
+            for j in range(i + 1, len(codes)):
+                if timestamps[j] - timestamps[i] > param:
+                    break
+                if codes[i] != codes[j]:
+                    counts[codes[i], codes[j]] += 2
+                    attribution[codes[i], codes[j], calls[j]] += 2
+    else:
+        stack = []
+        for code, call in zip(codes, calls):
+            if code in stack:
+                stack.remove(code)
+            stack.insert(0, code)
+            for other in stack[1:param + 1]:
+                counts[code, other] += 1
+                attribution[code, other, call] += 1
+    upper = np.triu(counts + counts.T, 1)
+    return upper, np.triu(np.moveaxis(attribution + attribution.transpose(1, 0, 2), 2, 0), 1)
+
+
+def finished_matrix(method, counts):
+    finished = proximity_graph.finish_pair_counts(method, counts)
+    rows, cols, weights = proximity_graph.pair_entries(finished)
+    matrix = np.zeros((finished.n_fields, finished.n_fields), dtype=np.int64)
+    matrix[rows, cols] = weights
+    return finished, matrix
+
+
+def count(path, method, param, n_jobs, chunk_size, sparse=False, partition_by=None, top_k=None):
+    labels, field_events, partitions, counts, partition_counts = proximity_graph.count_in_chunks(
+        path, method, param, n_jobs, chunk_size, sparse, partition_by, attribution_top_k=top_k)
+    assert labels == sorted(FIELDS)
+    return counts, partitions, partition_counts
+
+
+@pytest.mark.parametrize("method,param", [("window", 40.0), ("window", 400.0), ("stack", 2), ("stack", 5)])
+@pytest.mark.parametrize("n_jobs,chunk_size", [(1, 100000), (1, 7), (3, 50), (4, 128)])
+@pytest.mark.parametrize("sparse", [False, True])
+def test_counts_match_reference(trace, method, param, n_jobs, chunk_size, sparse):
+    df, path = trace
+    expected, _ = reference_counts(df, method, param)
+    counts, _, _ = count(path, method, param, n_jobs, chunk_size, sparse)
+    np.testing.assert_array_equal(finished_matrix(method, counts)[1], expected)
+
+
+@pytest.mark.parametrize("method,param", [("window", 40.0), ("stack", 3)])
+def test_partition_counts_match_reference(trace, method, param):
+    df, path = trace
+    counts, partitions, partition_counts = count(path, method, param, 2, 60, partition_by='Runqueue_CPU')
+    for (key, _, _), part_counts in zip(partitions, partition_counts):
+        expected, _ = reference_counts(df[df['Runqueue_CPU'] == key], method, param)
+        np.testing.assert_array_equal(finished_matrix(method, part_counts)[1], expected)
+
+
+def attribution_entries(attribution):
+    # {(a, b): {function code or None for "[other]": weight}}
+    pairs, functions = np.divmod(attribution.keys, attribution.n_functions)
+    entries = {}
+    for pair, function, weight in zip(pairs.tolist(), functions.tolist(), attribution.values.tolist()):
+        entries.setdefault(divmod(pair, attribution.n_fields), {})[function] = weight
+    for pair, weight in zip(attribution.other_keys.tolist(), attribution.other_values.tolist()):
+        entries.setdefault(divmod(pair, attribution.n_fields), {})[None] = weight
+    return entries
+
+
+@pytest.mark.parametrize("method,param", [("window", 40.0), ("stack", 3)])
+@pytest.mark.parametrize("n_jobs,chunk_size", [(1, 100000), (3, 50)])
+@pytest.mark.parametrize("sparse", [False, True])
+def test_attribution_matches_reference(trace, method, param, n_jobs, chunk_size, sparse):
+    # With top_k covering every function nothing is compacted, so each
+    # function's weight is exact.
+    df, path = trace
+    _, expected = reference_counts(df, method, param)
+    counts, _, _ = count(path, method, param, n_jobs, chunk_size, sparse, top_k=len(FUNCTIONS))
+    finished, _ = finished_matrix(method, counts)
+    entries = attribution_entries(finished.attribution)
+    assert finished.attribution.function_labels == sorted(FUNCTIONS)
+    assert not len(finished.attribution.other_keys)
+    for f, a, b in zip(*np.nonzero(expected)):
+        assert entries[(a, b)][f] == expected[f, a, b]
+    assert sum(len(functions) for functions in entries.values()) == np.count_nonzero(expected)
+
+
+@pytest.mark.parametrize("method,param", [("window", 400.0), ("stack", 5)])
+@pytest.mark.parametrize("n_jobs,chunk_size", [(1, 100000), (1, 7), (3, 50)])
+@pytest.mark.parametrize("top_k", [1, 2])
+def test_attribution_sums_to_graph_weights(trace, tmp_path, method, param, n_jobs, chunk_size, top_k):
+    df, path = trace
+    counts, _, _ = count(path, method, param, n_jobs, chunk_size, top_k=top_k)
+    finished, matrix = finished_matrix(method, counts)
+    entries = attribution_entries(finished.attribution)
+    assert len(finished.attribution.other_keys)
+    assert set(entries) == set(zip(*np.nonzero(matrix)))
+    for (a, b), functions in entries.items():
+        assert a < b
+        assert len([f for f in functions if f is not None]) <= top_k
+        assert sum(functions.values()) == matrix[a, b]
+
+    # The same holds for the file hierarchical-clustering.py reads.
+    attribution_file = tmp_path / "attribution.csv"
+    labels = sorted(FIELDS)
+    proximity_graph.write_attribution(finished.attribution, labels, str(attribution_file))
+    written = kstruct_io.read_attribution(str(attribution_file))
+    assert len(written) == len(entries)
+    for (a, b), functions in written.items():
+        assert sum(weight for _, weight in functions) == matrix[labels.index(a), labels.index(b)]
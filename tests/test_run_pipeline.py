@@ -0,0 +1,45 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import kstruct_io  # noqa: E402
+
+run_pipeline = kstruct_io.import_script("run-pipeline")
+
+
+def write_output(out_dir):
+    with open(os.path.join(out_dir, 'result.txt'), 'w') as f:
+        f.write('done')
+
+
+def test_failed_build_leaves_no_temporary_directory(tmp_path):
+    cache = run_pipeline.StageCache(str(tmp_path))
+
+    def fail(out_dir):
+        write_output(out_dir)
+        raise OSError("No space left on device")
+
+    with pytest.raises(OSError):
+        cache.run('parse', 'key', fail)
+    assert os.listdir(tmp_path / 'parse') == []
+
+    path, cached = cache.run('parse', 'key', write_output)
+    assert not cached and os.listdir(tmp_path / 'parse') == ['key']
+    assert cache.run('parse', 'key', write_output) == (path, True)
+
+
+def test_concurrent_store_of_the_same_key(tmp_path):
+    cache = run_pipeline.StageCache(str(tmp_path))
+
+    def racing(out_dir):
+        # Another run finishes the same key while this one builds.
+        os.makedirs(tmp_path / 'parse' / 'key')
+        write_output(str(tmp_path / 'parse' / 'key'))
+        write_output(out_dir)
+
+    path, cached = cache.run('parse', 'key', racing)
+    assert not cached and os.listdir(tmp_path / 'parse') == ['key']
+    assert os.listdir(path) == ['result.txt']